@@ -2,11 +2,15 @@
 
 import argparse
 import multiprocessing
+import os
 from os import kill,environ
 from signal import SIGINT
 import sys
 import numpy as np
 import re
+import time
+import threading
+import concurrent.futures
 
 # Do not ask me why this needs to be included now...
 sys.path.append("./eevee")
@@ -16,22 +20,27 @@ import lappdIfc
 
 #
 # Common parameters that are used by anything intaking packets
+# (tools that can drive several boards at once pass several=True)
 #
-def create(leader):
+def create(leader, several=False):
     
     parser = argparse.ArgumentParser(description=leader)
     
-    parser.add_argument('board', metavar='IP_ADDRESS', type=str, help='IP address of the target board')
+    if several:
+        parser.add_argument('board', metavar='IP_ADDRESS', type=str, nargs='+', help='IP addresses of the target boards (configured concurrently)')
+    else:
+        parser.add_argument('board', metavar='IP_ADDRESS', type=str, help='IP address of the target board')
 
-    parser.add_argument('-a', '--aim', metavar='UDP_PORT', type=int, help='Aim the board at this port on this machine.')
+    parser.add_argument('-a', '--aim', metavar='UDP_PORT', type=int, help='Aim the board at this port on this machine.  With several boards, each gets its own block of NUM_THREADS ports, in order.')
     parser.add_argument('-c', '--channels', metavar='CHANNELS', help="Explicitly force a hex channel mask. (Persistent)")
     parser.add_argument('-w', '--wait', metavar='WAIT', type=int, help="Adjust delay between receipt of soft/hard trigger and DRS4 sampling stop. (Persistant)")
-    parser.add_argument('-u', '--udpsport', metavar='UDPSPORT', type=int, help="Set the originating port for outgoing control signals explicitly")
+    parser.add_argument('-u', '--udpsport', metavar='UDPSPORT', type=int, help="Set the originating port for outgoing control signals explicitly (incremented for each further board)")
     
     parser.add_argument('-N', metavar='NUM_SAMPLES', type=int, default=0, help='Issue N soft triggers of the board')
     parser.add_argument('-r', '--rate', metavar='RATE', type=float, default=100, help='The rate (in Hz) of software triggers')
     parser.add_argument('-I', '--initialize', action="store_true", help="Initialize the board")
     parser.add_argument('-t', '--threads', metavar="NUM_THREADS", type=int, help="Number of distinct ports to receive data.  Ports increment from the aimed port.")
+    parser.add_argument('--depth', metavar='DEPTH', type=int, default=PIPELINE_DEPTH, help='Register transactions in flight during bulk reads and writes (default: %d)' % PIPELINE_DEPTH)
 
     parser.add_argument('--adctestpattern', help='ADC custom mode test pattern')
     parser.add_argument('-e', '--external', type=int, help='Adjust extriggering (odd is on)')
@@ -86,9 +95,14 @@ def create(leader):
 
 ifc = None
 
+# Every board connect() configured, by address, as (ifc, pipeline)
+boards = {}
+
 def connect(parser):
 
     global ifc
+    global pipeline
+    global boards
 
     # Parse the arguments
     args = parser.parse_args()
@@ -98,8 +112,73 @@ def connect(parser):
         print("Given rate", args.rate, "is non-sensical.")
         exit(1)
 
+    # Settings are understood once, and applied to every board
+    settings(args)
+
+    addresses = args.board if isinstance(args.board, list) else [args.board]
+
+    # Boards after the first get their own ports
+    def bringup(address):
+        k = addresses.index(address)
+        return configure(address,
+                         args,
+                         aim=None if args.aim is None else args.aim + k*(args.threads or 1),
+                         udpsport=None if args.udpsport is None else args.udpsport + k)
+
+    boards, errors = everyboard(addresses, bringup, 'configured')
+    if errors:
+        exit(1)
+
+    # The first board is the one tools work with by default
+    ifc, pipeline = boards[addresses[0]]
+
+    # Give the socket address for use by spawn()
+    args.listen = ifc.brd.s.getsockname()[0]
+
+    # Return a tuble with the interface and the arguments
+    return (ifc, args)
+
+#
+# Turn textual settings into register values
+#
+def settings(args):
+
+    if not args.adctestpattern is None and args.adcmode == 'custom':
+        args.adctestpattern = int(args.adctestpattern, 0)
+
+    # Set the channels?
+    if not args.channels is None:
+        try:
+            args.channels = int(args.channels, base=16)
+        except ValueError as e:
+            # Allow the same channel specifications as the browser
+            args.channels = chans2bitmask(parse_speclist(args.channels))
+
+    # Set the and mask?
+    if not args.andtrigger is None:
+        try:
+            args.andtrigger = int(args.andtrigger, base=16)
+        except ValueError as e:
+            args.andtrigger = chans2bitmask(parse_speclist(args.andtrigger))
+
+    # Set the or mask?
+    if not args.ortrigger is None:
+        try:
+            args.ortrigger = int(args.ortrigger, base=16)
+        except ValueError as e:
+            args.ortrigger = chans2bitmask(parse_speclist(args.ortrigger))
+
+#
+# Connect to the board at address and apply the (already understood) settings in args.
+# Boards don't share anything, so several can be configured at once.
+#
+def configure(address, args, aim=None, udpsport=None):
+
     # Connect to the board
-    ifc = lappdIfc.lappdInterface(args.board, udpsport=args.udpsport)
+    ifc = lappdIfc.lappdInterface(address, udpsport=udpsport)
+
+    # More connections for pipelined bulk transactions (made when they're first needed)
+    pipeline = lazyPipeline(ifc.brd, address, args.depth)
 
     # Initialize the board, if requested
     if args.initialize:
@@ -109,18 +188,14 @@ def connect(parser):
     if args.threads is not None:
         ifc.brd.pokenow(lappdIfc.NUDPPORTS, args.threads)
 
-    # Give the socket address for use by spawn()
-    if args.aim is not None:
-        ifc.brd.aimNBIC(port=args.aim)
-    
-    args.listen = ifc.brd.s.getsockname()[0]
+    # Aim the board
+    if aim is not None:
+        ifc.brd.aimNBIC(port=aim)
 
     # Set both adc's if requested
     # XXX? Is this wrong to do at this point?
     if not args.adcmode is None:
         if not args.adctestpattern is None and args.adcmode == 'custom':
-            args.adctestpattern = int(args.adctestpattern, 0)
-            
             ifc.AdcSetTestPat(0, args.adctestpattern)
             ifc.AdcSetTestPat(1, args.adctestpattern)
             
@@ -146,45 +221,24 @@ def connect(parser):
     for dacout, derp in derps:
         eval_derp = eval('args.%s' % derp)
         if not eval_derp is None:
-            print("Setting %s to %f..." % (derp, eval_derp))
+            print("Setting %s to %f on %s..." % (derp, eval_derp, address))
             for num in (0,1):
                 ifc.DacSetVout(num, dacout, eval_derp)
                 
-    # Set the channels?
+    # Write the masks out all at once
     if not args.channels is None:
-        try:
-            args.channels = int(args.channels, base=16)
-        except ValueError as e:
-            # Allow the same channel specifications as the browser
-            args.channels = chans2bitmask(parse_speclist(args.channels))
+        writemask(lappdIfc.ADCCHANMASK_0, args.channels, ifc.brd)
 
-        # Write it out all at once
-        writemask(lappdIfc.ADCCHANMASK_0, args.channels)
-
-    # Set the and mask?
     if not args.andtrigger is None:
-        try:
-            args.andtrigger = int(args.andtrigger, base=16)
-        except ValueError as e:
-            args.andtrigger = chans2bitmask(parse_speclist(args.andtrigger))
-
-        # Write it out
-        writemask(lappdIfc.ZERSUPMASKAND_0, args.andtrigger)
+        writemask(lappdIfc.ZERSUPMASKAND_0, args.andtrigger, ifc.brd)
 
-    # Set the or mask?
     if not args.ortrigger is None:
-        try:
-            args.ortrigger = int(args.ortrigger, base=16)
-        except ValueError as e:
-            args.ortrigger = chans2bitmask(parse_speclist(args.ortrigger))
-
-        # Write it out
-        writemask(lappdIfc.ZERSUPMASKOR_0, args.ortrigger)
+        writemask(lappdIfc.ZERSUPMASKOR_0, args.ortrigger, ifc.brd)
 
     # Set the wait?
     if not args.wait is None:
         ifc.brd.pokenow(lappdIfc.DRSWAITSTART, args.wait)
-        print("Setting STOP delay to: %d" % args.wait, file=sys.stderr)
+        print("Setting STOP delay on %s to: %d" % (address, args.wait), file=sys.stderr)
 
     if not args.external is None:
         ifc.RegSetBit(lappdIfc.MODE, lappdIfc.C_MODE_EXTTRG_EN_BIT, args.external & 1)
@@ -197,9 +251,53 @@ def connect(parser):
 
     if not args.zsuppress is None:
         ifc.RegSetBit(lappdIfc.MODE, lappdIfc.C_MODE_ZERSUP_EN_BIT, args.zsuppress & 1)
-        
-    # Return a tuble with the interface and the arguments
-    return (ifc, args)
+
+    return (ifc, pipeline)
+
+#
+# Run work(address) for every board at once, a thread each, so that a rack
+# takes as long as its slowest board rather than all of them together.
+# Returns the results, and whatever was raised by the ones that failed, by address.
+# A single board is just done, and anything it raises goes through.
+#
+def everyboard(addresses, work, what='done'):
+
+    if len(addresses) == 1:
+        return ({ addresses[0] : work(addresses[0]) }, {})
+
+    results = {}
+    errors = {}
+    times = {}
+
+    def timed(address):
+        start = time.monotonic()
+        try:
+            return work(address)
+        finally:
+            times[address] = time.monotonic() - start
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(len(addresses)) as pool:
+        futures = [(address, pool.submit(timed, address)) for address in addresses]
+        for address, future in futures:
+            try:
+                results[address] = future.result()
+            except Exception as e:
+                errors[address] = e
+
+    # Report
+    for address in addresses:
+        if address in errors:
+            print("%s: FAILED after %.2f s (%s: %s)" % (address, times[address], type(errors[address]).__name__, errors[address]), file=sys.stderr)
+        else:
+            print("%s: %s in %.2f s" % (address, what, times[address]), file=sys.stderr)
+
+    print("%d of %d boards %s in %.2f s (%.2f s one after another)" % (len(results),
+                                                                        len(addresses),
+                                                                        what,
+                                                                        time.monotonic() - start,
+                                                                        sum(times.values())), file=sys.stderr)
+    return (results, errors)
 
 #
 # Strip mappings to channels.
@@ -335,81 +433,129 @@ def parse_speclist(speclist):
     return [x for x in inclusions if x not in exclusions]
 
 #
-# Do a block write of EEVEE register space, using
-# fast register trasnactions
+# Bulk register transactions.
 #
-# Eventually, this should be replaced with some sort bulk write
-# from a base pointer in C, with a different type of EEVEE transaction
+# Register space is read and written in chunks of chunksize registers, one
+# transaction each.  Given a pipeline (a list of connections to the same board,
+# see connections()), chunks are spread over the connections, and each connection
+# works through its share in its own thread, so that depth transactions are in
+# flight at once.  Every connection has its own socket, so responses can't be
+# mixed up between them.  A chunk whose transaction fails, or whose response
+# doesn't cover every register asked for, is retried (up to retries times).
 #
-def blockwrite(board, baseaddr, data, chunksize=32):
+# Transactions in flight for bulk reads and writes
+PIPELINE_DEPTH = 4
 
-    # Start at the beginning
-    offset = 0
-    
-    while offset < len(data):
+# Connections to the board, made by connect() (the first is ifc.brd, see lazyPipeline)
+pipeline = None
 
-        # Reset it
-        act = {}
-        count = 0
-        
-        # Build up a chunk
-        while count < chunksize:
-            act[baseaddr + offset*4] = data[offset]
-            offset += 1
-            count += 1
-
-            # Check for end of data
-            if offset == len(data):
-                break
-    
+# depth connections to the board at address
+def connections(address, depth=PIPELINE_DEPTH):
+    import eevee
+    return [eevee.board(address) for k in range(depth)]
+
+#
+# A pipeline that starts out as just the board's own connection, and grows
+# (up to depth) the first time a bulk transaction has the chunks to use more,
+# so tools that never do one don't open sockets they don't need.
+#
+class lazyPipeline(list):
+
+    def __init__(self, board, address, depth=PIPELINE_DEPTH):
+        super().__init__([board])
+        self.address = address
+        self.depth = depth
+
+    # Have enough connections for count chunks at once
+    def grow(self, count):
+        wanted = min(count, self.depth)
+        if len(self) < wanted:
+            self.extend(connections(self.address, wanted - len(self)))
+
+# Chunk boundaries, split over the connections
+def chunkplan(length, chunksize, boards):
+    chunks = [(offset, min(offset + chunksize, length)) for offset in range(0, length, chunksize)]
+    return [(board, chunks[k::len(boards)]) for k, board in enumerate(boards)]
+
+# Run work(board, lo, hi) over every chunk, a thread per connection
+def pipelined(board, length, chunksize, retries, work):
+
+    if isinstance(board, lazyPipeline):
+        board.grow((length + chunksize - 1) // chunksize)
+    boards = board if isinstance(board, list) else [board]
+
+    def worker(board, chunks):
+        for lo, hi in chunks:
+            for attempt in range(retries + 1):
+                try:
+                    work(board, lo, hi)
+                    break
+                except (OSError, KeyError, IndexError) as e:
+                    if attempt == retries:
+                        raise
+                    print("Register transaction for %d registers failed (%s), retrying..." % (hi - lo, e), file=sys.stderr)
+
+    plan = chunkplan(length, chunksize, boards)
+    if len(plan) == 1:
+        worker(*plan[0])
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(len(plan)) as pool:
+        for future in [pool.submit(worker, *job) for job in plan]:
+            future.result()
+
+#
+# Write values into the given registers
+#
+def scatterwrite(board, addrs, values, chunksize=32, retries=3):
+
+    addrs = np.asarray(addrs).tolist()
+    values = np.asarray(values).tolist()
+
+    def work(board, lo, hi):
         # Write out the chunk, or any remainder
-        board.poke(act, silent=True)
+        board.poke(dict(zip(addrs[lo:hi], values[lo:hi])), silent=True)
         board.transact()
 
+    pipelined(board, len(addrs), chunksize, retries, work)
+
 #
-# NOTE: length is not byte length, its number of 32-bit addresses to 
-#       qwerty
+# Read the given registers
 #
-def blockread(board, baseaddr, length, chunksize=32, cast=np.int16):
-    # Start at the beginning
-    offset = 0
+def scatterread(board, addrs, chunksize=32, cast=np.int64, retries=3):
 
-    results = {}
-    
-    while offset < length:
+    addrs = np.asarray(addrs).tolist()
 
-        # Reset it
-        act = {}
-        count = 0
-        
-        # Build up a chunk
-        while count < chunksize:
-            act[baseaddr + offset*4] = 0x0
-            offset += 1
-            count += 1
-
-            # Check for end of data
-            if offset == length:
-                break
-    
+    # Results go straight into place
+    datablock = np.zeros((len(addrs)), dtype=cast)
+
+    def work(board, lo, hi):
         # Read out the chunk, or any remainder
-        board.peek(act)
+        board.peek(dict.fromkeys(addrs[lo:hi], 0x0))
 
         # Zero index because there was a single transaction
         # .data because this attribute contains the reconstructed register dictionary
+        # (KeyError if the response is missing any of them)
         regdict = board.transact()[0].data
-        results = {**results, **regdict}
+        datablock[lo:hi] = [regdict[addr] for addr in addrs[lo:hi]]
 
-    # Now assemble the resulting dictionary back into a contiguous numpy type
-    datablock = np.zeros((length), dtype=cast)
+    pipelined(board, len(addrs), chunksize, retries, work)
 
-    offset = 0
-    while offset < length:
-        datablock[offset] = results[baseaddr + offset*4]
-        offset += 1
-
-    # Return the datablock
     return datablock
+
+#
+# Do a block write of EEVEE register space, using
+# fast register trasnactions
+#
+def blockwrite(board, baseaddr, data, chunksize=32, retries=3):
+    scatterwrite(board, baseaddr + 4*np.arange(len(data)), data, chunksize, retries)
+
+#
+# NOTE: length is not byte length, its number of 32-bit addresses to 
+#       qwerty
+#
+def blockread(board, baseaddr, length, chunksize=32, cast=np.int16, retries=3):
+    return scatterread(board, baseaddr + 4*np.arange(length), chunksize, cast, retries)
     
 #
 # Convenience coverter from signed millivolts to natural ADC units
@@ -439,8 +585,229 @@ def chans2bitmask(chans):
 # Write a 64 bit mask, in little endian.
 # Do them both at once, so there's a greater chance of success under high rate.
 #
-def writemask(baseaddr, mask):
-    ifc.brd.poke({ baseaddr : mask & 0x00000000FFFFFFFF,
-                   baseaddr+4 : (mask & 0xFFFFFFFF00000000) >> 32 }, readback=False)
-    ifc.brd.transact()
-    
+def writemask(baseaddr, mask, board=None):
+    board = ifc.brd if board is None else board
+    board.poke({ baseaddr : mask & 0x00000000FFFFFFFF,
+                 baseaddr+4 : (mask & 0xFFFFFFFF00000000) >> 32 }, readback=False)
+    board.transact()
+
+#
+# Soft triggers
+#
+SOFTTRIGGER = 0x320
+SOFTTRIGGER_BIT = 6
+
+# Send count soft triggers in a single control packet
+def softtrigger(board, count=1):
+    # Suppress board readback and response!
+    if count == 1:
+        board.pokenow(SOFTTRIGGER, 1 << SOFTTRIGGER_BIT, readback=False, silent=True)
+        return
+
+    for k in range(count):
+        board.poke({ SOFTTRIGGER : 1 << SOFTTRIGGER_BIT }, readback=False, silent=True)
+    board.transact()
+
+#
+# Sends soft triggers at a steady rate.
+#
+# Triggers are due at absolute times (start + k/rate), so a late one doesn't
+# push back the rest.  The OS sleeps most of the way to each deadline,
+# and the last SPIN seconds are spun off, since sleeps overshoot.
+# With batch > 1, triggers go out batch at a time, one control packet each,
+# for rates beyond what one packet per trigger can keep up with.  That only
+# helps if the firmware queues soft triggers: otherwise the pokes in a packet
+# land while the board is still reading out the first one, and are dropped.
+# Batching hasn't been checked on hardware yet.
+#
+# What's reported is the rate pokes went out at, not the rate events came
+# back at (count events in the run for that).
+#
+SPIN = 0.002
+
+class triggerScheduler(object):
+
+    def __init__(self, ifc, rate, batch=1):
+        self.ifc = ifc
+        self.rate = rate
+        self.batch = max(batch, 1)
+
+    # Send N triggers, and report how it went
+    def run(self, N):
+        batches = (N + self.batch - 1) // self.batch
+        period = self.batch / self.rate
+
+        deadlines = time.monotonic() + period*np.arange(batches)
+        sent = np.empty(batches)
+
+        for k in range(batches):
+
+            # Sleep, then spin
+            remaining = deadlines[k] - time.monotonic()
+            if remaining > SPIN:
+                time.sleep(remaining - SPIN)
+            while time.monotonic() < deadlines[k]:
+                pass
+
+            sent[k] = time.monotonic()
+            softtrigger(self.ifc.brd, min(self.batch, N - k*self.batch))
+
+        return self.report(N, deadlines, sent)
+
+    # Sending rate and jitter (lateness of each control packet against its deadline)
+    def report(self, N, deadlines, sent):
+        if not len(sent):
+            return None
+
+        late = (sent - deadlines) * 1e6
+        elapsed = sent[-1] - sent[0]
+        sending = (N - (N - 1) % self.batch - 1) / elapsed if elapsed > 0 else float('nan')
+
+        print("Sent %d soft trigger pokes in %d packets at %.1f Hz (%.1f Hz requested), jitter %.1f us rms, %.1f us max" %
+              (N, len(sent), sending, self.rate, late.std(), late.max()), file=sys.stderr)
+
+        return { 'requested' : self.rate,
+                 'sending' : sending,
+                 'jitter_rms' : late.std(),
+                 'jitter_max' : late.max() }
+
+#
+# Soft triggered acquisition, labelled by what actually arrives.
+#
+# Triggers go out no faster than rate, with at most window of them unanswered,
+# while the run's index is followed for the events they produce.  A step is
+# over when all its events have arrived, or nothing has arrived for timeout
+# seconds after the last trigger.
+#
+# The board numbers events one per trigger, so a step's events are exactly
+# first ... first + sent - 1, where first is the step's first event number
+# (the previous step's first + sent, or for the very first step, the first
+# event to arrive).  Stragglers from a step that timed out are ignored by the
+# next one, rather than labelled with its setpoint (see ranges).
+#
+# Without .index records, an event is indexed from its first packet, so the
+# newest event only counts once the files have stopped growing for holdoff seconds.
+#
+# Following the index moves the run's file positions, so anything reading
+# events from the run in another thread (while a step is taken) holds lock.
+#
+class acquisition(object):
+
+    def __init__(self, ifc, events, rate, window=64, timeout=1.0, poll=0.005, holdoff=0.02):
+        self.ifc = ifc
+        self.events = events
+        self.period = 1.0/rate
+        self.window = window
+        self.timeout = timeout
+        self.poll = poll
+        self.holdoff = holdoff
+        self.lock = threading.Lock()
+
+        # (label, first event_num, last event_num, events received, triggers sent), per step
+        self.ranges = []
+
+        # Anything already in the run isn't ours
+        seen = events.getArrivalOrderedEventNumbers()
+        self.floor = int(seen[-1]) + 1 if len(seen) else 0
+
+        # The next step's first event number, once it's known
+        self.next_event = None
+
+        # Sizes of the backing files, and when they last changed
+        self.sizes = None
+        self.grew = time.monotonic()
+
+    # Are events whole as soon as they're indexed?
+    def whole(self):
+        return all(fhandle in self.events.index_fps or fhandle in self.events.fp_limit for fhandle in self.events.fps)
+
+    # This step's events that have arrived (first is None until one has)
+    def arrived(self, first, sent):
+        with self.lock:
+            self.events.updateIndex(verbose=False)
+            seen = self.events.getArrivalOrderedEventNumbers()
+            whole = self.whole()
+            sizes = [os.fstat(fp.fileno()).st_size for fp in self.events.fps.values()]
+
+        # Is the newest event (of all) still being written?
+        writing = False
+        if len(seen) and not whole:
+            now = time.monotonic()
+            if not sizes == self.sizes:
+                self.sizes = sizes
+                self.grew = now
+            writing = now - self.grew < self.holdoff
+
+        newest = int(seen[-1]) if len(seen) else None
+        if first is None:
+            seen = seen[np.searchsorted(seen, self.floor):][:sent]
+        else:
+            seen = seen[np.searchsorted(seen, first):np.searchsorted(seen, first + sent)]
+
+        if writing and len(seen) and int(seen[-1]) == newest:
+            seen = seen[:-1]
+
+        return seen
+
+    # Send N soft triggers (after settle seconds), wait for the events,
+    # and return their event numbers
+    def take(self, N, label=None, settle=0):
+
+        # Let the setpoint settle
+        time.sleep(settle)
+
+        first = self.next_event
+        sent = 0
+        lost = 0
+        arrived = self.arrived(first, sent)
+        deadline = heard = next_poll = time.monotonic()
+
+        while len(arrived) < N:
+            now = time.monotonic()
+
+            # Whatever hasn't answered in timeout seconds isn't coming
+            if now - heard > self.timeout:
+                if sent == N:
+                    break
+                lost = sent - len(arrived)
+                heard = now
+
+            # Trigger, if it's time and there's room
+            if sent < N and now >= deadline and sent - len(arrived) - lost < self.window:
+                softtrigger(self.ifc.brd)
+                sent += 1
+                heard = now
+                deadline = max(deadline + self.period, now)
+                continue
+
+            # Follow the index
+            if now >= next_poll:
+                count = len(arrived)
+                arrived = self.arrived(first, sent)
+                if len(arrived) > count:
+                    heard = time.monotonic()
+
+                # The first event ever seen pins down the numbering
+                if first is None and len(arrived):
+                    first = int(arrived[0])
+                next_poll = now + self.poll
+                continue
+
+            # Sleep until a trigger or a poll is due
+            wake = next_poll
+            if sent < N and sent - len(arrived) - lost < self.window:
+                wake = min(wake, deadline)
+            time.sleep(max(wake - now, 0))
+
+        # Anything later belongs to the next step
+        if first is not None:
+            self.next_event = first + sent
+            self.floor = self.next_event
+
+        if len(arrived):
+            self.ranges.append((label, int(arrived[0]), int(arrived[-1]), len(arrived), sent))
+            print("Received %d of %d events (#%d to #%d)" % (len(arrived), sent, arrived[0], arrived[-1]), file=sys.stderr)
+        else:
+            print("Received none of %d events" % sent, file=sys.stderr)
+
+        return arrived
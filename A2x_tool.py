@@ -13,16 +13,18 @@ import lappdIfc
 
 
 # Make a new tool
-parser = A2x_common.create('Generic configuration tool for Ultralytics A2x series LAPPD boards.')
+parser = A2x_common.create('Generic configuration tool for Ultralytics A2x series LAPPD boards.', several=True)
 
 # Custom args
 parser.add_argument('-R', '--register', dest='registers', metavar='REGISTER', type=str, nargs=1, action='append', help='Peek and document the given register')
 parser.add_argument('-W', '--words', metavar='NUM_WORDS', type=int, help='Number of samples to report after DRS4 stop. (must be power of 2 for packette)')
 
 parser.add_argument('-T', '--threshold', help='Intake channel thresholds for zero suppression from stdin, with ASCII, line by line')
+parser.add_argument('-B', '--batch', metavar='BATCH', type=int, default=1, help='Send soft triggers this many to a control packet (experimental: only helps if the firmware queues soft triggers)')
 
-# Connect to the board
+# Connect to the boards (all of them at once)
 ifc, args = A2x_common.connect(parser)
+addresses = list(A2x_common.boards.keys())
     
 # Are we using an external trigger?  If so, kill the delay
 if args.external:
@@ -54,7 +56,7 @@ human_readable = {
 }
 
 if args.words:
-    ifc.brd.pokenow(lappdIfc.ADCBUFNUMWORDS, int(args.words))
+    A2x_common.everyboard(addresses, lambda address: A2x_common.boards[address][0].brd.pokenow(lappdIfc.ADCBUFNUMWORDS, int(args.words)))
 
 # Set a uniform trigger threshold
 if args.threshold:
@@ -69,17 +71,24 @@ if args.threshold:
 
      chans = A2x_common.parse_speclist(chanspec)
 
-     # Do a non-destructive set, so gotta read-em first
-     thresholds = A2x_common.blockread(ifc.brd, lappdIfc.ZEROTHRESH_0, 64)
+     def setthresholds(address):
+         pipeline = A2x_common.boards[address][1]
 
-     # Now adjust
-     for chan in chans:
-         thresholds[chan] = value
+         # Do a non-destructive set, so gotta read-em first
+         thresholds = A2x_common.blockread(pipeline, lappdIfc.ZEROTHRESH_0, 64)
 
-     # Now write the new values
-     A2x_common.blockwrite(ifc.brd, lappdIfc.ZEROTHRESH_0, thresholds)
+         # Now adjust
+         for chan in chans:
+             thresholds[chan] = value
+
+         # Now write the new values
+         A2x_common.blockwrite(pipeline, lappdIfc.ZEROTHRESH_0, thresholds)
+
+     results, errors = A2x_common.everyboard(addresses, setthresholds, 'thresholds updated')
 
      # Feedback
+     if errors:
+         exit(1)
      print("A2x_tool.py: thresholds updated")
 
 #    except ValueError as e:
@@ -103,13 +112,10 @@ import time
 if args.external:
     exit(0)
         
-# Otherwise, send soft triggers
-for i in range(0, args.N):
-    # Suppress board readback and response!
-    ifc.brd.pokenow(0x320, (1 << 6), readback=False, silent=True)
-    
-    # Notify that a trigger was sent
-    # print("Trigger %d sent..." % i, file=sys.stderr)
-    
-    # Sleep for the specified delay
-    time.sleep(1.0/args.rate)
+# Otherwise, send soft triggers (to every board at once)
+if args.N:
+    results, errors = A2x_common.everyboard(addresses,
+                                            lambda address: A2x_common.triggerScheduler(A2x_common.boards[address][0], args.rate, args.batch).run(args.N),
+                                            'triggered')
+    if errors:
+        exit(1)
@@ -2,28 +2,92 @@
 
 import pickle
 import sys
+import io
+import argparse
+import contextlib
 import numpy as np
 
 #
-# Loads and then describes a pedestal
+# Loads and then describes pedestals
 #
+# Each channel is a block of rows (capacitor #, mean, RMS, channel, counts),
+# with blocks separated by a blank line for gnuplot.  Values are truncated to
+# integers, and anything that isn't a number comes out as 0.
+#
+# In binary mode, the same rows are written as little endian int32 records
+# (e.g. gnuplot's binary format="%5int32", or numpy.fromfile(..., dtype=row))
+#
+row = np.dtype([('capacitor', '<i4'),
+                ('mean', '<i4'),
+                ('rms', '<i4'),
+                ('channel', '<i4'),
+                ('counts', '<i4')])
+
+# Integers, with NaN (or nothing at all) as 0
+def column(values, length):
+    if values is None:
+        return np.zeros(length, dtype=np.int64)
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0, posinf=0.0, neginf=0.0)
+    return values.astype(np.int64)
+
+#
+# The whole table for a pedestal, as (channels x capacitors) rows
+#
+def describe(aPedestal, chans=None):
+
+    chans = [chan for chan in aPedestal.mean if chans is None or chan in chans]
+    length = max([len(aPedestal.mean[chan]) for chan in chans], default=0)
+
+    table = np.zeros([len(chans), length], dtype=row)
+    for k, chan in enumerate(chans):
+        table['capacitor'][k] = np.arange(length)
+        table['mean'][k] = column(aPedestal.mean[chan], length)
+        table['rms'][k] = column(aPedestal.rms[chan] if aPedestal.rms is not None else None, length)
+        table['channel'][k] = chan
+        table['counts'][k] = column(aPedestal.counts[chan] if aPedestal.counts is not None else None, length)
+
+    return chans, table
+
+# Text, one block per channel
+# (a whole block is formatted by one %, rather than line by line)
+def ascii(chans, table):
+    out = io.StringIO()
+    line = ' '.join(['%d']*len(row.names)) + '\n'
+    for k, chan in enumerate(chans):
+        out.write("# Channel: %d\n" % chan)
+        out.write((line*table.shape[1]) % tuple(table[k].view('<i4').tolist()))
+
+        # Break on channel
+        out.write("\n")
+    return out.getvalue()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Describe pedestals as text (for gnuplot) or binary records')
+    parser.add_argument('pedestals', metavar='PEDESTAL', nargs='+', help='pedestal files (from pedestal_calibration.py)')
+    parser.add_argument('-c', '--channels', metavar='CHANNELS', help='only these channels (e.g. 0-31,40)')
+    parser.add_argument('-b', '--binary', action='store_true', help='write int32 records instead of text')
+    args = parser.parse_args()
 
-aPedestal = pickle.load(open(sys.argv[1], "rb"))
+    chans = None
+    if args.channels is not None:
+        from A2x_common import parse_speclist
 
-for chan in aPedestal.mean:
+        # (keep its chatter out of the output)
+        with contextlib.redirect_stdout(sys.stderr):
+            chans = parse_speclist(args.channels)
 
-    print("# Channel: %d" % chan)
+    for fname in args.pedestals:
+        aPedestal = pickle.load(open(fname, "rb"))
+        which, table = describe(aPedestal, chans)
 
-    n = 0
+        if args.binary:
+            sys.stdout.buffer.write(table.tobytes())
+            continue
 
-    #fmt = lambda x: x if not x is None else float('nan')
-    
-    for mean, var, count in zip(aPedestal.mean[chan], aPedestal.rms[chan], aPedestal.counts[chan]):
-        mean12 = (np.int64(mean) & 0xFFFF) >> 4
-        var12 = (np.int64(var) & 0xFFFF) >> 4 if not np.isnan(var) else 0
-        
-        print("%d %d %d %d %d" % (n, np.int64(mean), np.int64(var), chan, count))
-        n += 1
+        # Say which is which, when there are several
+        if len(args.pedestals) > 1:
+            sys.stdout.write("# Pedestal: %s\n" % fname)
+        sys.stdout.write(ascii(which, table))
 
-    # Break on channel
-    print("")
+    sys.stdout.flush()
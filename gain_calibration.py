@@ -2,6 +2,7 @@
 import numpy as np
 import sys
 import time
+import concurrent.futures
 
 import packette_stream as packette
 
@@ -9,13 +10,16 @@ import A2x_common
 
 # Set up a new tool, with arguments common to the event digestion
 # subsystem.  All tools will share the same baseline syntax and semantics.
-parser = A2x_common.create("Measure per capacitor gain slopes between two given voltages")
+parser = A2x_common.create("Measure per capacitor gain slopes over a sweep of given voltages")
 
 # Add some specific options for this tool
 # These default values calibrate pretty well
 parser.add_argument('low', metavar='LOW', type=float, default=0.7, help='Use this as the low voltage sample')
 parser.add_argument('high', metavar='HIGH', type=float, default=1, help='Use this value as the high voltage sample')
 parser.add_argument('datafile', metavar='DATA',type=str, help='Read board output events in real-time from this run')
+parser.add_argument('--sweep', metavar='STEPS', type=int, default=2, help='Step TCAL over this many evenly spaced voltages from LOW to HIGH (default: 2, just LOW and HIGH)')
+parser.add_argument('--settle', metavar='SECONDS', type=float, default=0.05, help='Time for TCAL to settle after each change (default: 0.05)')
+parser.add_argument('--order', metavar='ORDER', type=int, default=1, choices=[1, 2, 3], help='Order of the per capacitor response fit (default: 1, linear)')
 
 # Handle common configuration due to the common arguments
 ifc, args = A2x_common.connect(parser)
@@ -23,108 +27,168 @@ ifc, args = A2x_common.connect(parser)
 if not args.N:
     print("ERROR: You must specify the -N flag")
     exit(1)
+
+if args.sweep < args.order + 1:
+    print("ERROR: An order %d fit needs at least %d voltages" % (args.order, args.order + 1))
+    exit(1)
     
 # Open up the events (set the view to capacitor ordering)
 events = packette.packetteRun(args.datafile, SCAView=True)
 
-# Tell the user what we are dusering
-print("# CMOFS: %f\n# TCAL_low: %f\n# TCAL_high: %f\n# ROFS: %f" % (args.cmofs, args.low, args.high, args.rofs))
-
-event_count = {}
+# The setpoints, and the middle of the sweep (fits are about this voltage)
+voltages = np.linspace(args.low, args.high, args.sweep)
+center = (args.low + args.high)/2
 
-for voltage in (args.low, args.high):
-    # Set the low value
+# Tell the user what we are dusering
+print("# CMOFS: %f\n# TCAL_low: %f\n# TCAL_high: %f\n# TCAL_steps: %d\n# ROFS: %f" % (args.cmofs, args.low, args.high, args.sweep, args.rofs))
+
+# Events are reduced this many at a time
+BLOCK = 256
+
+# Floor on sample variances (the ADC's 12 bits sit above 4 flag bits, so a count is 16)
+QUANTIZATION = 16**2/12
+
+#
+# Accumulate per capacitor sums, sums of squares and counts of unflagged samples
+# over the given events, as (channels x 1024) arrays
+#
+def accumulate(event_nums, chans):
+    sums = np.zeros([len(chans), 1024], dtype=np.int64)
+    sumsquares = np.zeros([len(chans), 1024], dtype=np.int64)
+    counts = np.zeros([len(chans), 1024], dtype=np.int64)
+
+    for k in range(0, len(event_nums), BLOCK):
+
+        # (events x channels x 1024), absent channels are NOT_DATA
+        block = np.full([len(event_nums[k:k + BLOCK]), len(chans), 1024], packette.NOT_DATA, dtype=np.int16)
+        for row, event_num in enumerate(event_nums[k:k + BLOCK]):
+
+            # (the next setpoint is being taken meanwhile, see below)
+            with acq.lock:
+                evt = events[int(event_num)]
+            for n, chan in enumerate(chans):
+                if chan in evt.channels:
+                    block[row, n] = evt.channels[chan].cachedView
+
+        # Anything flagged (not data, masked, ...) doesn't count
+        valid = (block & 0xF) == 0
+        samples = np.where(valid, block, 0).astype(np.int64)
+
+        sums += samples.sum(axis=0)
+        sumsquares += (samples*samples).sum(axis=0)
+        counts += valid.sum(axis=0)
+
+    return sums, sumsquares, counts
+
+#
+# Weighted least squares, accumulated one setpoint at a time.
+# Each capacitor's mean response at a setpoint, weighted by the inverse variance of that mean,
+# goes into its normal equations in x = voltage - center:
+#
+#   normal[i][j] = sum w x^(i+j)    moments[i] = sum w x^i mean
+#
+class gainFit(object):
+
+    def __init__(self, shape, order):
+        self.order = order
+        self.normal = np.zeros(shape + (order + 1, order + 1))
+        self.moments = np.zeros(shape + (order + 1,))
+        self.points = np.zeros(shape, dtype=np.int64)
+
+    def add(self, voltage, sums, sumsquares, counts):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sums / counts
+            var = np.maximum((sumsquares - sums*mean) / (counts - 1), QUANTIZATION)
+
+        # Capacitors without at least two samples here sit this one out
+        used = counts > 1
+        weight = np.where(used, counts / var, 0)
+        mean = np.where(used, mean, 0)
+
+        powers = (voltage - center) ** np.arange(2*self.order + 1)
+        self.normal += weight[..., None, None] * powers[np.add.outer(np.arange(self.order + 1), np.arange(self.order + 1))]
+        self.moments += (weight*mean)[..., None] * powers[:self.order + 1]
+        self.points += used
+
+    # Coefficients (in x) and their covariances, NaN where there weren't enough setpoints
+    def solve(self):
+        bad = self.points < self.order + 1
+        normal = self.normal.copy()
+        normal[bad] = np.eye(self.order + 1)
+
+        covariance = np.linalg.inv(normal)
+        coefficients = np.einsum('...ij,...j->...i', covariance, self.moments)
+
+        coefficients[bad] = np.nan
+        covariance[bad] = np.nan
+        return coefficients, covariance
+
+# Fold a setpoint into the fit
+def fold(voltage, event_nums):
+    fit.add(voltage, *accumulate(event_nums, chans))
+
+chans = None
+fit = None
+
+# Triggers are paced by what arrives (up to the requested rate), and each setpoint's
+# events are the ones that arrived after its DAC change
+acq = A2x_common.acquisition(ifc, events, args.rate)
+
+# Setpoints are folded in one at a time, in the background
+folder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+folding = []
+
+for voltage in voltages:
+    # Set the voltage
     ifc.DacSetVout(ifc.DACOUTS['TCAL_N1'], voltage)
     ifc.DacSetVout(ifc.DACOUTS['TCAL_N2'], voltage)
 
     # Give some output
     print("Receiving data for TCAL_N = %f" % voltage, file=sys.stderr)
 
-    k = args.N
-    # Request N samples at both low and high
-    while k > 0:
-        # Wait for it to settle
-        time.sleep(args.i)
-
-        # Software trigger
-        ifc.brd.pokenow(0x320, 1 << 6, readback=False, silent=True)
-
-        k -= 1
-        
-    # Refresh the file index
-    events.updateIndex()
+    # Request N samples at each voltage
+    # (we might not receive all N samples)
+    event_nums = acq.take(args.N, voltage, settle=args.settle)
 
-    # Remember how many events we got, since these events correspond
-    # to these values in the curve (we might not have received all N samples)
-    event_count[voltage] = len(events)
-
-    if not event_count[voltage]:
+    if not len(event_nums):
         raise Exception("Received no events??")
-    
-# The slope denominator
-run = args.high - args.low
-
-# Iterate over channels, because we want response curves per channel
-firstevent = iter(events).__next__()
 
-chans = firstevent.channels.keys()
+    # We want response curves per channel (the channels of the first event)
+    if chans is None:
+        chans = sorted(events[int(event_nums[0])].channels.keys())
+        fit = gainFit((len(chans), 1024), args.order)
 
-caps_low = {}
-caps_high = {}
-slopes = {}
+    # Fold this setpoint in while the next one is being taken
+    folding.append(folder.submit(fold, voltage, event_nums))
 
-from scipy.stats import describe
-import math
+# Wait for the last of them (and raise anything that went wrong)
+for future in folding:
+    future.result()
+folder.shutdown()
 
-for chan in chans:
-    
-    # Now prepare to store the average gains
-    caps_low[chan] = [[] for x in range(1024)]
-    caps_high[chan] = [[] for x in range(1024)]
-    slopes[chan] = [[] for x in range(1024)]
-    
-    # Filter out any masked capacitors
-    for n,evt in enumerate(events):
-
-        # In case the order is wonky for some reason?
-        if n < event_count[args.low]:
-            caps = caps_low[chan]
-        else:
-            caps = caps_high[chan]
-
-        # Save this data point
-        for cap in range(1024):
-            if evt.channels[chan][cap] is packette.NOT_DATA:
-                continue
-            
-            # Record it
-            caps[cap].append(evt.channels[chan][cap])
-
-    # In case events got lost, we need to truncate to the shortest list
-    samples = min(len(caps_high[chan][cap]), len(caps_low[chan][cap]))
-    caps_high[chan][cap][:samples]
-    caps_low[chan][cap][:samples]
-    
-    # Now caps are nicely sorted, take averages and std deviations
-    for cap in range(1024):
+# Event number ranges taken at each setpoint
+ranges = [(voltage, first, last) for voltage, first, last, received, sent in acq.ranges]
 
-        # Replace the lists with tuples containing the statistical dirt
-        caps_high[chan][cap] = describe(caps_high[chan][cap])
-        caps_low[chan][cap] = describe(caps_low[chan][cap])
+coefficients, covariance = fit.solve()
 
-        # Now make the slopes and propogated RMSs
-        varhigh = caps_high[chan][cap].variance
-        varlow = caps_low[chan][cap].variance
+# The gain is the slope at the middle of the sweep, and we want recriprocal slopes
+with np.errstate(divide='ignore', invalid='ignore'):
+    recip_k = 1/coefficients[..., 1]
+    recip_err = recip_k**2 * np.sqrt(covariance[..., 1, 1])
 
-        ampl_variance = math.sqrt(caps_high[chan][cap].variance + caps_low[chan][cap].variance)/(run*math.sqrt(samples))
-        recip_k = run/(caps_high[chan][cap].mean - caps_low[chan][cap].mean)
-        
-        # We want recriprocal slopes
-        slopes[chan][cap] = ( recip_k, recip_k**2 * ampl_variance)
+slopes = {chan : list(zip(recip_k[n].tolist(), recip_err[n].tolist())) for n, chan in enumerate(chans)}
 
 # Output a correction file
 import pickle
-pickle.dump(slopes, open("%s.gains" % events.board_id.hex(), "wb"))
+pickle.dump(slopes, open("%s.gains" % events.property_stash.board_id.hex(), "wb"))
+
+# Higher order responses don't fit in a slope, so keep the whole curve too
+if args.order > 1:
+    curve = {'center' : center,
+             'ranges' : ranges,
+             'coefficients' : {chan : coefficients[n] for n, chan in enumerate(chans)},
+             'covariance' : {chan : covariance[n] for n, chan in enumerate(chans)}}
+    pickle.dump(curve, open("%s.gaincurve" % events.property_stash.board_id.hex(), "wb"))
     
 # Now output the results
 for channel, results in slopes.items():
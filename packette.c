@@ -10,6 +10,14 @@
 #include <string.h>
 #include <sys/socket.h>
 #include <arpa/inet.h>
+#include <stddef.h>
+
+// Classic BPF for SO_REUSEPORT steering
+#include <linux/filter.h>
+
+#ifndef SO_ATTACH_REUSEPORT_CBPF
+#define SO_ATTACH_REUSEPORT_CBPF 51
+#endif
 
 // Multiprocess
 #include <sys/types.h>
@@ -28,6 +36,27 @@
 // Shared memory (for interprocess comms without IPC)
 #include <sys/mman.h>
 
+// Preallocation of output files
+#include <fcntl.h>
+#include <linux/falloc.h>
+
+// NUMA topology and memory policy (without requiring libnuma)
+#include <ifaddrs.h>
+#include <net/if.h>
+#include <sys/syscall.h>
+
+#ifndef MPOL_PREFERRED
+#define MPOL_PREFERRED 1
+#endif
+
+#ifndef SO_BUSY_POLL
+#define SO_BUSY_POLL 46
+#endif
+
+#ifndef SO_PREFER_BUSY_POLL
+#define SO_PREFER_BUSY_POLL 69
+#endif
+
 // For total fluff
 #include <ncurses.h>
 
@@ -50,6 +79,16 @@ unsigned long (*process_packets_fptr)(void *buf,
 
 unsigned long *emptyBlock;
 
+// Event index emission (each child is its own process, so these are per-child)
+FILE *index_file = 0x0;                 // Companion event index, 0x0 if not indexing
+uint64_t ordered_offset = 0;            // Bytes written to the ordered stream so far
+struct packette_index current_index;    // The event currently being written
+unsigned char index_open = 0;
+
+// Output preallocation (also per-child)
+uint64_t prealloc_extent = 0;           // Bytes to reserve at a time, 0 if not preallocating
+uint64_t prealloc_end = 0;              // Reserved through here
+
 // This is used to signal that we should cleanup
 volatile sig_atomic_t interrupt_flag = 0;
 
@@ -72,6 +111,86 @@ char *packette_logo =
 char *static_header =
   " PID   | Instantaneous rate             | Cumulative data\n-----------------------------------------------------------------";
 
+//
+// Reserve disk ahead of the write position in large extents, so the filesystem
+// isn't allocating blocks underneath us on every buffer flush.
+// FALLOC_FL_KEEP_SIZE means the file size still tracks what has actually been
+// written, so readers tailing the file never see reserved (zero) space.
+//
+void preallocate(FILE *fp, uint64_t upto) {
+
+  while(prealloc_end < upto) {
+    if(fallocate(fileno(fp), FALLOC_FL_KEEP_SIZE, prealloc_end, prealloc_extent) == -1) {
+      perror("fallocate()");
+      fprintf(stderr, "WARNING (PID %d): Unable to preallocate, continuing without.\n", getpid());
+      prealloc_extent = 0;
+      return;
+    }
+    prealloc_end += prealloc_extent;
+  }
+}
+
+//
+// Every processor that produces an ordered stream writes through here,
+// so that we can note event boundaries as they go by.
+// An event's index entry is written once the next event begins
+// (or on shutdown), when its extent is known.
+//
+void write_ordered(struct packette_transport *ptr,
+		   unsigned int stride,
+		   FILE *ordered_file) {
+
+  fwrite(ptr,
+	 stride,
+	 1,
+	 ordered_file);
+
+  if(index_file) {
+
+    // Crossed an event boundary?
+    if(!index_open
+       || ptr->header.event_num != current_index.event_num
+       || memcmp(ptr->assembly.board_id, current_index.board_id, 6)) {
+
+      // Close out the previous event
+      if(index_open)
+	fwrite(&current_index, sizeof(struct packette_index), 1, index_file);
+
+      memcpy(current_index.board_id, ptr->assembly.board_id, 6);
+      current_index.reserved = 0;
+      current_index.event_num = ptr->header.event_num;
+      current_index.trigger_low = ptr->header.trigger_low;
+      current_index.offset = ordered_offset;
+      current_index.length = 0;
+      current_index.num_packets = 0;
+      current_index.first_seqnum = ptr->assembly.seqnum;
+      current_index.channel_mask = ptr->header.channel_mask;
+      index_open = 1;
+    }
+
+    current_index.length += stride;
+    current_index.num_packets++;
+    current_index.last_seqnum = ptr->assembly.seqnum;
+  }
+
+  ordered_offset += stride;
+
+  // Stay at least half an extent ahead
+  if(prealloc_extent && ordered_offset + prealloc_extent/2 > prealloc_end)
+    preallocate(ordered_file, ordered_offset + prealloc_extent/2);
+}
+
+//
+// Write out the index entry for the event in progress
+//
+void close_index() {
+
+  if(index_file && index_open)
+    fwrite(&current_index, sizeof(struct packette_index), 1, index_file);
+
+  index_open = 0;
+}
+
 //
 // PACKET PROCESSORS
 //
@@ -265,10 +384,9 @@ unsigned long order_processor(void *buf,
       
       // Immediately write the packet with
       // only its payload to the output stream
-      fwrite(buf,
-	     stride,
-	     1,
-	     ordered_file);
+      write_ordered(ptr,
+		    stride,
+		    ordered_file);
 
       // Accounting
       bytes += stride;
@@ -303,6 +421,194 @@ unsigned long order_processor(void *buf,
   return bytes;
 }
 
+//
+// This processor holds a small window of recent packets, keyed by sequence number,
+// and releases them to the ordered file in sequence order.  Mild disorder
+// (e.g. multi-queue NICs handing us packets a few positions apart) is fixed
+// up here, instead of spilling to the orphans and needing a merge pass.
+// Only packets that arrive after the window has moved past them are orphaned.
+//
+// In-order arrivals are written straight out of the receive buffer.
+// Only out-of-order packets are copied into the window.
+//
+// A child whose port doesn't carry every packet (e.g. with -s) sees gaps
+// that never close, so held packets are also let go once the socket has
+// been idle for REORDER_IDLE_MS, rather than waiting for the next burst.
+//
+// Must be a power of 2
+#define REORDER_WINDOW 64
+#define REORDER_IDLE_MS 20
+
+// Each child is its own process, so these are per-child
+char *reorder_slots;                                  // REORDER_WINDOW fixed width buffers
+unsigned char reorder_occupied[REORDER_WINDOW];
+uint64_t reorder_base;                                // Lowest sequence number not yet released
+unsigned char reorder_primed = 0;
+
+//
+// Release whatever is held at the bottom of the window (if anything)
+// and slide the window up by one.
+//
+unsigned long reorder_advance(FILE *ordered_file,
+			      uint64_t *prev_seqnum,
+			      uint32_t *prev_event_num) {
+
+  struct packette_transport *ptr;
+  unsigned int slot, stride;
+
+  slot = reorder_base & (REORDER_WINDOW - 1);
+  ++reorder_base;
+
+  if(!reorder_occupied[slot])
+    return 0;
+
+  ptr = (struct packette_transport *)(reorder_slots + slot*BUFSIZE);
+  stride = sizeof(struct packette_transport) + ptr->channel.num_samples*SAMPLE_WIDTH;
+
+  write_ordered(ptr,
+		stride,
+		ordered_file);
+
+  *prev_seqnum = ptr->assembly.seqnum;
+  *prev_event_num = ptr->header.event_num;
+  reorder_occupied[slot] = 0;
+
+  return stride;
+}
+
+//
+// Release everything still held, in order, sliding the window
+// only as far as the last of them.
+// Called when the socket goes idle, and on the way out so the tail
+// of the capture isn't lost.
+//
+unsigned long reorder_flush(FILE *ordered_file,
+			    uint64_t *prev_seqnum,
+			    uint32_t *prev_event_num) {
+
+  unsigned long bytes;
+  unsigned int k, held;
+
+  held = 0;
+  for(k = 0; k < REORDER_WINDOW; ++k)
+    held += reorder_occupied[k];
+
+  bytes = 0;
+  while(held) {
+    held -= reorder_occupied[reorder_base & (REORDER_WINDOW - 1)];
+    bytes += reorder_advance(ordered_file, prev_seqnum, prev_event_num);
+  }
+
+  return bytes;
+}
+
+unsigned long reorder_processor(void *buf,
+				struct mmsghdr *msgs,
+				int vlen,
+				FILE *ordered_file,
+				FILE *orphan_file,
+				uint64_t *prev_seqnum,
+				uint32_t *prev_event_num) {
+
+  struct packette_transport *ptr;
+  unsigned long bytes;
+  unsigned int stride, slot;
+  uint64_t seqnum;
+
+  // Start counter at zero
+  bytes = 0;
+
+  // Iterate over the packets we are given
+  while(vlen--) {
+
+    // Get the first one, casting it so we can extract the fields
+    ptr = (struct packette_transport *)buf;
+    seqnum = ptr->assembly.seqnum;
+
+    // The first packet sets the window, centered on itself,
+    // in case its predecessors are still on the way
+    if(!reorder_primed) {
+      reorder_base = seqnum > REORDER_WINDOW/2 ? seqnum - REORDER_WINDOW/2 : 0;
+      reorder_primed = 1;
+    }
+
+    if(seqnum < reorder_base) {
+
+      // The window has already moved past this one.
+      // Immediately buffered write the fixed width
+      // buffer to the orphans
+      fwrite(buf,
+	     BUFSIZE,
+	     1,
+	     orphan_file);
+
+      // Accounting
+      bytes += BUFSIZE;
+    }
+    else {
+
+      // After a long gap (i.e. loss), dump the window and jump
+      // rather than sliding one sequence number at a time
+      if(seqnum - reorder_base >= 2*REORDER_WINDOW) {
+	bytes += reorder_flush(ordered_file, prev_seqnum, prev_event_num);
+	reorder_base = seqnum - REORDER_WINDOW + 1;
+      }
+
+      // Make room for this one
+      while(seqnum >= reorder_base + REORDER_WINDOW)
+	bytes += reorder_advance(ordered_file, prev_seqnum, prev_event_num);
+
+      slot = seqnum & (REORDER_WINDOW - 1);
+
+      if(reorder_occupied[slot]) {
+
+	// Within the window, an occupied slot can only hold this same sequence number.
+	// Orphan it, like anything else we can't place, and let packette_merge sort it out
+	fwrite(buf,
+	       BUFSIZE,
+	       1,
+	       orphan_file);
+
+	// Accounting
+	bytes += BUFSIZE;
+      }
+      else if(seqnum == reorder_base) {
+
+	// Fast path: this is the next one we want, no need to hold it
+	stride = sizeof(struct packette_transport) + ptr->channel.num_samples*SAMPLE_WIDTH;
+	
+	write_ordered(ptr,
+		      stride,
+		      ordered_file);
+
+	bytes += stride;
+	++reorder_base;
+	
+	*prev_seqnum = seqnum;
+	*prev_event_num = ptr->header.event_num;
+      }
+      else {
+	
+	// Hold it until the gap before it closes (or the window moves on)
+	memcpy(reorder_slots + slot*BUFSIZE,
+	       buf,
+	       sizeof(struct packette_transport) + ptr->channel.num_samples*SAMPLE_WIDTH);
+	reorder_occupied[slot] = 1;
+      }
+      
+      // Release anything that is now contiguous
+      while(reorder_occupied[reorder_base & (REORDER_WINDOW - 1)])
+	bytes += reorder_advance(ordered_file, prev_seqnum, prev_event_num);
+    }
+
+    // Advance to the next packet
+    buf += BUFSIZE;
+  }
+
+  // Return bytes written to disk
+  return bytes;
+}
+
 //
 // This processor randomly drops and shunts packets to the orphans.
 // This is for testing unordered and lossy reassembly downstream
@@ -342,10 +648,9 @@ unsigned long abandonment_processor(void *buf,
       
       // Immediately write the packet with
       // only its payload to the output stream
-      fwrite(buf,
-	     stride,
-	     1,
-	     ordered_file);
+      write_ordered(ptr,
+		    stride,
+		    ordered_file);
 
       // Accounting
       bytes += stride;
@@ -380,6 +685,151 @@ unsigned long abandonment_processor(void *buf,
   return bytes;
 }
 
+//
+// Fan-out steering
+//
+// When all children share a single port with SO_REUSEPORT, the kernel
+// would normally spread datagrams by 4-tuple hash.  Since the board sends
+// everything from one source port, that would put everything on one child.
+// Instead, we hand the reuseport group a classic BPF program that selects
+// the socket by the low 16 bits of event_num.  Every fragment of an event
+// then lands in the same child, so events are never split across files.
+//
+// The program runs with the packet data positioned at the UDP payload,
+// so offsets are into struct packette_transport.  BPF_ABS loads are
+// big-endian, and event_num is little-endian on the wire, so we assemble
+// the low 16 bits byte by byte.
+//
+int attach_fanout_filter(int sockfd, unsigned char children) {
+
+  struct sock_filter code[] = {
+    { BPF_LD  | BPF_B   | BPF_ABS, 0, 0, offsetof(struct packette_transport, header.event_num) + 1 },
+    { BPF_ALU | BPF_LSH | BPF_K,   0, 0, 8 },
+    { BPF_MISC | BPF_TAX,          0, 0, 0 },
+    { BPF_LD  | BPF_B   | BPF_ABS, 0, 0, offsetof(struct packette_transport, header.event_num) },
+    { BPF_ALU | BPF_OR  | BPF_X,   0, 0, 0 },
+    { BPF_ALU | BPF_MOD | BPF_K,   0, 0, children },
+    { BPF_RET | BPF_A,             0, 0, 0 }
+  };
+
+  struct sock_fprog prog = {
+    .len = sizeof(code) / sizeof(code[0]),
+    .filter = code
+  };
+
+  // Any member of the group can install the program for the whole group.
+  // Every child does it, so it doesn't matter who binds first.
+  return setsockopt(sockfd, SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, &prog, sizeof(prog));
+}
+
+//
+// TOPOLOGY
+//
+
+//
+// Parses a Linux-style CPU list (e.g. "0,2,8-11") into an array of CPU numbers,
+// in the order given.  This is the same format as sysfs cpulist files.
+// Returns the number of CPUs parsed, or -1 on garbage.
+//
+int parse_cpulist(const char *str, int *cpus, int max) {
+
+  int n, low, high;
+  char *end;
+
+  n = 0;
+  while(*str && *str != '\n') {
+
+    low = strtol(str, &end, 10);
+    if(end == str)
+      return -1;
+
+    high = low;
+    if(*end == '-') {
+      str = end + 1;
+      high = strtol(str, &end, 10);
+      if(end == str || high < low)
+	return -1;
+    }
+
+    while(low <= high && n < max)
+      cpus[n++] = low++;
+
+    // Skip the separator
+    str = end;
+    if(*str == ',')
+      ++str;
+  }
+
+  return n;
+}
+
+//
+// Finds the interface that owns the bind address and asks sysfs
+// which NUMA node its device hangs off of.  Returns -1 if this cannot
+// be determined (e.g. INADDR_ANY, virtual interfaces, single node machines).
+//
+int nic_numa_node(struct in_addr *addr, char *ifname) {
+
+  struct ifaddrs *ifap, *ifa;
+  char path[256];
+  FILE *fp;
+  int node;
+
+  node = -1;
+  ifname[0] = 0x0;
+  
+  if(getifaddrs(&ifap) == -1) {
+    perror("getifaddrs()");
+    return -1;
+  }
+
+  for(ifa = ifap; ifa; ifa = ifa->ifa_next) {
+    if(ifa->ifa_addr
+       && ifa->ifa_addr->sa_family == AF_INET
+       && ((struct sockaddr_in *)ifa->ifa_addr)->sin_addr.s_addr == addr->s_addr) {
+      strncpy(ifname, ifa->ifa_name, IF_NAMESIZE);
+      break;
+    }
+  }
+  freeifaddrs(ifap);
+
+  if(!ifname[0])
+    return -1;
+
+  snprintf(path, sizeof(path), "/sys/class/net/%s/device/numa_node", ifname);
+  if(!(fp = fopen(path, "r")))
+    return -1;
+
+  if(fscanf(fp, "%d", &node) != 1)
+    node = -1;
+  fclose(fp);
+
+  return node;
+}
+
+//
+// Gets the CPUs local to a NUMA node from sysfs.
+// Returns the number of CPUs, or -1 if the node is unknown.
+//
+int node_cpulist(int node, int *cpus, int max) {
+
+  char path[256];
+  char line[1024];
+  FILE *fp;
+
+  snprintf(path, sizeof(path), "/sys/devices/system/node/node%d/cpulist", node);
+  if(!(fp = fopen(path, "r")))
+    return -1;
+
+  if(!fgets(line, sizeof(line), fp)) {
+    fclose(fp);
+    return -1;
+  }
+  fclose(fp);
+
+  return parse_cpulist(line, cpus, max);
+}
+
 //
 // Called when the child receives SIGINT
 //
@@ -394,16 +844,19 @@ void flagInterrupt(int signum) {
 #define L2_CACHE 256000
 #define TIMEOUT 1
 
+// One x86 huge page
+#define WRITE_BUFFER (2 << 20)
+
 // For runtime selectable packet processing pipeline
-const unsigned char num_processor_ptrs = 3;
-const char *processor_names[] = { "ordered_processor", "disordered_processor", "debug_processor" };
+const unsigned char num_processor_ptrs = 4;
+const char *processor_names[] = { "ordered_processor", "disordered_processor", "debug_processor", "reorder_processor" };
 unsigned long (*processor_ptrs[])(void *buf,
 				  struct mmsghdr *msgs,
 				  int vlen,
 				  FILE *ordered_file,
 				  FILE *orphan_file,
 				  uint64_t *prev_seqnum,
-				  uint32_t *prev_event_num) = {&order_processor, &abandonment_processor, &debug_processor};
+				  uint32_t *prev_event_num) = {&order_processor, &abandonment_processor, &debug_processor, &reorder_processor};
 
 int main(int argc, char **argv) {
 
@@ -425,6 +878,13 @@ int main(int argc, char **argv) {
 
   // Processor pinning stuff
   cpu_set_t  mask;
+  int cpus[CPU_SETSIZE];           // CPUs to hand out to children, in order
+  int num_cpus;                    // 0 means legacy behaviour (child k gets CPU k)
+  int numa_node;                   // NUMA node of the NIC, -1 if unknown or unwanted
+  unsigned char numa_auto;
+  unsigned long nodemask;
+  char ifname[IF_NAMESIZE + 1];
+  int busy_poll;                   // SO_BUSY_POLL in microseconds, 0 is off
 
   // Argument parsing stuff
   int opt;
@@ -433,6 +893,7 @@ int main(int argc, char **argv) {
   unsigned int count;
   unsigned char packet_processor;
   unsigned char quiet;
+  unsigned char fanout;
   
   // Signal handling stuff
   struct sigaction new_action, old_action;
@@ -447,9 +908,16 @@ int main(int argc, char **argv) {
 #define BUFLEN 1024  
   char tmp1[BUFLEN], tmp2[BUFLEN];
   char prefix[BUFLEN];
+  char stem[BUFLEN];
+  unsigned char indexing;
+  unsigned long prealloc_MB;       // Preallocation extent, 0 is off
+  void *wbuf;                      // Output write buffer when preallocating
+  unsigned char wbuf_huge;
   
   unsigned int stash;
   uint32_t prev_event_num;
+  struct timeval idle;             // How long the socket waits before held packets are let go
+  unsigned long released;
   
   // Shared memory for performance reporting
   struct timeval parent_timeout;   // timeval, timespec, tm ... ugh
@@ -472,6 +940,15 @@ int main(int argc, char **argv) {
   count = 0;
   packet_processor = 0;
   quiet = 0;
+  fanout = 0;
+  num_cpus = 0;
+  indexing = 0;
+  prealloc_MB = 0;
+  wbuf = 0x0;
+  wbuf_huge = 0;
+  numa_node = -1;
+  numa_auto = 0;
+  busy_poll = 0;
   
   // Things for event counting
   prev_event_num = 0;
@@ -482,7 +959,7 @@ int main(int argc, char **argv) {
   
   /////////////////// ARGUMENT PARSING //////////////////
   
-  while ((opt = getopt(argc, argv, "t:p:f:oqn:d:")) != -1) {
+  while ((opt = getopt(argc, argv, "t:p:f:oqn:d:sc:ab:iP:")) != -1) {
     switch (opt) {
     case 't':
       children = atoi(optarg);
@@ -499,6 +976,27 @@ int main(int argc, char **argv) {
     case 'q':
       quiet = 1;
       break;
+    case 's':
+      fanout = 1;
+      break;
+    case 'c':
+      if((num_cpus = parse_cpulist(optarg, cpus, CPU_SETSIZE)) < 1) {
+	fprintf(stderr, "packette (parent): ERROR - Could not understand CPU list '%s'\n", optarg);
+	exit(EXIT_FAILURE);
+      }
+      break;
+    case 'a':
+      numa_auto = 1;
+      break;
+    case 'b':
+      busy_poll = atoi(optarg);
+      break;
+    case 'i':
+      indexing = 1;
+      break;
+    case 'P':
+      prealloc_MB = atol(optarg);
+      break;
     case 'd':
       packet_processor = atoi(optarg);
       if(packet_processor >= num_processor_ptrs) {
@@ -511,7 +1009,7 @@ int main(int argc, char **argv) {
       count = atoi(optarg) + 1;
       break;
     default: /* '?' */
-      fprintf(stderr, "Usage: %s [-t threads] [-p base UDP port] [-f output file prefix] [-o dump to standard out] [-n event count] [-d debug select] [-q quiet] BIND_ADDRESS\n",
+      fprintf(stderr, "Usage: %s [-t threads] [-p base UDP port] [-f output file prefix] [-o dump to standard out] [-n event count] [-d debug select] [-q quiet] [-s share one port across threads] [-c CPU list] [-a pin near NIC NUMA node] [-b busy poll usecs] [-i write event index] [-P preallocate output in extents of MB] BIND_ADDRESS\n",
 	      argv[0]);
       exit(EXIT_FAILURE);
     }
@@ -542,12 +1040,77 @@ int main(int argc, char **argv) {
   }
     
   // Report what we've been asked to do
-  fprintf(stderr,
-	  "packette (parent): %d children will bind at %s, starting from port %d\n",
-	  children,
-	  argv[optind],
-	  port);
+  if(fanout)
+    fprintf(stderr,
+	    "packette (parent): %d children will share %s:%d, events steered by event number\n",
+	    children,
+	    argv[optind],
+	    port);
+  else
+    fprintf(stderr,
+	    "packette (parent): %d children will bind at %s, starting from port %d\n",
+	    children,
+	    argv[optind],
+	    port);
+
+  // Work out where the children should live
+  if(numa_auto) {
+    
+    numa_node = nic_numa_node(&(sa.sin_addr), ifname);
+    if(numa_node < 0)
+      fprintf(stderr,
+	      "packette (parent): WARNING - Could not determine NUMA node for the interface bound to %s.  Not pinning by topology.\n",
+	      argv[optind]);
+    else {
+      fprintf(stderr,
+	      "packette (parent): Interface %s is attached to NUMA node %d\n",
+	      ifname,
+	      numa_node);
 
+      // An explicit CPU list wins, otherwise take the node's CPUs
+      if(!num_cpus && (num_cpus = node_cpulist(numa_node, cpus, CPU_SETSIZE)) < 1) {
+	fprintf(stderr,
+		"packette (parent): WARNING - Could not read CPUs for NUMA node %d.\n",
+		numa_node);
+	num_cpus = 0;
+      }
+    }
+  }
+
+  // Report the topology we settled on
+  if(num_cpus) {
+    output_msg_offset = 0;
+    for(i = 0; i < num_cpus && i < children; ++i)
+      output_msg_offset += snprintf(output + output_msg_offset,
+				    BIGBUFLEN - output_msg_offset,
+				    "%s%d", i ? "," : "", cpus[i]);
+    output_msg_offset = 0;
+    
+    fprintf(stderr,
+	    "packette (parent): Children will be pinned to CPUs %s%s\n",
+	    output,
+	    num_cpus < children ? " (wrapping, more children than CPUs)" : "");
+  }
+  else
+    fprintf(stderr,
+	    "packette (parent): Children will be pinned to CPUs 0-%d\n", children - 1);
+  
+  if(numa_node >= 0)
+    fprintf(stderr,
+	    "packette (parent): Receive buffers will prefer NUMA node %d\n", numa_node);
+
+  if(busy_poll)
+    fprintf(stderr,
+	    "packette (parent): Sockets will busy poll for %d us\n", busy_poll);
+
+  if(indexing)
+    fprintf(stderr,
+	    "packette (parent): Children will write an event index alongside each ordered stream\n");
+
+  if(prealloc_MB)
+    fprintf(stderr,
+	    "packette (parent): Children will preallocate ordered streams %lu MB at a time\n", prealloc_MB);
+  
   // Report how many packets
   if(!count) 
     fprintf(stderr,
@@ -632,19 +1195,37 @@ int main(int argc, char **argv) {
     // What is our purpose?
     pid = getpid();
 
+    // In fan-out mode, everyone listens on the base port
+    if(!fanout)
+      port += k - 1;
+
     // Pin ourselves to a separate processor
+    // RECYCLE: i (from socket stuff)
+    i = num_cpus ? cpus[(k-1) % num_cpus] : k-1;
+    
     CPU_ZERO(&mask);
-    CPU_SET(k-1, &mask);
+    CPU_SET(i, &mask);
     if(sched_setaffinity(0, sizeof(mask), &mask)) {
       perror("sched_setaffinity()");
       fprintf(stderr, "WARNING (PID %d): Unable to pin to CPU %d. (Too many threads?)\n",
 	      pid,
-	      k-1);
+	      i);
     }
     else
       fprintf(stderr, "packette (PID %d): Pinned self to CPU %d.\n",
 	      pid,
-	      k-1);
+	      i);
+
+    // Prefer memory on the NIC's node for everything we allocate from here on
+    if(numa_node >= 0 && numa_node < 8*sizeof(nodemask)) {
+      nodemask = 1UL << numa_node;
+      if(syscall(SYS_set_mempolicy, MPOL_PREFERRED, &nodemask, 8*sizeof(nodemask)) == -1) {
+	perror("set_mempolicy()");
+	fprintf(stderr, "WARNING (PID %d): Unable to prefer NUMA node %d for buffers.\n",
+		pid,
+		numa_node);
+      }
+    }
 
     // Install signal handler so we cleanly flush packets
     // From GNU docs:
@@ -680,26 +1261,84 @@ int main(int argc, char **argv) {
     
     // Set the first expected sequence number to 0
     prev_seqnum = 0;
+
+    // Make the reorder window, if we're using it
+    if(process_packets_fptr == &reorder_processor) {
+      if(!(reorder_slots = (char *)malloc(BUFSIZE * REORDER_WINDOW))) {
+	perror("malloc()");
+	exit(EXIT_FAILURE);
+      }
+      memset(reorder_occupied, 0, REORDER_WINDOW);
+      
+      fprintf(stderr, "packette (PID %d): Holding up to %d packets for reordering.\n",
+	      pid,
+	      REORDER_WINDOW);
+    }
     
     ////////////////// STREAMS //////////////////
     
+    // All of this child's files share a stem
+    if(fanout)
+      snprintf(stem, BUFLEN, "rawdata/%s_%s_%d_%d", tmp1, addr_str, port, k - 1);
+    else
+      snprintf(stem, BUFLEN, "rawdata/%s_%s_%d", tmp1, addr_str, port);
+    
     // Open streams for output
     if(!ordered_file) {
 
-      snprintf(tmp2, BUFLEN, "rawdata/%s_%s_%d.ordered", tmp1, addr_str, port + k - 1);
+      snprintf(tmp2, BUFLEN, "%s.ordered", stem);
       if( ! (ordered_file = fopen(tmp2, "wb"))) {
 	perror("fopen()");
 	exit(EXIT_FAILURE);
       }
+
+      // Reserve the first extents and write through a big buffer
+      if(prealloc_MB) {
+
+	prealloc_extent = prealloc_MB << 20;
+	preallocate(ordered_file, prealloc_extent);
+
+	// Try for a huge page first, so the buffer is one TLB entry
+	wbuf = mmap(NULL, WRITE_BUFFER, PROT_READ | PROT_WRITE,
+		    MAP_PRIVATE | MAP_ANONYMOUS | MAP_HUGETLB, -1, 0);
+	if(wbuf == MAP_FAILED) {
+	  if(posix_memalign(&wbuf, 4096, WRITE_BUFFER)) {
+	    perror("posix_memalign()");
+	    exit(EXIT_FAILURE);
+	  }
+	}
+	else
+	  wbuf_huge = 1;
+
+	if(setvbuf(ordered_file, wbuf, _IOFBF, WRITE_BUFFER))
+	  fprintf(stderr, "WARNING (PID %d): Unable to set output buffer.\n", pid);
+	
+	fprintf(stderr, "packette (PID %d): Preallocating %s in %lu MB extents, writing through a %d kB %s buffer.\n",
+		pid,
+		tmp2,
+		prealloc_MB,
+		WRITE_BUFFER >> 10,
+		wbuf_huge ? "huge page" : "page aligned");
+      }
     }
     
-    snprintf(tmp2, BUFLEN, "rawdata/%s_%s_%d.orphans", tmp1, addr_str, port + k - 1);
+    snprintf(tmp2, BUFLEN, "%s.orphans", stem);
     
     // Open streams for output
     if( ! (orphan_file = fopen(tmp2, "wb"))) {
       perror("fopen()");
       exit(EXIT_FAILURE);
     }
+
+    // Open the event index
+    if(indexing) {
+
+      snprintf(tmp2, BUFLEN, "%s.index", stem);
+      if( ! (index_file = fopen(tmp2, "wb"))) {
+	perror("fopen()");
+	exit(EXIT_FAILURE);
+      }
+    }
     
     ///////////////////// SOCKET ////////////////////
     
@@ -713,8 +1352,40 @@ int main(int argc, char **argv) {
       exit(EXIT_FAILURE);
     }
 
+    // Children share the port and let the kernel steer by event number
+    if(fanout) {
+      opt = 1;
+      if(setsockopt(sockfd, SOL_SOCKET, SO_REUSEPORT, &opt, sizeof(opt)) == -1) {
+	perror("setsockopt(SO_REUSEPORT)");
+	exit(EXIT_FAILURE);
+      }
+    }
+    
+    // Drain the socket from userspace instead of waiting on interrupts
+    if(busy_poll) {
+      if(setsockopt(sockfd, SOL_SOCKET, SO_BUSY_POLL, &busy_poll, sizeof(busy_poll)) == -1) {
+	perror("setsockopt(SO_BUSY_POLL)");
+	fprintf(stderr, "WARNING (PID %d): Unable to busy poll (requires CAP_NET_ADMIN above net.core.busy_read).\n",
+		pid);
+      }
+      
+      opt = 1;
+      if(setsockopt(sockfd, SOL_SOCKET, SO_PREFER_BUSY_POLL, &opt, sizeof(opt)) == -1)
+	perror("setsockopt(SO_PREFER_BUSY_POLL)");
+    }
+    
+    // Wake up when the socket goes quiet, to let go of packets held for reordering
+    if(process_packets_fptr == &reorder_processor) {
+      idle.tv_sec = 0;
+      idle.tv_usec = REORDER_IDLE_MS*1000;
+      if(setsockopt(sockfd, SOL_SOCKET, SO_RCVTIMEO, &idle, sizeof(idle)) == -1) {
+	perror("setsockopt(SO_RCVTIMEO)");
+	fprintf(stderr, "WARNING (PID %d): Held packets will wait for the next burst.\n", pid);
+      }
+    }
+
     // Set the port with proper endianness
-    sa.sin_port = htons(port + k - 1);
+    sa.sin_port = htons(port);
     sa.sin_family = AF_INET;
 
     // Why does this always have an explicit cast in the examples?
@@ -724,12 +1395,25 @@ int main(int argc, char **argv) {
       exit(EXIT_FAILURE);
     }
 
+    // The steering program must go on after bind(), once we're in the group
+    if(fanout) {
+      if(attach_fanout_filter(sockfd, children) == -1) {
+	perror("setsockopt(SO_ATTACH_REUSEPORT_CBPF)");
+	fprintf(stderr, "WARNING (PID %d): Unable to attach event steering.  Events will be split across children by kernel hash.\n",
+		pid);
+      }
+      else
+	fprintf(stderr, "packette (PID %d): Attached event number steering across %d children.\n",
+		pid,
+		children);
+    }
+
     // Report success
     fprintf(stderr,
 	    "packette (PID %d): Listening at %s:%d...\n",
 	    pid,
 	    addr_str,
-	    port + k - 1);
+	    port);
         
     // Now need to allocate the message structures
     retval =
@@ -741,6 +1425,10 @@ int main(int argc, char **argv) {
       perror("malloc()");
       exit(EXIT_FAILURE);
     }
+
+    // Touch the buffer now, so its pages are faulted in
+    // on our (pinned) node and not at the first burst
+    memset(buf, 0, BUFSIZE * vlen);
     
     // Report success.
     fprintf(stderr,
@@ -818,10 +1506,27 @@ int main(int argc, char **argv) {
 
 	// If there was trouble, see if there was an interrupt
 	if (retval == -1) {
-	  perror("recvmmsg()");
+
+	  // The socket went quiet: let go of anything held for reordering,
+	  // so the end of a burst doesn't wait on the next one
+	  if(errno == EAGAIN || errno == EWOULDBLOCK) {
+
+	    if(process_packets_fptr == &reorder_processor
+	       && (released = reorder_flush(ordered_file, &prev_seqnum, &prev_event_num))) {
+	      *bytes_processed_ptr += released;
+
+	      // Readers following the index need the data on disk first
+	      fflush(ordered_file);
+	      if(index_file)
+		fflush(index_file);
+	    }
+	  }
+	  else
+	    perror("recvmmsg()");
 
 	  // Check for a Ctrl+C interrupt
 	  // Only check the volatile if the socket read got disrupted
+	  // (or went quiet, in case the signal landed between reads)
 	  if(interrupt_flag) {
 	    
 	    // Someone pressed Ctrl+C
@@ -834,9 +1539,36 @@ int main(int argc, char **argv) {
       }
     }
 
+    // Release anything still being held for reordering
+    if(process_packets_fptr == &reorder_processor) {
+      reorder_flush(ordered_file, &prev_seqnum, &prev_event_num);
+      free(reorder_slots);
+    }
+    
+    // Finish the index for the last event
+    if(index_file) {
+      close_index();
+      fclose(index_file);
+    }
+    
+    // Give back whatever we reserved but didn't use
+    if(prealloc_extent) {
+      fflush(ordered_file);
+      if(ftruncate(fileno(ordered_file), ftell(ordered_file)) == -1)
+	perror("ftruncate()");
+    }
+    
     // Close the file descriptors
     fclose(ordered_file);
     fclose(orphan_file);
+
+    // (stdio is done with it now)
+    if(wbuf) {
+      if(wbuf_huge)
+	munmap(wbuf, WRITE_BUFFER);
+      else
+	free(wbuf);
+    }
     
     // Free the scatter-gather buffers
     free(buf);
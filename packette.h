@@ -78,6 +78,51 @@ struct packette_transport {
   
 //////////////////////// PACKETTE TRANSPORT PROTOCOL END ////////////////////////////
 
+//////////////////////// PACKETTE EVENT INDEX BEGIN ////////////////////////////
+
+//
+// One of these is written per event, once the event is complete,
+// to a companion stream alongside the stream it describes.
+// Readers can then locate events without walking the stream.
+//
+// 56 bytes
+struct packette_index {
+  uint8_t board_id[6];     // 6 bytes: board MAC address
+  uint16_t reserved;       // 2 bytes: (alignment)
+  uint32_t event_num;      // 4 bytes: event number
+  uint32_t trigger_low;    // 4 bytes: trigger time low (of the first packet)
+  uint64_t offset;         // 8 bytes: byte offset of the event's first packet within the stream
+  uint32_t length;         // 4 bytes: bytes occupied by the event within the stream
+  uint32_t num_packets;    // 4 bytes: transport packets within the event
+  uint64_t first_seqnum;   // 8 bytes: sequence number range of the event
+  uint64_t last_seqnum;    // 8 bytes
+  uint64_t channel_mask;   // 8 bytes: channels present in this event
+};
+
+//////////////////////// PACKETTE EVENT INDEX END ////////////////////////////
+
+//////////////////////// PACKETTE MERGED FILE BEGIN ////////////////////////////
+
+//
+// A globally merged file (packette_merge -g) is:
+//
+//   [ transport packets, event-contiguous, in (event_num, board_id, seqnum) order ]
+//   [ struct packette_index x num_events, offsets relative to the start of the file ]
+//   [ struct packette_footer ]
+//
+// Readers look for the magic in the last bytes of the file.
+//
+#define PACKETTE_FOOTER_MAGIC "PKTTIDX1"
+
+// 24 bytes
+struct packette_footer {
+  char magic[8];           // 8 bytes: PACKETTE_FOOTER_MAGIC (not terminated)
+  uint64_t table_offset;   // 8 bytes: byte offset of the event table (and end of packet data)
+  uint64_t num_events;     // 8 bytes: records in the event table
+};
+
+//////////////////////// PACKETTE MERGED FILE END ////////////////////////////
+
 #define BUFSIZE (sizeof(struct packette_transport) + MAX_FRAGMENT_WIDTH*SAMPLE_WIDTH)
 
 
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+#
+# packette_archive.py
+#
+# Compressed, randomly accessible archives of packette streams.
+#
+# Each event is stored as an independent block, so any event can be
+# decoded on its own.  Samples carry 12 bits of ADC data above a 4 bit flag
+# nibble: the ADC part is delta encoded (mod 4096, zigzagged) and then either
+# bit-packed to 12 bits ('packed') or byte-shuffled and compressed (zlib, or
+# zstd/lz4 if those modules are installed).  Flags are usually clear, so
+# they are stored sparsely when that's smaller.  Transport headers are kept
+# verbatim, so decoding reproduces the original stream bytes exactly.
+#
+# zstd decodes fastest, and is the default when it's available.
+#
+# Layout:
+#
+#   [ file header: magic, codec name ]
+#   [ block ] x num_events           (block header, then encoded event)
+#   [ struct packette_index ] x num_events   (offset/length locate the block)
+#   [ struct packette_footer ]       (same as packette_merge -g, different magic)
+#
+# packetteRun opens archives transparently.
+#
+
+import struct
+import sys
+import zlib
+import numpy as np
+
+import multiprocessing
+
+import packette_stream as packette
+
+PACKETTE_ARCHIVE_MAGIC = b'PKTTARC1'
+
+# Magic and codec name
+archive_header = struct.Struct('8s 8s')
+
+# Bytes of transport headers, number of samples, stored (encoded) length
+archive_block = struct.Struct('I I I')
+
+# Transport headers, as numpy sees them
+transport_dtype = np.dtype([('board_id', 'S6'),
+                            ('rel_offset', '<u2'),
+                            ('seqnum', '<u8'),
+                            ('event_num', '<u4'),
+                            ('trigger_low', '<u4'),
+                            ('channel_mask', '<u8'),
+                            ('num_samples', '<u2'),
+                            ('channel', '<u2'),
+                            ('total_samples', '<u2'),
+                            ('drs4_stop', '<u2')])
+
+#
+# Codecs are (compress, decompress) pairs over bytes
+#
+codecs = {
+    'packed' : (None, None),
+    'zlib' : (lambda b: zlib.compress(b, 1), zlib.decompress)
+}
+
+try:
+    import zstandard
+    codecs['zstd'] = (zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress)
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    codecs['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+default_codec = 'zstd' if 'zstd' in codecs else 'zlib'
+
+# 12 bit packing, two values into three bytes
+def pack12(values):
+    if len(values) % 2:
+        values = np.append(values, 0)
+    a = values[0::2]
+    b = values[1::2]
+    packed = np.empty([len(a), 3], dtype=np.uint8)
+    packed[:,0] = a & 0xFF
+    packed[:,1] = (a >> 8) | ((b & 0xF) << 4)
+    packed[:,2] = b >> 4
+    return packed.tobytes()
+
+def unpack12(data, n):
+    packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.uint16)
+    values = np.empty(2*len(packed), dtype=np.uint16)
+    values[0::2] = packed[:,0] | ((packed[:,1] & 0xF) << 8)
+    values[1::2] = (packed[:,1] >> 4) | (packed[:,2] << 4)
+    return values[:n]
+
+# 4 bit packing, two values into a byte
+def pack4(values):
+    if len(values) % 2:
+        values = np.append(values, 0)
+    return (values[0::2] | (values[1::2] << 4)).astype(np.uint8).tobytes()
+
+def unpack4(data, n):
+    packed = np.frombuffer(data, dtype=np.uint8)
+    values = np.empty(2*len(packed), dtype=np.uint16)
+    values[0::2] = packed & 0xF
+    values[1::2] = packed >> 4
+    return values[:n]
+
+# Flags are stored sparsely (positions and values) unless that's bigger
+DENSE_FLAGS = 0xFFFFFFFF
+
+# Split an event's raw bytes into transport headers and samples
+def splitEvent(raw):
+    headers = []
+    payloads = []
+    pos = 0
+    while pos + packette.packette_transport.size <= len(raw):
+        num_samples = struct.unpack_from('<H', raw, pos + 32)[0]
+        stride = packette.packette_transport.size + num_samples*packette.SAMPLE_WIDTH
+        headers.append(raw[pos:pos + packette.packette_transport.size])
+        payloads.append(raw[pos + packette.packette_transport.size:pos + stride])
+        pos += stride
+    return b''.join(headers), np.frombuffer(b''.join(payloads), dtype='<u2')
+
+#
+# Encodes the raw bytes of one event as a block
+#
+def encodeEvent(raw, codec):
+
+    headers, samples = splitEvent(raw)
+
+    # ADC bits, delta encoded (mod 4096), then zigzagged so small steps either way are small
+    delta = (np.diff(samples >> 4, prepend=np.uint16(0)) & 0xFFF).astype(np.int16)
+    delta[delta >= 2048] -= 4096
+    delta = ((delta << 1) ^ (delta >> 15)).astype(np.uint16) & 0xFFF
+
+    if codec == 'packed':
+        body = pack12(delta)
+    else:
+        # Low bytes together, then high bytes (which are mostly 0)
+        body = delta.astype('<u2').view(np.uint8).reshape(-1, 2).T.tobytes()
+
+    # Flags
+    flags = samples & 0xF
+    where = np.flatnonzero(flags).astype(np.uint32)
+    if 5*len(where) < len(samples)//2:
+        body += struct.pack('I', len(where)) + where.tobytes() + flags[where].astype(np.uint8).tobytes()
+    else:
+        body += struct.pack('I', DENSE_FLAGS) + pack4(flags)
+
+    body = headers + body
+
+    compress = codecs[codec][0]
+    if compress:
+        body = compress(body)
+
+    return archive_block.pack(len(headers), len(samples), len(body)) + body
+
+#
+# Reads a block at the current position of fp and returns the original event bytes
+#
+def readBlock(fp, codec):
+
+    header_bytes, num_samples, stored = archive_block.unpack(fp.read(archive_block.size))
+    body = fp.read(stored)
+
+    decompress = codecs[codec][1]
+    if decompress:
+        body = decompress(body)
+
+    headers = body[:header_bytes]
+    pos = header_bytes
+
+    if codec == 'packed':
+        width = 3*((num_samples + 1)//2)
+        delta = unpack12(body[pos:pos + width], num_samples)
+    else:
+        width = 2*num_samples
+        planes = np.frombuffer(body, dtype=np.uint8, count=width, offset=pos).reshape(2, -1)
+        delta = planes[0] | (planes[1].astype(np.uint16) << 8)
+    pos += width
+
+    # Undo the zigzag and the delta (mod 4096)
+    delta = (delta >> 1) ^ (np.uint16(0) - (delta & 1))
+    samples = (np.cumsum(delta, dtype=np.uint16) & 0xFFF) << 4
+
+    # Put the flags back
+    num_flags = struct.unpack_from('I', body, pos)[0]
+    pos += 4
+    if num_flags == DENSE_FLAGS:
+        samples |= unpack4(body[pos:pos + (num_samples + 1)//2], num_samples)
+    else:
+        where = np.frombuffer(body, dtype=np.uint32, count=num_flags, offset=pos)
+        pos += 4*num_flags
+        samples[where] |= np.frombuffer(body, dtype=np.uint8, count=num_flags, offset=pos)
+
+    # Interleave headers and payloads again
+    info = np.frombuffer(headers, dtype=transport_dtype)
+    bounds = np.concatenate(([0], np.cumsum(info['num_samples'], dtype=np.int64))).tolist()
+    samples = samples.astype('<u2', copy=False).tobytes()
+
+    raw = []
+    for k in range(len(info)):
+        raw.append(headers[k*transport_dtype.itemsize:(k + 1)*transport_dtype.itemsize])
+        raw.append(samples[2*bounds[k]:2*bounds[k + 1]])
+
+    return b''.join(raw)
+
+#
+# Writes an archive of a single packette stream (ordered, merged, ...)
+#
+def archive(fname, codec=default_codec, outname=None):
+
+    if outname is None:
+        outname = fname + '.archive'
+
+    run = packette.packetteRun(fname)
+
+    # Event byte ranges, in file order
+    starts = np.sort(run.indexOffsets).tolist()
+    ends = starts[1:] + [run.fp_limit.get(0, run.fp_indexed[0])]
+
+    fp = run.fps[0]
+    table = []
+    raw_total = 0
+
+    with open(outname, 'wb') as out:
+        out.write(archive_header.pack(PACKETTE_ARCHIVE_MAGIC, codec.encode()))
+
+        for start, end in zip(starts, ends):
+            fp.seek(start)
+            raw = fp.read(end - start)
+            raw_total += len(raw)
+
+            block = encodeEvent(raw, codec)
+
+            # Describe the event from its headers
+            info = np.frombuffer(splitEvent(raw)[0], dtype=transport_dtype)
+            table.append(packette.packette_index.pack(info['board_id'][0],
+                                                      0,
+                                                      int(info['event_num'][0]),
+                                                      int(info['trigger_low'][0]),
+                                                      out.tell(),
+                                                      len(block),
+                                                      len(info),
+                                                      int(info['seqnum'][0]),
+                                                      int(info['seqnum'][-1]),
+                                                      int(info['channel_mask'][0])))
+            out.write(block)
+
+        table_offset = out.tell()
+        out.write(b''.join(table))
+        out.write(packette.packette_footer.pack(PACKETTE_ARCHIVE_MAGIC, table_offset, len(table)))
+        archived = out.tell()
+
+    print("packette_archive.py: %s -> %s: %d events, %.1f MB -> %.1f MB (%.1fx)" % (fname,
+                                                                                  outname,
+                                                                                  len(table),
+                                                                                  raw_total/1e6,
+                                                                                  archived/1e6,
+                                                                                  raw_total/archived if archived else 0),
+          file=sys.stderr)
+    return outname
+
+#
+# Entry point for the archiver
+#
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compress packette streams into randomly accessible archives (FILE.archive)')
+    parser.add_argument('files', metavar='FILE', nargs='+', help='packette streams (.ordered, .merged, ...)')
+    parser.add_argument('-c', '--codec', default=default_codec, choices=sorted(codecs.keys()), help='block codec (default: %s)' % default_codec)
+    args = parser.parse_args()
+
+    # One worker per file
+    with multiprocessing.Pool() as p:
+        p.starmap(archive, [(f, args.codec) for f in args.files])
@@ -8,11 +8,13 @@ import argparse
 import numpy as np
 import os
 import readline
+import bisect
 from A2x_common import parse_speclist
 
 parser = argparse.ArgumentParser(description='Realtime packette data inspector. Can browse existing packette data files or (slowly) capture and new, single-port, streams')
 parser.add_argument('--capture', action='store_true', help='Interpret arguments as an IP address and UDP port to listen at')
 parser.add_argument('fnames', type=str, nargs='+', help='Files to load or IP address and port')
+parser.add_argument('-b', '--board', help='With several boards in the run, browse this one (number or aa:bb:cc:dd:ee:ff, default: the first)')
 
 args = parser.parse_args()
 
@@ -37,10 +39,35 @@ print("Browsing run described by: ", args.fnames)
 
 histf = '.packette_browse_history'
 
+# With several boards, one is browsed at a time (see the board command)
+view = events
+board = 0
+
 # This contains an ordered list of event numbers present within
-# the run (possibly coming from many distinct files)
+# the browsed run (possibly coming from many distinct files)
 run = events.getArrivalOrderedEventNumbers()
 
+def select(which):
+    global view, board, run
+
+    if len(events.getBoards()) > 1:
+        board = events.boardHandle(int(which) if str(which).isdigit() else which)
+        view = events.board(board)
+    else:
+        board = 0
+        view = events
+
+    run = view.getArrivalOrderedEventNumbers()
+
+try:
+    select(0 if args.board is None else args.board)
+except KeyError as e:
+    print("ERROR: No board %s in this run" % args.board)
+    exit(1)
+
+if len(events.getBoards()) > 1:
+    print("Run contains %d boards, browsing %s (see 'board')" % (len(events.getBoards()), packette.prettyBoard(events.getBoards()[board])))
+
 i = 0
 pos = None
 event = None
@@ -80,7 +107,7 @@ def stream_current():
 
     # Update da kine
     try:
-        event = events[run[i]]
+        event = view[run[i]]
 
         # Output it
         print(event)
@@ -168,7 +195,7 @@ def graph(arg):
         for eventpos in eventspec:
             for n in chanlist:
                 try:
-                    graphs.append((events[run[eventpos]].channels[n], eventpos, n))
+                    graphs.append((view[run[eventpos]].channels[n], eventpos, n))
                 except (KeyError, StopIteration, IndexError) as e:
                     print("Missing Event %d, Channel %d?" % (eventpos,n))
 
@@ -366,10 +393,33 @@ def refresh():
     global run
 
     resptuple = events.updateIndex()
+
+    # The index is rebuilt, not extended, so pick up the new one
+    # (and boards may have turned up)
+    select(board)
     print("Indexed %d additional events in ~%f seconds" % resptuple)
 
     # Go to the end
-    jump(len(events)-1)
+    jump(len(view)-1)
+
+# List the boards, or browse another
+def switch_board(arg):
+    global i
+
+    boards = events.getBoards()
+    if len(arg) == 0:
+        for handle, board_id in enumerate(boards):
+            print("%s %d: %s" % ('*' if handle == board else ' ', handle, packette.prettyBoard(board_id)))
+        return
+
+    try:
+        select(arg)
+    except KeyError as e:
+        print("No board %s in this run" % arg)
+        return
+
+    i = 0
+    stream_current()
     
 # Shell out and run the A2x_tool
 def execute(args):
@@ -427,6 +477,9 @@ class PacketteShell(cmd.Cmd):
     def do_cmd(self, arg):
         'Runs ./A2x_tool.py <whatever>: e.g. cmd -I -N 20 10.0.6.97 to initialize the board at 10.0.6.97 and then request 20 soft triggers at the default rate'
         execute(arg)
+    def do_board(self, arg):
+        'List the boards in the run, or browse one of them:  board, board 1, board 00:13:37:00:00:bb'
+        switch_board(arg.strip())
     def do_refresh(self, arg):
         'Rebuild stream index and jump to most recent event: refresh'
         refresh()
@@ -456,15 +509,24 @@ class PacketteShell(cmd.Cmd):
             self.onecmd(cmd)
 
     def do_ffwd(self, arg):
-        'Fast-forward to the next non-empty event'
+        'Fast-forward to the next non-empty event, or the next event with any of the given channels:  FFWD 0-7'
 
-        global event
-        stream_next()
-        
-        while len(event.channels) == 0 and stream_next():
-            pass
-                    
-        print("You should now be on a non-empty event (or end of run).")
+        global event, i
+
+        if event is None:
+            print("No current event!")
+            return
+
+        # Consult the channel masks, instead of loading events one at a time
+        later = view.eventsWithAny(parse_speclist(arg) if arg else None)
+        later = later[later > run[i]]
+
+        if len(later) == 0:
+            print("End of run.")
+            return
+
+        i = bisect.bisect_left(run, int(later[0]))
+        stream_current()
         
     def do_quit(self, arg):
         'Quit'
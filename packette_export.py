@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+#
+# packette_export.py
+#
+# Bulk export of packette runs into columnar stores, so analysis
+# elsewhere doesn't need to go through packetteRun.
+#
+# Each row is an event:
+#
+#   board_id      uint64            (the board's MAC, as an integer)
+#   event_num     uint32
+#   trigger_low   uint32
+#   channel_mask  uint64
+#   drs4_stop     uint16[64]
+#   samples       int16[64, 1024]   (absent channels and samples are NOT_DATA)
+#
+# Samples are in time or capacitor (SCA) ordering, and are not masked.
+#
+# Rows are written in groups.  A pool of workers decodes (and, for HDF5,
+# compresses) groups while the parent writes them, with only a few groups
+# in flight at a time, so memory stays bounded no matter the run length.
+#
+# Output format goes by extension:
+#   .h5, .hdf5              HDF5 (h5py)
+#   .parquet, .pq           Parquet (pyarrow), samples as a fixed shape tensor
+#   .arrow, .feather, .ipc  Arrow IPC file (pyarrow)
+#
+
+import sys
+import os
+import zlib
+import collections
+import multiprocessing
+import numpy as np
+
+import packette_stream as packette
+
+NUM_CHANNELS = 64
+CAP_LEN = 1024
+
+# Events per row group
+ROWS_PER_GROUP = 256
+
+# HDF5 deflate level (chunks are one event, compressed by the workers)
+DEFLATE_LEVEL = 4
+
+formats = {'.h5' : 'hdf5',
+           '.hdf5' : 'hdf5',
+           '.parquet' : 'parquet',
+           '.pq' : 'parquet',
+           '.arrow' : 'arrow',
+           '.feather' : 'arrow',
+           '.ipc' : 'arrow'}
+
+#
+# The run is indexed once, in the parent, and forked workers inherit it.
+#
+run = None
+
+def openRun(fnames, SCAView):
+    global run
+    run = packette.packetteRun(fnames, SCAView=SCAView)
+
+# Workers need their own file handles though: forked ones share file
+# positions with the parent (and each other), so their seeks would race
+def reopenFiles():
+    for fhandle, fp in run.fps.items():
+        run.fps[fhandle] = open(run.fnames[fhandle], 'rb')
+        fp.close()
+
+#
+# Decode a group of events, given as (board, event_num) rows, into arrays
+# (and compress the samples one event per HDF5 chunk, if asked)
+#
+def decodeGroup(rows, deflate=False):
+
+    n = len(rows)
+    group = {'board_id' : np.empty(n, dtype=np.uint64),
+             'event_num' : np.empty(n, dtype=np.uint32),
+             'trigger_low' : np.empty(n, dtype=np.uint32),
+             'channel_mask' : np.empty(n, dtype=np.uint64),
+             'drs4_stop' : np.zeros([n, NUM_CHANNELS], dtype=np.uint16),
+             'samples' : np.full([n, NUM_CHANNELS, CAP_LEN], packette.NOT_DATA, dtype=np.int16)}
+
+    for row, (board, event_num) in enumerate(rows):
+        event = run.loadEvent(event_num, board)
+
+        group['board_id'][row] = int.from_bytes(event.board_id, 'big')
+        group['event_num'][row] = event.event_num
+        group['trigger_low'][row] = event.trigger_low
+        group['channel_mask'][row] = run.channelMask(event_num, board)
+
+        for chan, data in event.channels.items():
+            # Export the data, not the display masks
+            data.clearMasks()
+            data.buildCache()
+
+            group['drs4_stop'][row, chan] = data.drs4_stop
+            group['samples'][row, chan] = data.cachedView
+
+    if deflate:
+        group['samples'] = [zlib.compress(group['samples'][row].tobytes(), DEFLATE_LEVEL) for row in range(n)]
+
+    return group
+
+#
+# Writers take groups as they come
+#
+class hdf5Writer(object):
+
+    def __init__(self, outname):
+        import h5py
+        self.f = h5py.File(outname, 'w')
+        self.rows = 0
+
+        for name, dtype, shape in (('board_id', np.uint64, ()),
+                                   ('event_num', np.uint32, ()),
+                                   ('trigger_low', np.uint32, ()),
+                                   ('channel_mask', np.uint64, ()),
+                                   ('drs4_stop', np.uint16, (NUM_CHANNELS,))):
+            self.f.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype, chunks=(ROWS_PER_GROUP,) + shape)
+
+        # Chunks are single events, so workers can compress them
+        self.f.create_dataset('samples',
+                              shape=(0, NUM_CHANNELS, CAP_LEN),
+                              maxshape=(None, NUM_CHANNELS, CAP_LEN),
+                              dtype=np.int16,
+                              chunks=(1, NUM_CHANNELS, CAP_LEN),
+                              compression='gzip',
+                              compression_opts=DEFLATE_LEVEL)
+
+    def write(self, group):
+        n = len(group['event_num'])
+        for name, dset in self.f.items():
+            dset.resize(self.rows + n, axis=0)
+            if not name == 'samples':
+                dset[self.rows:] = group[name]
+
+        # Already deflated
+        for row, chunk in enumerate(group['samples']):
+            self.f['samples'].id.write_direct_chunk((self.rows + row, 0, 0), chunk)
+
+        self.rows += n
+
+    def close(self):
+        self.f.close()
+
+class arrowWriter(object):
+
+    def __init__(self, outname, parquet):
+        import pyarrow as pa
+        self.pa = pa
+        self.parquet = parquet
+        self.tensor = pa.fixed_shape_tensor(pa.int16(), (NUM_CHANNELS, CAP_LEN))
+        self.schema = pa.schema([('board_id', pa.uint64()),
+                                 ('event_num', pa.uint32()),
+                                 ('trigger_low', pa.uint32()),
+                                 ('channel_mask', pa.uint64()),
+                                 ('drs4_stop', pa.list_(pa.uint16(), NUM_CHANNELS)),
+                                 ('samples', self.tensor)])
+
+        if parquet:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(outname, self.schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(outname, self.schema,
+                                          options=pa.ipc.IpcWriteOptions(compression='zstd', use_threads=True))
+
+    def write(self, group):
+        pa = self.pa
+        n = len(group['event_num'])
+        stops = pa.FixedSizeListArray.from_arrays(pa.array(group['drs4_stop'].ravel()), NUM_CHANNELS)
+        samples = pa.ExtensionArray.from_storage(self.tensor,
+                                                 pa.FixedSizeListArray.from_arrays(pa.array(group['samples'].ravel()),
+                                                                                   NUM_CHANNELS*CAP_LEN))
+        batch = pa.record_batch([pa.array(group['board_id']),
+                                 pa.array(group['event_num']),
+                                 pa.array(group['trigger_low']),
+                                 pa.array(group['channel_mask']),
+                                 stops,
+                                 samples], schema=self.schema)
+
+        # One row group per group
+        if self.parquet:
+            self.writer.write_batch(batch, row_group_size=n)
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+#
+# Export a run (one or more packette streams) into outname
+#
+def export(fnames, outname, SCAView=False, workers=None, rows=ROWS_PER_GROUP):
+
+    fmt = formats.get(os.path.splitext(outname)[1].lower())
+    if fmt is None:
+        raise Exception("Don't know how to write %s (try one of %s)" % (outname, ', '.join(formats.keys())))
+
+    if fmt == 'hdf5':
+        writer = hdf5Writer(outname)
+    else:
+        writer = arrowWriter(outname, fmt == 'parquet')
+
+    # Index here to plan the groups (workers are forked after, and inherit the index)
+    # Rows are (board, event_num), one board after the other
+    openRun(fnames, SCAView)
+    planned = [(int(board), int(event_num)) for board, event_num in zip(run.indexBoards, run.indexEvents)]
+    groups = [planned[k:k + rows] for k in range(0, len(planned), rows)]
+
+    workers = workers or os.cpu_count()
+
+    with multiprocessing.get_context('fork').Pool(workers, initializer=reopenFiles) as p:
+
+        # Keep a couple of groups per worker in flight, and write them in order
+        pending = collections.deque()
+        for group in groups:
+            pending.append(p.apply_async(decodeGroup, (group, fmt == 'hdf5')))
+
+            if len(pending) >= 2*workers:
+                writer.write(pending.popleft().get())
+
+        while pending:
+            writer.write(pending.popleft().get())
+
+    writer.close()
+
+    print("packette_export.py: wrote %d events to %s" % (len(planned), outname), file=sys.stderr)
+
+#
+# Entry point for the exporter
+#
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export packette runs to HDF5, Parquet or Arrow, one row per event')
+    parser.add_argument('fnames', metavar='FILE', nargs='+', help='packette streams making up the run')
+    parser.add_argument('-o', '--output', required=True, help='output file (.h5, .parquet or .arrow)')
+    parser.add_argument('--sca', action='store_true', help='write samples in capacitor ordering (default is time ordering)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='decoding processes (default: one per core)')
+    parser.add_argument('--rows', type=int, default=ROWS_PER_GROUP, help='events per row group (default: %d)' % ROWS_PER_GROUP)
+    args = parser.parse_args()
+
+    export(args.fnames, args.output, SCAView=args.sca, workers=args.workers, rows=args.rows)
@@ -9,6 +9,18 @@
 // Signals
 #include <signal.h>
 
+// Workers
+#include <sys/wait.h>
+#include <glob.h>
+
+// Mapping inputs
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+// Time
+#include <time.h>
+
 // Local stuff
 #include "packette.h"
 
@@ -16,10 +28,16 @@
 
 //
 // Compares sequence numbers for qsort()
+// (Don't subtract, these are 64-bit and the result is an int)
 //
 int eval_seqnum(const void *a, const void *b) {
 
-  return ((const struct packette_transport *)a)->assembly.seqnum - ((const struct packette_transport *)b)->assembly.seqnum;
+  uint64_t sa, sb;
+
+  sa = ((const struct packette_transport *)a)->assembly.seqnum;
+  sb = ((const struct packette_transport *)b)->assembly.seqnum;
+
+  return (sa > sb) - (sa < sb);
 }
 
 //
@@ -38,177 +56,781 @@ void flagInterrupt(int signum) {
 #define L2_CACHE 256000
 #define TIMEOUT 1
 
+// Default size of an in-memory sorted run of orphans
+#define RUN_MB 256
+
+// Output is written through a buffer this big
+#define OUTPUT_BUFFER (4 << 20)
+
+// How often (in packets) to look for Ctrl+C
+#define INTERRUPT_CHECK 4096
+
+///////////////////////////// MERGE ENGINE /////////////////////////
+
 //
-// packette_merge is a simpler program designed to be 
-// run via xargs
+// A sorted run of fixed width orphan buffers
 //
-// It takes an ordered packette file and an orphan packette file
-// and merges them into a single file that is ordered in
-// sequence number.
+struct orphan_run {
+  char *base;                    // Mapped (or allocated) sorted orphans
+  unsigned long len;             // Bytes
+  unsigned long pos;             // Bytes consumed
+  unsigned char mapped;          // munmap() or free()?
+};
+
 //
-// 1) The orphan file is qsort()ed
-// 2) The ordered file is written to filename.merged one
-//    transport packet at a time until a jump in sequence
-//    number is detected.  Packets are pulled from the
-//    sorted orphan file until the sequence is patched
-//    or there are no more events.
-// 3) 
-int main(int argc, char **argv) {
+// Accounting for a single prefix
+//
+struct merge_stats {
+  unsigned long ordered;         // Packets taken from the ordered stream
+  unsigned long placed;          // Orphans placed within the ordered stream
+  unsigned long trailing;        // Orphans placed after the last ordered packet
+  unsigned long duplicates;      // Dropped
+  unsigned long runs;            // Sorted runs of orphans
+  unsigned long bytes;           // Written to output
+  double seconds;                // Wall time
+  unsigned char status;          // MERGE_* below
+};
+
+// How a merge went (MERGE_FAILED unless a worker says otherwise)
+#define MERGE_FAILED 0
+#define MERGE_DONE 1
+#define MERGE_NOTHING 2
 
-  // Argument parsing stuff
-  int opt;
-  char *prefix_str;
+//
+// Merges the ordered stream and the orphans of one prefix,
+// handing back packets one at a time in sequence number order.
+//
+struct port_merge {
 
-  // Signal handling stuff
-  struct sigaction new_action, old_action;
+  const char *prefix;
 
-  // Files and data output stuff
-  FILE *ordered_file;              // Stage I reconstruction (ordered and stripped) output
-  FILE *orphan_file;               // Stage II reconstruction (unordered, raw) output
-  FILE *merged_file;               // Merged output
+  // The ordered stream, mapped in
+  char *ordered;
+  unsigned long ordered_len;
+  unsigned long ordered_pos;
 
-  // General purpose string buffers
-  char tmp1[1024];
+  // Sorted runs of orphans, and a min-heap (by head sequence number) over them
+  struct orphan_run *runs;
+  unsigned int num_runs;
+  unsigned int *heap;
+  unsigned int heap_len;
 
-  // Merging stuff
-  unsigned long orphan_size;
-  char *orphans;
-  struct packette_transport *tmp, *ptr;
-  
-  // Initialization
-  tmp1[0] = 0x0;
-  merged_file = 0x0;
-  
-  /////////////////// ARGUMENT PARSING //////////////////
-  
-  while ((opt = getopt(argc, argv, "o")) != -1) {
-    switch (opt) {
-    case 'o':
-      merged_file = stdout;
+  // Duplicate suppression
+  uint64_t last_seqnum;
+  unsigned char started;
+
+  struct merge_stats stats;
+};
+
+// Sequence number at the head of a run
+#define RUN_HEAD(m, r) ((struct packette_transport *)((m)->runs[r].base + (m)->runs[r].pos))
+
+void heap_sift_down(struct port_merge *m, unsigned int i) {
+
+  unsigned int child, tmp;
+
+  while((child = 2*i + 1) < m->heap_len) {
+
+    // Pick the smaller child
+    if(child + 1 < m->heap_len
+       && RUN_HEAD(m, m->heap[child + 1])->assembly.seqnum < RUN_HEAD(m, m->heap[child])->assembly.seqnum)
+      ++child;
+
+    if(RUN_HEAD(m, m->heap[i])->assembly.seqnum <= RUN_HEAD(m, m->heap[child])->assembly.seqnum)
       break;
-    default: /* '?' */
-      fprintf(stderr, "Usage: %s [-o dump to standard out] FILE_PREFIX\n",	argv[0]);
-      exit(EXIT_FAILURE);
-    }
+
+    tmp = m->heap[i];
+    m->heap[i] = m->heap[child];
+    m->heap[child] = tmp;
+    i = child;
   }
+}
 
-  // Sanity check
-  if(merged_file)
-    fprintf(stderr, "Packette_merge: dumping to stdout...\n");
+//
+// Maps a file read-only for a single sequential pass.
+// Returns 0x0 for empty files (and sets *len to 0).
+//
+char *map_input(int fd, unsigned long *len) {
 
-  // Now grab mandatory positional arguments
-  if(optind >= argc) {
-    fprintf(stderr, "Expected file prefix\n");
+  struct stat st;
+  char *base;
+
+  if(fstat(fd, &st) == -1) {
+    perror("fstat()");
     exit(EXIT_FAILURE);
   }
 
-  // For clarity
-  prefix_str = argv[optind];
+  *len = st.st_size;
+  if(!*len)
+    return 0x0;
+
+  if((base = mmap(NULL, *len, PROT_READ, MAP_PRIVATE, fd, 0)) == MAP_FAILED) {
+    perror("mmap()");
+    exit(EXIT_FAILURE);
+  }
 
-  // Attempt to open the prefix files
-  sprintf(tmp1, "%s.orphans", prefix_str);
+  madvise(base, *len, MADV_SEQUENTIAL);
+  return base;
+}
 
-  // Open the orphansfile
+//
+// Sorts the orphans of a prefix into runs of at most run_bytes.
+// If they fit in a single run, it stays in memory.
+// Otherwise each run is sorted in memory and spilled to an (unlinked)
+// temporary file next to the data, which is then mapped back in for the merge.
+// This way orphan files larger than memory can be merged.
+//
+// Returns the number of orphans.
+//
+unsigned long sort_orphans(struct port_merge *m, unsigned long run_bytes) {
+
+  char tmp1[1024];
+  FILE *orphan_file;
+  unsigned long orphan_size, chunk, got;
+  char *buf;
+  int fd, i;
+
+  snprintf(tmp1, 1024, "%s.orphans", m->prefix);
   if(! (orphan_file = fopen(tmp1, "rb"))) {
     perror("fopen()");
     exit(EXIT_FAILURE);
   }
 
-  // Make sure there are some orphans
-  fseek(orphan_file, 0, SEEK_END);
-
   // How big is it?
+  fseek(orphan_file, 0, SEEK_END);
   orphan_size = ftell(orphan_file);
-
-  // Was it empty?
-  if(!orphan_size) {
-    fprintf(stderr,
-	    "SUCCESS: Attempted to merge an empty orphan file.  Congratulations, you received everything in order.  No merged file necessary.\n");
-    exit(0);
-  }
+  fseek(orphan_file, 0, SEEK_SET);
 
   // Is it corrupted?
   if(orphan_size % BUFSIZE) {
     fprintf(stderr,
-	    "ERROR: Orphans file is not the correct length and qsort() will fail.\n\tCorruption likely, but perhaps not terminal.  Walk the file yourself if you really need it.\n");
+	    "ERROR: %s is not the correct length and cannot be sorted.\n\tCorruption likely, but perhaps not terminal.  Walk the file yourself if you really need it.\n", tmp1);
     exit(EXIT_FAILURE);
   }
 
-  // Attempt to allocate memory large enough to
-  // sort the orphans in place
-  if(! (orphans = (char *)malloc(orphan_size))) {
+  m->num_runs = 0;
+  m->heap_len = 0;
+  if(!orphan_size) {
+    fclose(orphan_file);
+    return 0;
+  }
+
+  // Runs are whole buffers
+  run_bytes -= run_bytes % BUFSIZE;
+  if(run_bytes < BUFSIZE)
+    run_bytes = BUFSIZE;
+
+  chunk = orphan_size < run_bytes ? orphan_size : run_bytes;
+  m->num_runs = (orphan_size + chunk - 1) / chunk;
+
+  if(! ((m->runs = (struct orphan_run *)calloc(m->num_runs, sizeof(struct orphan_run)))
+	&& (m->heap = (unsigned int *)malloc(m->num_runs * sizeof(unsigned int)))
+	&& (buf = (char *)malloc(chunk)))) {
     perror("malloc()");
     fprintf(stderr,
-	    "ERROR: Failed to allocate %d bytes for in-place sort of orphans.  Your orphan file should not be gigabytes...\n");
+	    "ERROR: Failed to allocate %lu bytes for sorting orphans.  Try a smaller run size (-m).\n", chunk);
     exit(EXIT_FAILURE);
   }
 
-  // Go back to the beginning and load the stream
-  fseek(orphan_file, 0, SEEK_SET);
+  fprintf(stderr,
+	  "Packette_merge: sorting %lu orphans of %s in %u run(s)...\n",
+	  orphan_size / BUFSIZE,
+	  m->prefix,
+	  m->num_runs);
 
-  // This will die if the entire orphans file is larger than
-  // the available memory on the system
-  // Is this shitting on everything?
-  fread(orphans,
-  	BUFSIZE,
-  	orphan_size / BUFSIZE,
-  	orphan_file);
-
-  // Check for weirdness
-  if(ferror(orphan_file)) {
-    perror("fread()");
-    exit(EXIT_FAILURE);
+  for(m->stats.runs = 0; m->stats.runs < m->num_runs; ++m->stats.runs) {
+
+    got = fread(buf, BUFSIZE, chunk / BUFSIZE, orphan_file);
+    if(ferror(orphan_file)) {
+      perror("fread()");
+      exit(EXIT_FAILURE);
+    }
+
+    qsort(buf, got, BUFSIZE, eval_seqnum);
+
+    // It all fit, keep it
+    if(m->num_runs == 1) {
+      m->runs[0].base = buf;
+      m->runs[0].len = got * BUFSIZE;
+      buf = 0x0;
+      break;
+    }
+
+    // Spill it
+    snprintf(tmp1, 1024, "%s.run.XXXXXX", m->prefix);
+    if((fd = mkstemp(tmp1)) == -1) {
+      perror("mkstemp()");
+      exit(EXIT_FAILURE);
+    }
+    unlink(tmp1);
+
+    if(write(fd, buf, got * BUFSIZE) != (ssize_t)(got * BUFSIZE)) {
+      perror("write()");
+      exit(EXIT_FAILURE);
+    }
+
+    m->runs[m->stats.runs].base = map_input(fd, &(m->runs[m->stats.runs].len));
+    m->runs[m->stats.runs].mapped = 1;
+    close(fd);
   }
+  m->stats.runs = m->num_runs;
 
-  // Close the file
   fclose(orphan_file);
-  
-  //
-  // Step 1)
-  //
-  // qsort() the orphans
-  //
-  fprintf(stderr,
-	  "Packette_merge: sorting %d orphan events...\n", orphan_size / BUFSIZE);
-  qsort(orphans, orphan_size / BUFSIZE, BUFSIZE, eval_seqnum);
-  fprintf(stderr,
-	  "Packette_merge: ...sorting complete.\n");
+  free(buf);
 
-  // WARNING: There may still be *duplicates* sitting in the orphans.
-  //          i.e. orphans themselves may be duplicated and orphans
-  //          may contain duplicates of things already present in ordered!
-  
-  //
-  // Step 2)
-  //
-  // Process the ordered stream and output streams in serial
-  // so we keep memory usage as low as possible
-  //
+  // Build the heap
+  for(m->heap_len = 0; m->heap_len < m->num_runs; ++m->heap_len)
+    m->heap[m->heap_len] = m->heap_len;
 
-  // Attempt to open the ordered and merged files
-  sprintf(tmp1, "%s.ordered", prefix_str);
-  if(! (ordered_file = fopen(tmp1, "rb"))) {
-    perror("fopen()");
+  for(i = (int)m->heap_len/2 - 1; i >= 0; --i)
+    heap_sift_down(m, i);
+
+  return orphan_size / BUFSIZE;
+}
+
+//
+// Set up a merge of the given prefix
+// Returns the number of orphans (0 means there's nothing to merge)
+//
+unsigned long merge_open(struct port_merge *m, const char *prefix, unsigned long run_bytes) {
+
+  char tmp1[1024];
+  int fd;
+  unsigned long orphans;
+
+  memset(m, 0, sizeof(struct port_merge));
+  m->prefix = prefix;
+
+  orphans = sort_orphans(m, run_bytes);
+
+  snprintf(tmp1, 1024, "%s.ordered", prefix);
+  if((fd = open(tmp1, O_RDONLY)) == -1) {
+    perror("open()");
     exit(EXIT_FAILURE);
   }
+  m->ordered = map_input(fd, &(m->ordered_len));
+  close(fd);
+
+  return orphans;
+}
+
+//
+// Hands back the next packet in sequence, or 0x0 when both streams are done.
+// Returned pointers are into mapped memory and stay valid until merge_close().
+//
+const struct packette_transport *merge_next(struct port_merge *m) {
+
+  const struct packette_transport *ordered, *orphan;
+  struct orphan_run *run;
+  unsigned int stride;
+
+  while(1) {
+
+    // What's at the head of the ordered stream?
+    // (A partially written packet at the end counts as the end.)
+    ordered = 0x0;
+    if(m->ordered_pos + sizeof(struct packette_transport) <= m->ordered_len) {
+      ordered = (const struct packette_transport *)(m->ordered + m->ordered_pos);
+      stride = sizeof(struct packette_transport) + ordered->channel.num_samples*SAMPLE_WIDTH;
+      if(m->ordered_pos + stride > m->ordered_len)
+	ordered = 0x0;
+    }
+
+    // And at the head of the orphans?
+    orphan = m->heap_len ? RUN_HEAD(m, m->heap[0]) : 0x0;
+
+    if(!ordered && !orphan)
+      return 0x0;
+
+    if(ordered && (!orphan || ordered->assembly.seqnum <= orphan->assembly.seqnum)) {
+
+      // In-order arrival
+      m->ordered_pos += stride;
+
+      if(m->started && ordered->assembly.seqnum == m->last_seqnum) {
+	m->stats.duplicates++;
+	continue;
+      }
+      m->stats.ordered++;
+      m->last_seqnum = ordered->assembly.seqnum;
+      m->started = 1;
+      return ordered;
+    }
+
+    // Pop the orphan
+    run = &(m->runs[m->heap[0]]);
+    run->pos += BUFSIZE;
+    if(run->pos >= run->len)
+      m->heap[0] = m->heap[--m->heap_len];
+    heap_sift_down(m, 0);
+
+    // Orphans may duplicate each other, or things already in the ordered stream
+    if(m->started && orphan->assembly.seqnum == m->last_seqnum) {
+      m->stats.duplicates++;
+      continue;
+    }
+
+    if(ordered)
+      m->stats.placed++;
+    else
+      m->stats.trailing++;
+
+    m->last_seqnum = orphan->assembly.seqnum;
+    m->started = 1;
+    return orphan;
+  }
+}
+
+void merge_close(struct port_merge *m) {
+
+  unsigned int r;
+
+  for(r = 0; r < m->num_runs; ++r) {
+    if(m->runs[r].mapped)
+      munmap(m->runs[r].base, m->runs[r].len);
+    else
+      free(m->runs[r].base);
+  }
+
+  if(m->ordered)
+    munmap(m->ordered, m->ordered_len);
+
+  if(m->num_runs) {
+    free(m->runs);
+    free(m->heap);
+  }
+}
+
+//
+// Event table for globally merged output (-g)
+//
+unsigned char index_events;
+struct packette_index *event_table;
+unsigned long num_events, event_table_len;
+uint64_t merged_offset;
+
+//
+// Same bookkeeping as packette -i, but kept in memory
+// so that it can be appended to the merged file
+//
+void index_packet(const struct packette_transport *ptr, unsigned int stride) {
+
+  struct packette_index *current;
+
+  current = num_events ? &event_table[num_events - 1] : 0x0;
+
+  // Crossed an event boundary?
+  if(!current
+     || ptr->header.event_num != current->event_num
+     || memcmp(ptr->assembly.board_id, current->board_id, 6)) {
+
+    // Grow the table
+    if(num_events == event_table_len) {
+      event_table_len = event_table_len ? 2*event_table_len : 4096;
+      if(! (event_table = (struct packette_index *)realloc(event_table, event_table_len * sizeof(struct packette_index)))) {
+	perror("realloc()");
+	exit(EXIT_FAILURE);
+      }
+    }
+
+    current = &event_table[num_events++];
+    memcpy(current->board_id, ptr->assembly.board_id, 6);
+    current->reserved = 0;
+    current->event_num = ptr->header.event_num;
+    current->trigger_low = ptr->header.trigger_low;
+    current->offset = merged_offset;
+    current->length = 0;
+    current->num_packets = 0;
+    current->first_seqnum = ptr->assembly.seqnum;
+    current->channel_mask = ptr->header.channel_mask;
+  }
+
+  current->length += stride;
+  current->num_packets++;
+  current->last_seqnum = ptr->assembly.seqnum;
+}
+
+//
+// Emit a merged packet, ignoring excess (orphan) buffer space
+//
+void merge_write(struct port_merge *m, const struct packette_transport *ptr, FILE *merged_file) {
+
+  unsigned int stride;
+
+  stride = sizeof(struct packette_transport) + ptr->channel.num_samples*SAMPLE_WIDTH;
+  fwrite(ptr,
+	 stride,
+	 1,
+	 merged_file);
+
+  if(index_events)
+    index_packet(ptr, stride);
+
+  m->stats.bytes += stride;
+  merged_offset += stride;
+}
+
+//
+// Append the event table and footer
+//
+void write_table(FILE *merged_file) {
+
+  struct packette_footer footer;
+
+  memcpy(footer.magic, PACKETTE_FOOTER_MAGIC, sizeof(footer.magic));
+  footer.table_offset = merged_offset;
+  footer.num_events = num_events;
+
+  fwrite(event_table, sizeof(struct packette_index), num_events, merged_file);
+  fwrite(&footer, sizeof(struct packette_footer), 1, merged_file);
+}
+
+//
+// Global ordering: event number, then board, then sequence number
+//
+int event_order(const struct packette_transport *a, const struct packette_transport *b) {
+
+  int c;
+
+  if(a->header.event_num != b->header.event_num)
+    return a->header.event_num < b->header.event_num ? -1 : 1;
+
+  if((c = memcmp(a->assembly.board_id, b->assembly.board_id, 6)))
+    return c;
+
+  return (a->assembly.seqnum > b->assembly.seqnum) - (a->assembly.seqnum < b->assembly.seqnum);
+}
+
+//
+// Merge the (already sequence ordered) port streams into one.
+// With a single port, this is just the sequence number merge.
+//
+void merge_ports(struct port_merge *ports, unsigned int num_ports, FILE *merged_file) {
 
-  sprintf(tmp1, "%s.merged", prefix_str);
-  if(! (merged_file = fopen(tmp1, "wb"))) {
+  const struct packette_transport **heads, *last;
+  unsigned long n;
+  int i, best;
+
+  if(! (heads = (const struct packette_transport **)malloc(num_ports * sizeof(struct packette_transport *)))) {
+    perror("malloc()");
+    exit(EXIT_FAILURE);
+  }
+
+  for(i = 0; i < num_ports; ++i)
+    heads[i] = merge_next(&ports[i]);
+
+  last = 0x0;
+  n = 0;
+  while(1) {
+
+    // There are only ever a handful of ports, so just look at all of them
+    best = -1;
+    for(i = 0; i < num_ports; ++i)
+      if(heads[i] && (best < 0 || event_order(heads[i], heads[best]) < 0))
+	best = i;
+
+    if(best < 0)
+      break;
+
+    // The same packet made it onto two ports
+    if(last && !event_order(heads[best], last))
+      ports[best].stats.duplicates++;
+    else
+      merge_write(&ports[best], heads[best], merged_file);
+
+    last = heads[best];
+    heads[best] = merge_next(&ports[best]);
+
+    // Look for Ctrl+C
+    if(!(++n % INTERRUPT_CHECK) && interrupt_flag) {
+
+      // Finish up and close
+      fprintf(stderr,
+	      "Packette_merge: Caught Ctrl+C, cleaning up....\n");
+      break;
+    }
+  }
+
+  free(heads);
+}
+
+void report(const char *prefix, struct merge_stats *stats) {
+
+  switch(stats->status) {
+  case MERGE_NOTHING:
+    fprintf(stderr,
+	    "Packette_merge: %s: empty orphan file, everything was received in order.  No merged file necessary.\n",
+	    prefix);
+    return;
+  case MERGE_FAILED:
+    fprintf(stderr,
+	    "Packette_merge: %s: FAILED\n",
+	    prefix);
+    return;
+  }
+
+  fprintf(stderr,
+	  "Packette_merge: %s: %lu ordered, %lu orphans placed, %lu trailing, %lu duplicates dropped (%lu runs), %.1f MB in %.2f s (%.1f MB/s)\n",
+	  prefix,
+	  stats->ordered,
+	  stats->placed,
+	  stats->trailing,
+	  stats->duplicates,
+	  stats->runs,
+	  stats->bytes / 1e6,
+	  stats->seconds,
+	  stats->seconds > 0 ? stats->bytes / 1e6 / stats->seconds : 0.0);
+
+  if(stats->trailing)
+    fprintf(stderr,
+	    "WARNING: %lu orphans with sequence number greater than the last ordered fragment existed.\n\tThis should not happen in normal operation, but can happen in various debug scenarios (e.g. abandonment).  They were merged.\n",
+	    stats->trailing);
+}
+
+double now() {
+
+  struct timespec ts;
+
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+//
+// Opens the output and sets it up for writing in big blocks
+//
+FILE *open_output(const char *fname, char **obuf) {
+
+  FILE *merged_file;
+
+  if(! (merged_file = fopen(fname, "wb"))) {
     perror("fopen()");
     exit(EXIT_FAILURE);
   }
 
-  // Allocate a buffer
-  if(! (tmp = (struct packette_transport *)malloc(BUFSIZE))) {
+  if(! (*obuf = (char *)malloc(OUTPUT_BUFFER))) {
     perror("malloc()");
     exit(EXIT_FAILURE);
   }
+  setvbuf(merged_file, *obuf, _IOFBF, OUTPUT_BUFFER);
+
+  return merged_file;
+}
+
+//
+// Sequence merge of a single prefix into prefix.merged (or stdout)
+//
+void merge_one(const char *prefix, unsigned long run_bytes, unsigned char to_stdout, struct merge_stats *stats) {
+
+  struct port_merge merge;
+  FILE *merged_file;
+  char tmp1[1024];
+  char *obuf;
+  double start;
+
+  start = now();
+
+  // Sort the orphans
+  if(!merge_open(&merge, prefix, run_bytes)) {
+    merge_close(&merge);
+    stats->status = MERGE_NOTHING;
+    return;
+  }
+
+  if(to_stdout) {
+    merged_file = stdout;
+    if(! (obuf = (char *)malloc(OUTPUT_BUFFER))) {
+      perror("malloc()");
+      exit(EXIT_FAILURE);
+    }
+    setvbuf(merged_file, obuf, _IOFBF, OUTPUT_BUFFER);
+  }
+  else {
+    snprintf(tmp1, 1024, "%s.merged", prefix);
+    merged_file = open_output(tmp1, &obuf);
+  }
+
+  // Stream the ordered and orphans into the output
+  merge_ports(&merge, 1, merged_file);
+
+  fclose(merged_file);
+  free(obuf);
+
+  memcpy(stats, &merge.stats, sizeof(struct merge_stats));
+  stats->seconds = now() - start;
+  stats->status = MERGE_DONE;
+
+  merge_close(&merge);
+}
+
+//
+// Arguments may be prefixes or globs (e.g. 'rawdata/run_10.0.6.254_*').
+// Globs are matched against .ordered and .orphans files, and the
+// distinct prefixes are returned in sorted order.
+//
+char **expand_prefixes(char **args, int num_args, unsigned int *num_prefixes) {
+
+  glob_t matches;
+  char **prefixes, *ext, *candidate;
+  unsigned int n, i, j, max;
+
+  // Count the most we could get
+  max = 0;
+  for(i = 0; i < num_args; ++i) {
+    if(!strpbrk(args[i], "*?[")) {
+      ++max;
+      continue;
+    }
+
+    if(glob(args[i], 0, NULL, &matches) == 0) {
+      max += matches.gl_pathc;
+      globfree(&matches);
+    }
+  }
+
+  if(! (prefixes = (char **)calloc(max ? max : 1, sizeof(char *)))) {
+    perror("calloc()");
+    exit(EXIT_FAILURE);
+  }
+
+  n = 0;
+  for(i = 0; i < num_args; ++i) {
+
+    // Not a glob, take it as given
+    if(!strpbrk(args[i], "*?[")) {
+      prefixes[n++] = strdup(args[i]);
+      continue;
+    }
+
+    if(glob(args[i], 0, NULL, &matches))
+      continue;
+
+    for(j = 0; j < matches.gl_pathc; ++j) {
+
+      // Only packette streams
+      if(! ((ext = strrchr(matches.gl_pathv[j], '.'))
+	    && (!strcmp(ext, ".ordered") || !strcmp(ext, ".orphans"))))
+	continue;
+
+      candidate = strndup(matches.gl_pathv[j], ext - matches.gl_pathv[j]);
+
+      // Each prefix once
+      if(n && !strcmp(prefixes[n - 1], candidate))
+	free(candidate);
+      else
+	prefixes[n++] = candidate;
+    }
+
+    globfree(&matches);
+  }
+
+  *num_prefixes = n;
+  return prefixes;
+}
+
+//
+// packette_merge is a simpler program designed to be
+// run via xargs
+//
+// It takes an ordered packette file and an orphan packette file
+// and merges them into a single file that is ordered in
+// sequence number.
+//
+// 1) The orphan file is sorted in runs that fit in memory (-m).
+//    Runs that don't all fit are spilled to temporary files.
+// 2) The ordered stream and the sorted runs are mapped in and
+//    k-way merged by sequence number into filename.merged,
+//    through a large output buffer.  Duplicates are dropped.
+// 3) A summary is reported.
+//
+// Given several prefixes (or globs), it forks a pool of workers
+// (-j, defaulting to the number of cores) and merges them concurrently.
+//
+// With -g OUTPUT, it takes every port prefix of a run instead.
+// Each port is merged as above, and the ports are merged together
+// by (event_num, board, seqnum) into OUTPUT, so events are contiguous.
+// An event table and footer (see packette.h) are appended, so readers
+// get an index without walking the file.
+//
+int main(int argc, char **argv) {
+
+  // Argument parsing stuff
+  int opt;
+  char *global_str;
+  unsigned long run_bytes;
+  unsigned char to_stdout;
+  long num_workers;
+
+  // Signal handling stuff
+  struct sigaction new_action, old_action;
+
+  // Files and data output stuff
+  FILE *merged_file;               // Merged output
+  char *obuf;
+
+  // Merging stuff
+  char **prefixes;
+  unsigned int num_prefixes, i, next, running, failed;
+  struct port_merge *ports;
+  struct merge_stats *stats, total;
+  unsigned long orphans;
+  double start;
+  pid_t pid;
+  int wstatus;
+
+  // Initialization
+  to_stdout = 0;
+  global_str = 0x0;
+  run_bytes = (unsigned long)RUN_MB << 20;
+  num_workers = sysconf(_SC_NPROCESSORS_ONLN);
+
+  /////////////////// ARGUMENT PARSING //////////////////
+
+  while ((opt = getopt(argc, argv, "om:g:j:")) != -1) {
+    switch (opt) {
+    case 'o':
+      to_stdout = 1;
+      break;
+    case 'm':
+      run_bytes = atol(optarg) << 20;
+      break;
+    case 'g':
+      global_str = optarg;
+      break;
+    case 'j':
+      num_workers = atol(optarg);
+      break;
+    default: /* '?' */
+      fprintf(stderr, "Usage: %s [-o dump to standard out] [-m orphan run size in MB] [-g merge all prefixes into OUTPUT] [-j workers] FILE_PREFIX|'GLOB' [...]\n",	argv[0]);
+      exit(EXIT_FAILURE);
+    }
+  }
+
+  // Now grab mandatory positional arguments
+  if(optind >= argc) {
+    fprintf(stderr, "Expected file prefix\n");
+    exit(EXIT_FAILURE);
+  }
+
+  prefixes = expand_prefixes(argv + optind, argc - optind, &num_prefixes);
+  if(!num_prefixes) {
+    fprintf(stderr, "No packette streams matched\n");
+    exit(EXIT_FAILURE);
+  }
+
+  // Sanity check
+  if(to_stdout) {
+    if(num_prefixes > 1 && !global_str) {
+      fprintf(stderr, "Can only dump one prefix to stdout (use -g to combine them)\n");
+      exit(EXIT_FAILURE);
+    }
+    fprintf(stderr, "Packette_merge: dumping to stdout...\n");
+  }
+
+  if(num_workers < 1)
+    num_workers = 1;
 
-  // Report what we've been asked to do
-  fprintf(stderr,
-	  "Packette-merge: will do an ordered merge of packette files with prefix %s\n", prefix_str);
-  
   // Catch Ctrl+C so we don't (easily) write corrupted output.
+  // (Workers inherit this)
   new_action.sa_handler = &flagInterrupt;
   sigemptyset (&new_action.sa_mask);
   new_action.sa_flags = 0;
@@ -217,121 +839,165 @@ int main(int argc, char **argv) {
   if (old_action.sa_handler != SIG_IGN)
     sigaction(SIGINT, &new_action, NULL);
 
-  // Perform the merge
-  ptr = (struct packette_transport *)orphans;
-  
-  while(1) {
+  start = now();
 
-    // Try to grab the header block from the stream that arrived in-order
-    fread(tmp,
-	  sizeof(struct packette_transport),
-	  1,
-	  ordered_file);
-
-    // Did we successfully read
-    if(!feof(ordered_file) && !ferror(ordered_file)) {
-
-      // Get caught up
-      // Notice we check for overrun and short-circuit, before we try to dereference ptr
-      // tmp makes sense, because the read was successful (we didn't run past the file)
-      while(((char *)ptr - orphans < orphan_size) && (ptr->assembly.seqnum < tmp->assembly.seqnum)) {
-
-	fprintf(stderr,
-		"Packette_merge: placing orphan %d at sequence position %jd\n",
-		((char *)ptr - orphans) / BUFSIZE,
-		ptr->assembly.seqnum);
-	
-	// Write the orphan, ignoring excess buffer space
-	fwrite(ptr,
-	       sizeof(struct packette_transport) + ptr->channel.num_samples*SAMPLE_WIDTH,
-	       1,
-	       merged_file);
-
-	// Go to the next one
-	// Since ptr is just the header type, we can't use pointer arithmetic here.
-	ptr = (struct packette_transport *)((char *)ptr + BUFSIZE);
-      }
-      
-      // Write out the header+payload that arrived in-order to merged
-      fprintf(stderr, "packette_merge: placing in-order arrival %ld\n", tmp->assembly.seqnum);
-
-      // Grab the payload (into payload position with pointer arithmetic)
-      // DANGER: if the packet is malformed, then this will corrupt memory.
-      fread(tmp + 1,
-	    tmp->channel.num_samples*SAMPLE_WIDTH,
-	    1,
-	    ordered_file);
-      
-      fwrite(tmp,
-	     sizeof(struct packette_transport) + tmp->channel.num_samples*SAMPLE_WIDTH,
-	     1,
-	     merged_file);
-
-      // Duplicates will never happen, because we drop them in stage I...
+  //
+  // Global merge: everything into one file
+  //
+  if(global_str) {
+
+    if(! (ports = (struct port_merge *)calloc(num_prefixes, sizeof(struct port_merge)))) {
+      perror("calloc()");
+      exit(EXIT_FAILURE);
     }
-    else {
 
-      // Did we encounter an error?
-      if(ferror(ordered_file)) {
+    // Sort the orphans
+    orphans = 0;
+    for(i = 0; i < num_prefixes; ++i)
+      orphans += merge_open(&ports[i], prefixes[i], run_bytes);
 
-	perror("fread()");
-	fprintf(stderr,
-	      "WARNING: error encountered on reading ordered file.  Trying to end gracefully...\n");
-	break;
+    if(to_stdout) {
+      merged_file = stdout;
+      if(! (obuf = (char *)malloc(OUTPUT_BUFFER))) {
+	perror("malloc()");
+	exit(EXIT_FAILURE);
       }
+      setvbuf(merged_file, obuf, _IOFBF, OUTPUT_BUFFER);
+    }
+    else
+      merged_file = open_output(global_str, &obuf);
 
-      // We must be done.
-      fprintf(stderr,
-	      "Packette_merge: Finished processing all ordered fragments.\n");
+    fprintf(stderr,
+	    "Packette-merge: will do an event ordered merge of %u prefixes (%lu orphans) into %s\n",
+	    num_prefixes,
+	    orphans,
+	    to_stdout ? "stdout" : global_str);
+
+    // Perform the merge
+    index_events = 1;
+    merge_ports(ports, num_prefixes, merged_file);
+    write_table(merged_file);
+
+    // Close streams
+    fclose(merged_file);
+    free(obuf);
+
+    // Summarize
+    for(i = 0; i < num_prefixes; ++i) {
+      ports[i].stats.seconds = now() - start;
+      ports[i].stats.status = MERGE_DONE;
+      report(prefixes[i], &ports[i].stats);
+      merge_close(&ports[i]);
+    }
 
-      //
-      // Check some xedge cases...
-      //
-      
-      // Write out all the remaining orphans
-      // Do a byte difference, not a typed pointer difference
+    fprintf(stderr,
+	    "Packette_merge: wrote %lu events (%.1f MB) to %s in %.2f s\n",
+	    num_events,
+	    merged_offset / 1e6,
+	    to_stdout ? "stdout" : global_str,
+	    now() - start);
 
-      if((char *)ptr - orphans < orphan_size)
-      	fprintf(stderr,
-		"WARNING: %d orphans with sequence number greater than the last ordered fragment exist.\n\tThis should not happen in normal operation, but can happen in various debug scenarios (e.g. abandonment).  Merging them...\n",
-		(orphan_size - ((char *)ptr - orphans)) / BUFSIZE);
+    free(event_table);
+    free(ports);
 
-      while((char *)ptr - orphans < orphan_size) {
+    // Done.
+    fprintf(stderr,
+	    "Packette_merge: Done.\n");
+    exit(0);
+  }
 
-	fprintf(stderr,
-		"Packette_merge: placing orphan %d at sequence position %jd\n",
-		((char *)ptr - orphans) / BUFSIZE,
-		ptr->assembly.seqnum);
+  //
+  // Otherwise, a pool of workers merges each prefix on its own.
+  // Statistics come back through shared memory.
+  //
+  if((stats = (struct merge_stats *)mmap(NULL,
+					 num_prefixes * sizeof(struct merge_stats),
+					 PROT_READ | PROT_WRITE,
+					 MAP_SHARED | MAP_ANONYMOUS,
+					 -1,
+					 0)) == MAP_FAILED) {
+    perror("mmap()");
+    exit(EXIT_FAILURE);
+  }
+  memset(stats, 0, num_prefixes * sizeof(struct merge_stats));
 
-	fwrite(ptr,
-	       sizeof(struct packette_transport) + ptr->channel.num_samples*SAMPLE_WIDTH,
-	       1,
-	       merged_file);
+  if(num_workers > num_prefixes)
+    num_workers = num_prefixes;
+
+  fprintf(stderr,
+	  "Packette-merge: will do ordered merges of %u prefixes with %ld workers\n",
+	  num_prefixes,
+	  num_workers);
 
-	ptr = (struct packette_transport *)((char *)ptr + BUFSIZE);
+  next = running = failed = 0;
+  while(next < num_prefixes || running) {
+
+    // Keep the pool full (unless we've been asked to stop)
+    while(next < num_prefixes && running < num_workers && !interrupt_flag) {
+
+      fflush(stderr);
+      if((pid = fork()) == -1) {
+	perror("fork()");
+	exit(EXIT_FAILURE);
       }
 
-      // End the while(1)
-      break;
-    }
+      if(!pid) {
+	merge_one(prefixes[next], run_bytes, to_stdout, &stats[next]);
+	exit(0);
+      }
 
-    // Look for Ctrl+C
-    if(interrupt_flag) {
+      ++next;
+      ++running;
+    }
 
-      // Finish up and close
-      fprintf(stderr,
-	      "Packette_merge: Caught Ctrl+C, cleaning up....\n");
+    if(!running)
       break;
-    }
+
+    // Wait for someone to finish
+    if(wait(&wstatus) == -1)
+      continue;
+
+    --running;
+    if(!WIFEXITED(wstatus) || WEXITSTATUS(wstatus))
+      ++failed;
   }
 
-  // Close streams
-  fclose(merged_file);
-  fclose(ordered_file);
+  if(interrupt_flag)
+    fprintf(stderr,
+	    "Packette_merge: Caught Ctrl+C, cleaning up....\n");
+
+  // Summarize
+  memset(&total, 0, sizeof(struct merge_stats));
+  for(i = 0; i < num_prefixes; ++i) {
+    report(prefixes[i], &stats[i]);
 
-  // Clean up
-  free(tmp);
-  free(orphans);
+    total.ordered += stats[i].ordered;
+    total.placed += stats[i].placed + stats[i].trailing;
+    total.duplicates += stats[i].duplicates;
+    total.bytes += stats[i].bytes;
+  }
+  total.seconds = now() - start;
+
+  fprintf(stderr,
+	  "Packette_merge: total: %u prefixes, %lu ordered, %lu orphans placed, %lu duplicates dropped, %.1f MB in %.2f s (%.1f MB/s)\n",
+	  num_prefixes,
+	  total.ordered,
+	  total.placed,
+	  total.duplicates,
+	  total.bytes / 1e6,
+	  total.seconds,
+	  total.seconds > 0 ? total.bytes / 1e6 / total.seconds : 0.0);
+
+  munmap(stats, num_prefixes * sizeof(struct merge_stats));
+  for(i = 0; i < num_prefixes; ++i)
+    free(prefixes[i]);
+  free(prefixes);
+
+  if(failed) {
+    fprintf(stderr,
+	    "ERROR: %u merges failed\n", failed);
+    exit(EXIT_FAILURE);
+  }
 
   // Done.
   fprintf(stderr,
@@ -5,13 +5,16 @@
 #
 class pedestal(object):
 
-    def __init__(self, means, rmss, counts):
+    def __init__(self, means, rmss, counts, board_id=None):
 
         # Set up for pedestals
         self.mean = means
         self.rms = rmss
         self.counts = counts
 
+        # MAC of the board these came from (6 bytes)
+        self.board_id = board_id
+
 #import argparse
 #import sys
 
@@ -30,7 +30,10 @@ import os
 import time
 import socket
 import select
-import bisect
+import io
+import json
+import functools
+import heapq
 
 from collections import namedtuple, OrderedDict
 
@@ -54,6 +57,51 @@ field_list = ['board_id',
               'total_samples',
               'drs4_stop']
 
+# Event index format incantation (struct packette_index in packette.h)
+packette_index_format = '6s H I I Q I I Q Q Q'
+
+# Make an encoder
+packette_index = struct.Struct(packette_index_format)
+
+index_field_list = ['board_id',
+                    'reserved',
+                    'event_num',
+                    'trigger_low',
+                    'offset',
+                    'length',
+                    'num_packets',
+                    'first_seqnum',
+                    'last_seqnum',
+                    'channel_mask']
+
+# The same, for numpy (whole tables at once)
+index_dtype = np.dtype([('board_id', 'u1', (6,)),
+                        ('reserved', '<u2'),
+                        ('event_num', '<u4'),
+                        ('trigger_low', '<u4'),
+                        ('offset', '<u8'),
+                        ('length', '<u4'),
+                        ('num_packets', '<u4'),
+                        ('first_seqnum', '<u8'),
+                        ('last_seqnum', '<u8'),
+                        ('channel_mask', '<u8')])
+
+# Globally merged files end in an event table and this footer
+# (struct packette_footer in packette.h)
+packette_footer_format = '8s Q Q'
+packette_footer = struct.Struct(packette_footer_format)
+PACKETTE_FOOTER_MAGIC = b'PKTTIDX1'
+
+# Compressed archives (packette_archive.py) share the footer
+PACKETTE_ARCHIVE_MAGIC = b'PKTTARC1'
+
+# Materialized (dense) runs: magic, then a JSON description padded out to DENSE_HEADER,
+# then page aligned arrays
+PACKETTE_DENSE_MAGIC = b'PKTTDNS1'
+dense_header = struct.Struct('8s Q')
+DENSE_HEADER = 65536
+DENSE_ALIGN = 4096
+
 # Sample width should be defined universally somwhere
 SAMPLE_WIDTH = 2
 NOT_DATA = 0x4
@@ -243,6 +291,9 @@ class packetteChannel(object):
         self.length = len(payload)
         self.masks = []
 
+        # Capacitors to always mask (1024 booleans, capacitor ordering), see packetteRun.maskCapacitors()
+        self.badCapacitors = None
+
         # Now, make a full array view for fast access
         self.cachedView = np.full([1024], NOT_DATA, dtype=np.int16) 
 
@@ -418,6 +469,14 @@ class packetteChannel(object):
         for low,high in self.masks:
             self.cachedView[low:high] = MASKED_DATA
 
+        # And mask the bad capacitors, wherever they have data
+        if self.badCapacitors is not None:
+            bad = np.flatnonzero(self.badCapacitors)
+            if not self.property_stash.SCAView:
+                bad = (bad - self.drs4_stop) % 1024
+            bad = bad[self.cachedView[bad] != NOT_DATA]
+            self.cachedView[bad] = MASKED_DATA
+
         # Now always pull from cache
         self.cacheValid = True
 
@@ -430,7 +489,11 @@ class packetteEvent(object):
         self.property_stash = property_stash
         self.event_num = header['event_num']
         self.trigger_low = header['trigger_low']
+        self.board_id = header.get('board_id', property_stash.board_id)
         
+        # This board's bad capacitors, if any are known (a (64 x 1024) boolean array)
+        masks = getattr(property_stash, 'capacitor_masks', {})
+        bad = masks.get(bytes(self.board_id) if self.board_id is not None else None, masks.get(None))
         
         # For every channel thats on in the mask, make a dictionary entry to it
         chan = 0
@@ -440,13 +503,15 @@ class packetteEvent(object):
 
             if chanmask & 0x1:
                 self.channels[chan] = packetteChannel(0, np.empty([0], dtype=np.int16), self.property_stash)
+                if bad is not None:
+                    self.channels[chan].badCapacitors = bad[chan]
 
             # Advance to the next place in the mask
             chanmask >>= 1
             chan += 1
 
     def prettyid(self):
-        return ':'.join(self.property_stash.board_id.hex()[i:i+2] for i in range(0,12,2))
+        return prettyBoard(self.board_id)
     
     def __str__(self):
         board_id = self.prettyid()
@@ -480,19 +545,66 @@ class packetteEvent(object):
 class Blank(object):
     pass
 
+# Board MAC addresses as aa:bb:cc:dd:ee:ff
+def prettyBoard(board_id):
+    return ':'.join(board_id.hex()[i:i+2] for i in range(0,12,2))
+
+# Board MAC addresses, (n, 6) bytes, as integers
+def boardNumbers(boards):
+    padded = np.zeros([len(boards), 8], dtype=np.uint8)
+    padded[:,2:] = boards
+    return padded.view('>u8').ravel()
+
+# Which channel masks have any of the given channels (or any channel at all)
+def hasAny(masks, chans=None):
+    if chans is None:
+        return masks != 0
+    want = np.uint64(sum(1 << chan for chan in set(chans)))
+    return (masks & want) != 0
+
 class packetteRun(object):
 
     # Initialize and load the files
     def __init__(self, fnames, SCAView=False, streaming=False):
 
-        self.orderedEventList = []
-        self.offsetTable = OrderedDict()
         self.eventCache = OrderedDict()
 
+        #
+        # The event index is a set of parallel arrays, sorted by board and then event number:
+        # where each event starts (file handle and byte offset), and which channels
+        # it carries and its trigger_low (from the headers, so without decoding).
+        # Rows are keyed by (board handle << 32) | event_num, where board handles number
+        # the boards in the order they were first seen.
+        # New events are staged, and merged in once per parse by commitEvents().
+        #
+        self.indexKeys = np.empty(0, dtype=np.int64)
+        self.indexBoards = np.empty(0, dtype=np.int64)
+        self.indexEvents = np.empty(0, dtype=np.int64)
+        self.indexFiles = np.empty(0, dtype=np.int32)
+        self.indexOffsets = np.empty(0, dtype=np.int64)
+        self.indexMasks = np.empty(0, dtype=np.uint64)
+        self.indexTimes = np.empty(0, dtype=np.uint32)
+
+        # Unwrapped trigger timelines, by board handle (built as needed, see timeline())
+        self.timelines = {}
+
+        # If keys are contiguous, an event's row is just key - indexBase
+        self.indexBase = None
+
+        # Board identifiers, by board handle
+        self.boards = []
+        self.boardHandles = {}
+
+        self.stagedRows = []
+        self.stagedArrays = []
+
         # So that we can pass some things with "by reference" semantics
         self.property_stash = Blank()
         self.property_stash.SCAView = SCAView
         self.property_stash.board_id = None
+
+        # Bad capacitors, by board_id (None for every board without its own)
+        self.property_stash.capacitor_masks = {}
          
         # We usually expect lists.  If its a one off, check for special conditions.
         # If not, wrap it in a list
@@ -603,6 +715,18 @@ class packetteRun(object):
         # (used to update the index on the fly)
         self.fp_indexed = { n : 0 for n in range(len(fnames))}
 
+        # If packette wrote an event index alongside an ordered stream (packette -i),
+        # we use that instead of walking the stream ourselves
+        self.index_consumed = {}
+        self.openIndices()
+
+        # Files merged by packette_merge -g carry their own event table,
+        # and packet data stops where it begins
+        self.fp_limit = {}
+
+        # Archives map file handles to their block codec
+        self.archives = {}
+
         # 
         # UUU Need to save state to index files, so you don't need to rebuild the
         # index every time.
@@ -618,9 +742,20 @@ class packetteRun(object):
             # os.fsync(fp.fileno())
 
             # Send it the 0 index, since this is the first time we are building the index
-            # parseOffsets mutates the offsetTable directly
-            self.parseOffsets(fp, fhandle, 0)
-            print("packette_stream.py: built event index for %s" % fnames[fhandle], file=sys.stderr)
+            # parseOffsets adds to the index directly
+            if self.parseFooter(fhandle):
+                print("packette_stream.py: loaded embedded event table from %s" % fnames[fhandle], file=sys.stderr)
+            elif fhandle in self.index_fps:
+                self.parseIndex(fhandle)
+                print("packette_stream.py: loaded event index for %s" % fnames[fhandle], file=sys.stderr)
+            else:
+                self.parseOffsets(fp, fhandle, 0)
+                print("packette_stream.py: built event index for %s" % fnames[fhandle], file=sys.stderr)
+
+        # If the run was materialized (and hasn't changed since), serve events from that
+        self.dense = None
+        if self.openDense():
+            print("packette_stream.py: serving events from materialized run %s" % self.denseName(), file=sys.stderr)
 
     # In streaming mode, give a recent event off the deque
     def popEvent(self, timeout=None):
@@ -638,8 +773,12 @@ class packetteRun(object):
         # Lookups can then be done by seeking in the underlying stream
         # Start loading in event data
         prev_event_num = -1
+        prev_board = None
         neweventcnt = 0
 
+        # When following a growing stream, we may pick up partway through an event
+        resuming = index > 0
+
         #offsetTable = {}
 
         # Yikes, forgot to do the initial seek
@@ -659,34 +798,26 @@ class packetteRun(object):
             # Unpack it and make a dictionary out of it
             header = dict(zip(field_list, packette_transport.unpack(header)))
 
-            # Are we looking at the same board?
-            if self.property_stash.board_id is None:
-                self.property_stash.board_id = header['board_id']
-            elif not self.property_stash.board_id == header['board_id']:
-                print("packette_stream.py: Expecting %s but just read %s..." % (self.property_stash.board_id, header['board_id']), file=sys.stderr)
-                
-                raise Exception("ERROR: Heterogenous board identifiers in multifile event stream.\n " \
-                                "\tOutput from different boards should be directed to\n " \
-                                "\tdistinct packette instances on disjoint port ranges")
+            # Which board is this?
+            board = self.addBoard(header['board_id'])
 
             # This logic is being weird.  Be explicit.
-            if index == packette_transport.size or prev_event_num < header['event_num']:
+            # (In merged multi-board files, boards take turns within an event number)
+            if index == packette_transport.size or not board == prev_board or prev_event_num < header['event_num']:
 
-                # Sanity check
-                if header['event_num'] in self.offsetTable:
-                    raise Exception("Event number collision!", header['event_num'], (fhandle, index - packette_transport.size))
-                
-                # Return a tuple with the stream and the byte position within the stream
-                self.offsetTable[header['event_num']] = (fhandle, index - packette_transport.size)
+                # (Unless it's the rest of an event we've already got)
+                if not (resuming and self.hasEvent(header['event_num'], board)):
 
-                # Do an event-number sorted insertion
-                bisect.insort(self.orderedEventList, header['event_num'])
+                    # Return a tuple with the stream and the byte position within the stream
+                    self.addEvent(header['event_num'], fhandle, index - packette_transport.size, header['channel_mask'], board, header['trigger_low'])
+
+                    # Count
+                    neweventcnt += 1
 
                 # Keep track that we've passed an event boundary
                 prev_event_num = header['event_num']
-
-                # Count
-                neweventcnt += 1
+                prev_board = board
+                resuming = False
                 
             # Increment the index by the size of this packet's payload
             index += header['num_samples'] * SAMPLE_WIDTH
@@ -697,12 +828,412 @@ class packetteRun(object):
         # Set the most recently successful read
         self.fp_indexed[fhandle] = index
 
+        self.commitEvents()
+
         # Return it
         return neweventcnt
     
+    # Find companion indices for ordered streams
+    def openIndices(self):
+        self.index_fps = {}
+        for n,f in enumerate(self.fnames):
+            root, ext = os.path.splitext(f)
+            if ext == '.ordered' and os.path.exists(root + '.index'):
+                self.index_fps[n] = open(root + '.index', 'rb')
+                self.index_consumed.setdefault(n, 0)
+
+    #
+    # Loads events from an index written by packette alongside the stream.
+    # Only whole records are consumed, so this is safe to call on an index
+    # that is still being written.  Events appear once they are complete.
+    #
+    def parseIndex(self, fhandle):
+        fp = self.index_fps[fhandle]
+
+        # Take everything past what we've already seen, leaving any partial record
+        fp.seek(self.index_consumed[fhandle])
+        data = fp.read()
+        usable = len(data) - len(data) % packette_index.size
+
+        # packette may be holding stream data in a large write buffer,
+        # so the index can get ahead of what's actually on disk
+        available = os.fstat(self.fps[fhandle].fileno()).st_size
+
+        records = np.frombuffer(data, dtype=index_dtype, count=usable // packette_index.size)
+        ends = records['offset'] + records['length']
+
+        # Leave anything not yet on disk for the next update
+        late = np.flatnonzero(ends > available)
+        if len(late):
+            records = records[:late[0]]
+            ends = ends[:late[0]]
+
+        neweventcnt = len(records)
+        if not neweventcnt:
+            return 0
+
+        self.addRecords(records, fhandle)
+        self.index_consumed[fhandle] += neweventcnt * packette_index.size
+
+        # The stream is known good up to the end of the last event
+        self.fp_indexed[fhandle] = int(ends[-1])
+
+        return neweventcnt
+
+    #
+    # Loads the event table appended by packette_merge -g.
+    # These files are finished, so they never need updating.
+    #
+    def parseFooter(self, fhandle):
+        fp = self.fps[fhandle]
+        size = os.fstat(fp.fileno()).st_size
+
+        if size < packette_footer.size:
+            return False
+
+        fp.seek(size - packette_footer.size)
+        magic, table_offset, num_events = packette_footer.unpack(fp.read(packette_footer.size))
+
+        # Make sure it's really a footer
+        if not (magic in (PACKETTE_FOOTER_MAGIC, PACKETTE_ARCHIVE_MAGIC)
+                and table_offset + num_events*packette_index.size + packette_footer.size == size):
+            return False
+
+        fp.seek(table_offset)
+        self.addRecords(np.frombuffer(fp.read(num_events*packette_index.size), dtype=index_dtype), fhandle)
+
+        # Events in archives are compressed blocks
+        if magic == PACKETTE_ARCHIVE_MAGIC:
+            import packette_archive
+            fp.seek(0)
+            self.archives[fhandle] = packette_archive.archive_header.unpack(fp.read(packette_archive.archive_header.size))[1].rstrip(b'\0').decode()
+
+            if not self.archives[fhandle] in packette_archive.codecs:
+                raise Exception("%s needs the %s codec, which is not installed" % (self.fnames[fhandle], self.archives[fhandle]))
+
+        self.fp_indexed[fhandle] = table_offset
+        self.fp_limit[fhandle] = table_offset
+        return True
+
+    # Boards get handles in the order they are first seen
+    def addBoard(self, board_id):
+        try:
+            return self.boardHandles[board_id]
+        except KeyError:
+            pass
+
+        handle = len(self.boards)
+        self.boards.append(board_id)
+        self.boardHandles[board_id] = handle
+
+        # Single board callers look here
+        if self.property_stash.board_id is None:
+            self.property_stash.board_id = board_id
+        else:
+            print("packette_stream.py: run also contains board %s" % prettyBoard(board_id), file=sys.stderr)
+
+        return handle
+
+    # Resolve a board (handle, board_id bytes, or 'xx:xx:xx:xx:xx:xx') to its handle
+    # Without one, the run must be single board.
+    def boardHandle(self, board=None):
+        if board is None:
+            if len(self.boards) > 1:
+                raise Exception("Run contains %d boards, specify one (e.g. run[board_id, event_num] or run.board(board_id))" % len(self.boards))
+            return 0
+
+        if isinstance(board, (int, np.integer)):
+            if not 0 <= board < max(len(self.boards), 1):
+                raise KeyError(board)
+            return int(board)
+
+        if isinstance(board, str):
+            board = bytes.fromhex(board.replace(':', ''))
+
+        return self.boardHandles[bytes(board)]
+
+    # Board identifiers, in handle order
+    def getBoards(self):
+        return list(self.boards)
+
+    # Record where an event starts (staged until commitEvents())
+    def addEvent(self, event_num, fhandle, offset, channel_mask=0, board=0, trigger_low=0):
+        self.stagedRows.append(((board << 32) | event_num, fhandle, offset, channel_mask, trigger_low))
+
+    # Stage a whole table of struct packette_index records, and commit them
+    def addRecords(self, records, fhandle):
+
+        handles = np.zeros(len(records), dtype=np.int64)
+
+        # Which boards?  (Usually there's just one, so check for that first)
+        if len(records):
+            boards = records['board_id']
+            macs = boardNumbers(boards)
+            handles[:] = self.addBoard(bytes(boards[0]))
+
+            if not (macs == macs[0]).all():
+                found, first, inverse = np.unique(macs, return_index=True, return_inverse=True)
+                lookup = np.empty(len(found), dtype=np.int64)
+
+                # Hand out new handles in file order
+                for k in np.argsort(first):
+                    lookup[k] = self.addBoard(bytes(boards[first[k]]))
+                handles = lookup[inverse.ravel()]
+
+        self.stagedArrays.append(((handles << 32) | records['event_num'].astype(np.int64),
+                                  np.full(len(records), fhandle, dtype=np.int32),
+                                  records['offset'].astype(np.int64),
+                                  records['channel_mask'],
+                                  records['trigger_low']))
+        self.commitEvents()
+
+    #
+    # Merge staged events into the index, sorting once
+    #
+    def commitEvents(self):
+
+        if self.stagedRows:
+            rows = np.array(self.stagedRows, dtype=np.uint64).T
+            self.stagedArrays.append((rows[0].astype(np.int64),
+                                      rows[1].astype(np.int32),
+                                      rows[2].astype(np.int64),
+                                      rows[3],
+                                      rows[4].astype(np.uint32)))
+            self.stagedRows = []
+
+        if not self.stagedArrays:
+            return
+
+        keys, files, offsets, masks, times = (np.concatenate(column) for column in zip((self.indexKeys,
+                                                                                         self.indexFiles,
+                                                                                         self.indexOffsets,
+                                                                                         self.indexMasks,
+                                                                                         self.indexTimes),
+                                                                                        *self.stagedArrays))
+        self.stagedArrays = []
+
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+
+        # Sanity check
+        collisions = np.flatnonzero(keys[1:] == keys[:-1])
+        if len(collisions):
+            row = order[collisions[0] + 1]
+            key = int(keys[collisions[0]])
+            raise Exception("Event number collision!", prettyBoard(self.boards[key >> 32]), key & 0xFFFFFFFF, (int(files[row]), int(offsets[row])))
+
+        self.indexKeys = keys
+        self.indexBoards = keys >> 32
+        self.indexEvents = keys & 0xFFFFFFFF
+        self.indexFiles = files[order]
+        self.indexOffsets = offsets[order]
+        self.indexMasks = masks[order]
+        self.indexTimes = times[order]
+        self.timelines = {}
+
+        # Contiguous keys can be looked up directly
+        if len(keys) and keys[-1] - keys[0] + 1 == len(keys):
+            self.indexBase = int(keys[0])
+        else:
+            self.indexBase = None
+
+    # Row of an event in the index
+    def eventRow(self, event_num, board=None):
+        key = (self.boardHandle(board) << 32) | event_num
+
+        if self.indexBase is not None:
+            row = key - self.indexBase
+            if 0 <= row < len(self.indexKeys):
+                return row
+        else:
+            row = np.searchsorted(self.indexKeys, key)
+            if row < len(self.indexKeys) and self.indexKeys[row] == key:
+                return row
+
+        raise KeyError(event_num if board is None else (board, event_num))
+
+    # Whether an event is in the index
+    def hasEvent(self, event_num, board=None):
+        try:
+            self.eventRow(event_num, board)
+            return True
+        except KeyError:
+            return False
+
+    # Where an event starts: (file handle, byte offset)
+    def eventOffset(self, event_num, board=None):
+        row = self.eventRow(event_num, board)
+        return (int(self.indexFiles[row]), int(self.indexOffsets[row]))
+
+    # Which channels an event carries
+    def channelMask(self, event_num, board=None):
+        return int(self.indexMasks[self.eventRow(event_num, board)])
+
+    # The index rows of one board (or all of them)
+    def boardRows(self, board=None):
+        if board is None:
+            return (0, len(self.indexKeys))
+        handle = self.boardHandle(board)
+        lo, hi = np.searchsorted(self.indexKeys, [handle << 32, (handle + 1) << 32])
+        return (int(lo), int(hi))
+
     # An accessor method to hide the variable
+    # (Sorted by event number.  This is replaced, not extended, when the index grows.)
+    # With several boards, these are the event numbers seen on any of them.
     def getArrivalOrderedEventNumbers(self):
-        return self.orderedEventList
+        if len(self.boards) > 1:
+            return np.unique(self.indexEvents)
+        return self.indexEvents
+
+    # Event numbers and their channel masks as parallel arrays, in event order.
+    # (Without a board, these are per board, one board after the other)
+    def channelMaskArray(self, board=None):
+        lo, hi = self.boardRows(board)
+        return (self.indexEvents[lo:hi], self.indexMasks[lo:hi])
+
+    # Events in which a channel is present
+    def eventsWithChannel(self, chan, board=None):
+        return self.eventsWithAny([chan], board)
+
+    # Events in which any of the given channels are present
+    # (With no channels, events with any channel at all)
+    def eventsWithAny(self, chans=None, board=None):
+        events, masks = self.channelMaskArray(board)
+        return events[hasAny(masks, chans)]
+
+    # Events in which all of the given channels are present
+    def eventsWithAll(self, chans, board=None):
+        events, masks = self.channelMaskArray(board)
+        want = np.uint64(sum(1 << chan for chan in set(chans)))
+        return events[(masks & want) == want]
+
+    # Iterate over only the events carrying any of the given channels
+    # (Empty events are skipped without being read)
+    def sparseIter(self, chans=None, board=None):
+        lo, hi = self.boardRows(board)
+        for row in lo + np.flatnonzero(hasAny(self.indexMasks[lo:hi], chans)):
+            yield self.loadEvent(int(self.indexEvents[row]), int(self.indexBoards[row]))
+
+    # One board's events, as a run of their own (sharing this run's index and cache)
+    def board(self, board):
+        return packetteBoardRun(self, board)
+
+    # All the boards' runs, in handle order
+    def subRuns(self):
+        return [packetteBoardRun(self, handle) for handle in range(len(self.boards))]
+
+    # Event numbers seen on every one of the given boards (default: all of them)
+    def alignedEventNumbers(self, boards=None):
+        handles = range(len(self.boards)) if boards is None else [self.boardHandle(b) for b in boards]
+        return functools.reduce(np.intersect1d, [self.channelMaskArray(h)[0] for h in handles])
+
+    # Iterate over events seen on every one of the given boards (default: all of them),
+    # yielding { board_id : event } for each event number
+    def alignedIter(self, boards=None):
+        handles = range(len(self.boards)) if boards is None else [self.boardHandle(b) for b in boards]
+        for event_num in self.alignedEventNumbers(handles):
+            yield {self.boards[h] : self.loadEvent(int(event_num), h) for h in handles}
+
+    #
+    # Trigger timelines
+    #
+    # trigger_low is the low 32 bits of the board's trigger clock, so it rolls over.
+    # In event number order it should only increase, so every step backwards
+    # (by more than half the range) is taken to be a rollover.
+    # (A gap in event numbers spanning a whole rollover can't be seen.)
+    #
+    # A board's timeline is (event numbers, 64 bit times) in time order.
+    #
+    def timeline(self, board=None):
+        return self.unwrapTimes(board)[:2]
+
+    # (Also keeps the times in index order, for single lookups)
+    def unwrapTimes(self, board=None):
+        handle = self.boardHandle(board)
+        try:
+            return self.timelines[handle]
+        except KeyError:
+            pass
+
+        lo, hi = self.boardRows(handle)
+        times = self.indexTimes[lo:hi].astype(np.int64)
+        rollovers = np.cumsum(np.diff(times) < -(1 << 31))
+        times[1:] += rollovers << 32
+
+        # Should already be in order, but make sure
+        order = np.argsort(times, kind='stable')
+        self.timelines[handle] = (self.indexEvents[lo:hi][order], times[order], times)
+        return self.timelines[handle]
+
+    # Unwrapped trigger time of an event
+    def triggerTime(self, event_num, board=None):
+        handle = self.boardHandle(board)
+        row = self.eventRow(event_num, handle)
+        return int(self.unwrapTimes(handle)[2][row - self.boardRows(handle)[0]])
+
+    # Events triggered in [start, stop), in time order
+    def eventsInWindow(self, start, stop, board=None):
+        events, times = self.timeline(board)
+        lo, hi = np.searchsorted(times, [start, stop])
+        return events[lo:hi]
+
+    # Merge the timelines of the given boards (default: all of them).
+    # Returns parallel arrays (times, board handles, event numbers), in time order.
+    def timeOrder(self, boards=None):
+        handles = range(len(self.boards)) if boards is None else [self.boardHandle(b) for b in boards]
+        lines = [self.timeline(h) for h in handles]
+        times = np.concatenate([t for e, t in lines] + [np.empty(0, dtype=np.int64)])
+        which = np.concatenate([np.full(len(e), h, dtype=np.int64) for h, (e, t) in zip(handles, lines)] + [np.empty(0, dtype=np.int64)])
+        events = np.concatenate([e for e, t in lines] + [np.empty(0, dtype=np.int64)])
+        order = np.argsort(times, kind='stable')
+        return (times[order], which[order], events[order])
+
+    # Iterate over events from the given boards (default: all of them) in trigger time order,
+    # optionally only within [start, stop).  Yields (time, event).
+    def timeOrderedIter(self, boards=None, start=None, stop=None):
+        handles = range(len(self.boards)) if boards is None else [self.boardHandle(b) for b in boards]
+
+        def stream(handle):
+            events, times = self.timeline(handle)
+            lo = 0 if start is None else np.searchsorted(times, start)
+            hi = len(times) if stop is None else np.searchsorted(times, stop)
+            for k in range(lo, hi):
+                yield (int(times[k]), handle, int(events[k]))
+
+        for time, handle, event_num in heapq.merge(*[stream(h) for h in handles]):
+            yield (time, self.loadEvent(event_num, handle))
+
+    #
+    # Coincidences: events from different boards whose trigger times chain together
+    # within window (clock ticks) of each other.  Every cluster seen on at least
+    # min_boards of the given boards (default: all of them) is returned as
+    # { board_id : event_num } (the first event from each board).
+    #
+    # Board clocks must share an origin for this to mean anything.
+    #
+    def coincidences(self, window, boards=None, min_boards=None):
+        handles = range(len(self.boards)) if boards is None else [self.boardHandle(b) for b in boards]
+        if min_boards is None:
+            min_boards = len(handles)
+
+        times, which, events = self.timeOrder(handles)
+        if not len(times):
+            return []
+
+        # Clusters break wherever consecutive triggers are further apart than the window
+        cluster = np.concatenate(([0], np.cumsum(np.diff(times) > window)))
+
+        # First event of each board in each cluster (in cluster, then board, order)
+        firsts = np.unique(cluster * len(self.boards) + which, return_index=True)[1]
+
+        # Clusters with enough boards
+        counts = np.bincount(cluster[firsts])
+        firsts = firsts[counts[cluster[firsts]] >= min_boards]
+
+        found = {}
+        for k in firsts:
+            found.setdefault(int(cluster[k]), {})[self.boards[which[k]]] = int(events[k])
+        return list(found.values())
     
     # Time ordered views return capacitor DRS4_STOP when requesting index 0
     # Capacitor ordered views return capacitor 0 when requesting index 0
@@ -729,21 +1260,205 @@ class packetteRun(object):
                 chan.buildCache()
 
         # (subsequently added events will automatically be channel cached correctly)
+
+    # Mask bad capacitors (e.g. from pedestal_qa.py), so their samples read as MASKED_DATA.
+    # mask is (64 x 1024) booleans in capacitor ordering, or None to stop masking.
+    # Without a board, it applies to every board that doesn't have its own.
+    def maskCapacitors(self, mask, board=None):
+
+        if board is not None:
+            board = self.boards[self.boardHandle(board)]
+
+        if mask is None:
+            self.property_stash.capacitor_masks.pop(board, None)
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            if not mask.shape == (64, 1024):
+                raise ValueError("Capacitor masks are (64 x 1024), not %s" % (mask.shape,))
+            self.property_stash.capacitor_masks[board] = mask
+
+        # Rebuild the cached events
+        masks = self.property_stash.capacitor_masks
+        for event in self.eventCache.values():
+            bad = masks.get(bytes(event.board_id) if event.board_id is not None else None, masks.get(None))
+            for chan, data in event.channels.items():
+                data.badCapacitors = None if bad is None else bad[chan]
+                data.buildCache()
             
+    # Where a materialized copy of this run lives
+    def denseName(self):
+        return self.fnames[0] + '.dense'
+
+    # Identifies the backing files, so stale materializations are ignored
+    def sourceKeys(self):
+        keys = []
+        for f in self.fnames:
+            st = os.stat(f)
+            keys.append([os.path.abspath(f), st.st_size, st.st_mtime_ns])
+        return keys
+
+    #
+    # Write the whole run out as dense (events x 64 x 1024) int16 samples,
+    # with side arrays, so that later passes can just map it.
+    # Samples are payloads as received (time ordering), padded with NOT_DATA.
+    #
+    def materialize(self, fname=None):
+        if fname is None:
+            fname = self.denseName()
+
+        events = self.indexEvents
+        n = len(events)
+
+        layout = [('board_id', 'u1', (n, 6)),
+                  ('event_num', '<u4', (n,)),
+                  ('trigger_low', '<u4', (n,)),
+                  ('channel_mask', '<u8', (n,)),
+                  ('drs4_stop', '<u2', (n, 64)),
+                  ('length', '<u2', (n, 64)),
+                  ('samples', '<i2', (n, 64, 1024))]
+
+        # Lay out the arrays
+        meta = {'sources' : self.sourceKeys(), 'arrays' : {}}
+        offset = DENSE_HEADER
+        for name, dtype, shape in layout:
+            meta['arrays'][name] = [offset, dtype, shape]
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+            offset += -offset % DENSE_ALIGN
+
+        description = json.dumps(meta).encode()
+        if dense_header.size + len(description) > DENSE_HEADER:
+            raise Exception("Too many backing files to materialize this run")
+
+        # Write somewhere else first, so readers never see half a file
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(dense_header.pack(PACKETTE_DENSE_MAGIC, len(description)) + description)
+            f.truncate(offset)
+
+        arrays = {name : np.memmap(tmpname, dtype=dtype, mode='r+', offset=start, shape=tuple(shape))
+                  for name, (start, dtype, shape) in meta['arrays'].items()}
+
+        # Never serve from an old materialization while making a new one
+        self.dense = None
+
+        arrays['event_num'][:] = events
+        arrays['channel_mask'][:] = self.indexMasks
+        for handle, board_id in enumerate(self.boards):
+            arrays['board_id'][self.indexBoards == handle] = np.frombuffer(board_id, dtype=np.uint8)
+
+        for row, (event_num, board) in enumerate(zip(events, self.indexBoards)):
+            event = self.loadEvent(int(event_num), int(board))
+
+            arrays['trigger_low'][row] = event.trigger_low
+            arrays['samples'][row] = NOT_DATA
+
+            for chan, data in event.channels.items():
+                arrays['drs4_stop'][row, chan] = data.drs4_stop
+                arrays['length'][row, chan] = data.length
+                arrays['samples'][row, chan, :data.length] = data.payload
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        os.replace(tmpname, fname)
+        print("packette_stream.py: materialized %d events into %s" % (n, fname), file=sys.stderr)
+
+        self.openDense(fname)
+        return fname
+
+    #
+    # Map a materialized run, if it exists and matches the backing files
+    #
+    def openDense(self, fname=None):
+        if fname is None:
+            fname = self.denseName()
+
+        try:
+            with open(fname, 'rb') as f:
+                magic, length = dense_header.unpack(f.read(dense_header.size))
+                if not magic == PACKETTE_DENSE_MAGIC:
+                    return False
+                meta = json.loads(f.read(length))
+        except (FileNotFoundError, struct.error, ValueError):
+            return False
+
+        if not meta['sources'] == self.sourceKeys() or 'board_id' not in meta['arrays']:
+            print("packette_stream.py: %s is stale, ignoring it" % fname, file=sys.stderr)
+            return False
+
+        self.dense = {name : np.memmap(fname, dtype=dtype, mode='r', offset=start, shape=tuple(shape))
+                      for name, (start, dtype, shape) in meta['arrays'].items()}
+        return True
+
+    # Whether an index row is materialized (the materialized run is in index order,
+    # unless the index has grown since)
+    def denseRow(self, row):
+        if self.dense is None or row >= len(self.dense['event_num']):
+            return None
+        if (self.dense['event_num'][row] == self.indexEvents[row]
+            and bytes(self.dense['board_id'][row]) == self.boards[self.indexBoards[row]]):
+            return row
+        return None
+
+    # The materialized arrays themselves (or None), for vectorized analysis
+    def getMaterialized(self):
+        return self.dense
+
+    # Build an event whose payloads are views into the materialized run
+    def loadDenseEvent(self, row):
+        header = {'board_id' : bytes(self.dense['board_id'][row]),
+                  'event_num' : int(self.dense['event_num'][row]),
+                  'trigger_low' : int(self.dense['trigger_low'][row]),
+                  'channel_mask' : int(self.dense['channel_mask'][row])}
+        event = packetteEvent(header, self.property_stash)
+
+        for chan, data in event.channels.items():
+            data.drs4_stop = int(self.dense['drs4_stop'][row, chan])
+            data.length = int(self.dense['length'][row, chan])
+
+            # No copy
+            data.payload = self.dense['samples'][row, chan, :data.length]
+
+            # Add a 5 sample symmetric mask around the stop sample
+            maskWidth = 15
+            if self.property_stash.SCAView:
+                data.mask(data.drs4_stop - maskWidth, data.drs4_stop + maskWidth)
+            else:
+                data.mask(-maskWidth, maskWidth)
+
+            data.buildCache()
+
+        return event
+
     # Load events from files
-    def loadEvent(self, event_num):
+    # (board is only needed when the run has several)
+    def loadEvent(self, event_num, board=None):
+
+        board = self.boardHandle(board)
 
         # First check cache
         try:
-            return self.eventCache[event_num]
+            return self.eventCache[(board, event_num)]
         except KeyError as e:
             # Wasn't in there
             # print("DEBUG (packette_stream.py): cache MISS on event #", event_num, file=sys.stderr)
             pass
 
-        
         # Table lookup
-        fhandle, offset = self.offsetTable[event_num]
+        row = self.eventRow(event_num, board)
+
+        # Materialized?
+        if self.denseRow(row) is not None:
+            event = self.loadDenseEvent(row)
+
+            self.eventCache[(board, event_num)] = event
+            if len(self.eventCache) > EVENT_CACHE_LENGTH:
+                self.eventCache.popitem(last=False)
+
+            return event
+
+        fhandle, offset = int(self.indexFiles[row]), int(self.indexOffsets[row])
 
         # Now get the fp
         try:
@@ -756,9 +1471,22 @@ class packetteRun(object):
 
         event = None
         
+        # Where the packet data ends (if we know)
+        limit = self.fp_limit.get(fhandle)
+
+        # Archived events are decoded into memory, and read from there
+        if fhandle in self.archives:
+            import packette_archive
+            fp = io.BytesIO(packette_archive.readBlock(fp, self.archives[fhandle]))
+            limit = None
+        
         # Load up the event
         while True:
 
+            # Don't wander into an embedded event table
+            if limit is not None and fp.tell() >= limit:
+                break
+
             # Grab a header
             # To make sure we get binary if stdin is given
             # use the underlying buffer
@@ -776,10 +1504,11 @@ class packetteRun(object):
             if event is None:
                 # Remember where we are at
                 prev_event_num = header['event_num']
+                prev_board = header['board_id']
                 event = packetteEvent(header, self.property_stash)
             
-            # If we've read past the event, return the completed event
-            if prev_event_num < header['event_num']:
+            # If we've read past the event (or into another board's), return the completed event
+            if prev_event_num < header['event_num'] or not prev_board == header['board_id']:
                 break
             
             # Check to see if this channel is actually in the mask
@@ -835,7 +1564,7 @@ class packetteRun(object):
             data.buildCache()
             
         # Add this event to the event cache, removing something if necessary
-        self.eventCache[event.event_num] = event
+        self.eventCache[(board, event_num)] = event
 
         if len(self.eventCache) > EVENT_CACHE_LENGTH:
             # Get rid of the oldest thing in the cache
@@ -845,31 +1574,41 @@ class packetteRun(object):
         return event
 
     # Implement this as a dictionary for fast accesses
+    # (run[event_num], or run[board_id, event_num] for multi-board runs)
     def __getitem__(self, eventnum):
+        if isinstance(eventnum, tuple):
+            board, eventnum = eventnum
+            return self.loadEvent(eventnum, board)
         return self.loadEvent(eventnum)
 
     # For underlying streams that are growing, we can update the index
-    def updateIndex(self):
+    # (verbose=False for frequent polling)
+    def updateIndex(self, verbose=True):
         start = time.time()
         neweventcnt = 0
         
         # Start parsing offsets at the last successful spot
         for fhandle,fp in self.fps.items():
-            print("packette_stream.py: syncing OS buffers for %s..." % self.fnames[fhandle],
-                  file=sys.stderr)
 
-            # Didn't seem to work...
-            # Make sure we get the most recent jazz
-            os.fsync(fp.fileno())
+            # Merged files are already complete
+            if fhandle in self.fp_limit:
+                continue
+            
+            # (No need to fsync: reads see the page cache, and syncing a file
+            #  packette is busy writing only slows it down)
 
             # Force a seek to the end
             fp.seek(0,2)
             
-            print("packette_stream.py: resuming indexing of %s at byte position %d..." % (self.fnames[fhandle], self.fp_indexed[fhandle]),
-                  file=sys.stderr)
+            if verbose:
+                print("packette_stream.py: resuming indexing of %s at byte position %d..." % (self.fnames[fhandle], self.fp_indexed[fhandle]),
+                      file=sys.stderr)
 
             # This will seek from where we previously left off
-            neweventcnt += self.parseOffsets(fp, fhandle, self.fp_indexed[fhandle])
+            if fhandle in self.index_fps:
+                neweventcnt += self.parseIndex(fhandle)
+            else:
+                neweventcnt += self.parseOffsets(fp, fhandle, self.fp_indexed[fhandle])
 
         stop = time.time()
 
@@ -880,6 +1619,10 @@ class packetteRun(object):
     def __getstate__(self):
         state = self.__dict__.copy()
         del state['fps']
+        del state['index_fps']
+
+        # Mappings get reopened, not copied
+        state['dense'] = None
         return state
 
     def __setstate__(self, state):
@@ -891,6 +1634,11 @@ class packetteRun(object):
             for fname in self.fnames:
                 self.fps = {n : open(f, 'rb') for n,f in enumerate(self.fnames)}
                 print("\t%s" % fname,file=sys.stderr)
+
+            # Pick the indices back up where we left off
+            self.openIndices()
+
+            self.openDense()
                 
         except FileNotFoundError as e:
             print("packette_stream.py: could not find one of the given files", file=sys.stderr)
@@ -902,13 +1650,76 @@ class packetteRun(object):
         print("packette_stream.py: after update, run contains %d events" % len(self), file=sys.stderr)
         
     # Return the total number of events described by this run
+    # (With several boards, each board's events count separately)
     def __len__(self):
-        return len(self.offsetTable)
+        return len(self.indexKeys)
 
     # An iterator to support list-like interaction
+    # (With several boards, one board after the other)
+    def __iter__(self):
+        for event_num, board in zip(self.indexEvents, self.indexBoards):
+            yield self.loadEvent(int(event_num), int(board))
+
+#
+# One board's events within a multi-board run.
+# This is a view: the index and event cache belong to the parent run.
+#
+class packetteBoardRun(object):
+
+    def __init__(self, run, board):
+        self.run = run
+        self.board = run.boardHandle(board)
+        self.board_id = run.boards[self.board]
+
+    def loadEvent(self, event_num):
+        return self.run.loadEvent(event_num, self.board)
+
+    def __getitem__(self, eventnum):
+        return self.loadEvent(eventnum)
+
+    def getArrivalOrderedEventNumbers(self):
+        return self.run.channelMaskArray(self.board)[0]
+
+    def channelMask(self, event_num):
+        return self.run.channelMask(event_num, self.board)
+
+    def channelMaskArray(self):
+        return self.run.channelMaskArray(self.board)
+
+    def eventsWithChannel(self, chan):
+        return self.run.eventsWithChannel(chan, self.board)
+
+    def eventsWithAny(self, chans=None):
+        return self.run.eventsWithAny(chans, self.board)
+
+    def eventsWithAll(self, chans):
+        return self.run.eventsWithAll(chans, self.board)
+
+    def sparseIter(self, chans=None):
+        return self.run.sparseIter(chans, self.board)
+
+    def timeline(self):
+        return self.run.timeline(self.board)
+
+    def triggerTime(self, event_num):
+        return self.run.triggerTime(event_num, self.board)
+
+    def eventsInWindow(self, start, stop):
+        return self.run.eventsInWindow(start, stop, self.board)
+
+    def maskCapacitors(self, mask):
+        return self.run.maskCapacitors(mask, self.board)
+
+    def prettyid(self):
+        return prettyBoard(self.board_id)
+
+    def __len__(self):
+        lo, hi = self.run.boardRows(self.board)
+        return hi - lo
+
     def __iter__(self):
-        for i in self.offsetTable.keys():
-            yield self.loadEvent(i)
+        for event_num in self.getArrivalOrderedEventNumbers():
+            yield self.loadEvent(int(event_num))
 
 # A human-readable view of the (cached) array state
 def dumpCachedView(array, width=3):
@@ -111,7 +111,7 @@ if __name__ == '__main__':
         stdevs[chan] = np.sqrt(sumsquares[chan]/counts[chan] - avgs[chan]**2)            
     # Write out a binary timing file
     import pickle
-    pickle.dump(pedestal(avgs, stdevs, counts), open("%s.pedestal" % board_id.hex(), 'wb'))
+    pickle.dump(pedestal(avgs, stdevs, counts, board_id), open("%s.pedestal" % board_id.hex(), 'wb'))
 
     # Let the whole world know, the pedestals are back in town
     print("%s.pedestal" % board_id.hex())
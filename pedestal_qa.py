@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+#
+# pedestal_qa.py
+#
+# Finds bad capacitors in a pedestal, all channels at once.
+#
+# Means, RMSs and counts are taken as (64 x 1024) arrays, and each channel is
+# judged against itself with robust statistics (median, and MAD scaled to a
+# standard deviation), so a handful of bad capacitors can't hide themselves
+# by dragging the channel's statistics along.  A capacitor is flagged if it
+#
+#   - isn't a number (no unflagged samples at all)
+#   - saw less than a fraction of the channel's median count
+#   - is noisier than the channel by more than rms_cut sigmas
+#   - doesn't move (RMS under STUCK_RMS), or sits at an ADC rail
+#   - has a mean further than mean_cut sigmas from the channel's
+#
+# Problems are bits in a (64 x 1024) array of flags, and mask() turns them
+# into booleans that packetteRun.maskCapacitors() takes.
+#
+# Means are in 16 bit sample units (12 bits of ADC above 4 flag bits), as
+# pedestal_calibration.py writes them; everything here is in ADC counts.
+#
+
+import sys
+import pickle
+import warnings
+import numpy as np
+
+NUM_CHANNELS = 64
+CAP_LEN = 1024
+
+# Problems, as bits
+NOT_A_NUMBER = 0x1
+LOW_COUNT = 0x2
+HIGH_RMS = 0x4
+STUCK = 0x8
+OUTLIER = 0x10
+
+problems = [(NOT_A_NUMBER, 'nan'),
+            (LOW_COUNT, 'low count'),
+            (HIGH_RMS, 'high rms'),
+            (STUCK, 'stuck'),
+            (OUTLIER, 'outlier')]
+
+# MAD of normal data, in standard deviations
+MAD_SIGMA = 1.4826
+
+# Floor on a channel's spread (a uniformly quantized count)
+QUANTIZATION = 1/np.sqrt(12)
+
+# Below this RMS (in counts) a capacitor isn't moving
+STUCK_RMS = 0.05
+
+# ADC rails, in counts
+RAILS = (0, 0xFFF)
+
+#
+# The pedestal as (64 x 1024) float arrays of mean and RMS (in counts) and counts,
+# NaN for channels it doesn't have, and which channels it has
+#
+def arrays(aPedestal):
+
+    means = np.full([NUM_CHANNELS, CAP_LEN], np.nan)
+    rmss = np.full([NUM_CHANNELS, CAP_LEN], np.nan)
+    counts = np.full([NUM_CHANNELS, CAP_LEN], np.nan)
+    present = np.zeros(NUM_CHANNELS, dtype=bool)
+
+    for chan in aPedestal.mean:
+        present[chan] = True
+
+        # Samples are signed 16 bit, so the upper half of the ADC range wraps
+        means[chan] = np.mod(np.asarray(aPedestal.mean[chan], dtype=np.float64), 1 << 16) / 16
+        if aPedestal.rms is not None:
+            rmss[chan] = np.asarray(aPedestal.rms[chan], dtype=np.float64) / 16
+        if aPedestal.counts is not None:
+            counts[chan] = aPedestal.counts[chan]
+
+    return means, rmss, counts, present
+
+# Per channel median and (MAD) standard deviation, as columns
+def robust(values):
+    median = np.nanmedian(values, axis=1, keepdims=True)
+    sigma = MAD_SIGMA * np.nanmedian(np.abs(values - median), axis=1, keepdims=True)
+    return median, np.fmax(sigma, QUANTIZATION)
+
+#
+# Flags for every capacitor (0 is good, and for channels the pedestal doesn't have)
+#
+def inspect(aPedestal, min_counts=0.5, rms_cut=6.0, mean_cut=6.0):
+
+    means, rmss, counts, present = arrays(aPedestal)
+    flags = np.zeros([NUM_CHANNELS, CAP_LEN], dtype=np.uint8)
+
+    # (Absent channels are all NaN, which numpy complains about)
+    with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        flags[~np.isfinite(means)] |= NOT_A_NUMBER
+
+        if aPedestal.counts is not None:
+            median = np.nanmedian(counts, axis=1, keepdims=True)
+            flags[counts < min_counts*median] |= LOW_COUNT
+
+        if aPedestal.rms is not None:
+            median, sigma = robust(rmss)
+            flags[rmss > median + rms_cut*sigma] |= HIGH_RMS
+            flags[rmss < STUCK_RMS] |= STUCK
+
+        flags[(means <= RAILS[0]) | (means >= RAILS[1])] |= STUCK
+
+        median, sigma = robust(means)
+        flags[np.abs(means - median) > mean_cut*sigma] |= OUTLIER
+
+    flags[~present] = 0
+    return flags
+
+# Which capacitors to mask, for packetteRun.maskCapacitors()
+def mask(flags, which=0xFF):
+    return (flags & which) != 0
+
+#
+# A compact report: totals, then a line per channel with problems
+#
+def report(flags, name='pedestal', file=sys.stdout):
+
+    bad = mask(flags)
+    print("# %s: %d bad capacitors in %d channels" % (name, bad.sum(), bad.any(axis=1).sum()), file=file)
+    if not bad.any():
+        return
+
+    print("# %s" % ', '.join("%d %s" % (((flags & bit) != 0).sum(), label) for bit, label in problems), file=file)
+
+    for chan in np.flatnonzero(bad.any(axis=1)):
+        caps = np.flatnonzero(bad[chan])
+
+        # Just the first few, the mask has the rest
+        shown = ' '.join("%d(%s)" % (cap, '/'.join(label for bit, label in problems if flags[chan, cap] & bit)) for cap in caps[:8])
+        print("channel %2d: %4d bad: %s%s" % (chan, len(caps), shown, ' ...' if len(caps) > 8 else ''), file=file)
+
+#
+# Entry point for the checker
+#
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check pedestals for bad capacitors (exits 1 if any are found)')
+    parser.add_argument('pedestals', metavar='PEDESTAL', nargs='+', help='pedestal files (from pedestal_calibration.py)')
+    parser.add_argument('--min-counts', type=float, default=0.5, help="flag capacitors with less than this fraction of their channel's median count (default: 0.5)")
+    parser.add_argument('--rms-cut', type=float, default=6.0, help="flag capacitors noisier than their channel by this many sigmas (default: 6)")
+    parser.add_argument('--mean-cut', type=float, default=6.0, help="flag capacitors with means this many sigmas from their channel's (default: 6)")
+    parser.add_argument('-m', '--mask', action='store_true', help='save the mask of bad capacitors as PEDESTAL.mask.npy, for packetteRun.maskCapacitors()')
+    args = parser.parse_args()
+
+    found = False
+    for fname in args.pedestals:
+        flags = inspect(pickle.load(open(fname, "rb")), args.min_counts, args.rms_cut, args.mean_cut)
+        report(flags, fname)
+
+        if args.mask:
+            np.save(fname + '.mask.npy', mask(flags))
+
+        found |= bool(flags.any())
+
+    sys.exit(1 if found else 0)
@@ -1,103 +1,287 @@
 #!/usr/bin/python3
-from sys import argv,path
+import sys
 import pickle
+import argparse
+import time
+import io
+import os
+import socket
 from os import environ
-#import numpy as np
+import numpy as np
 
 # Do not ask me why this needs to be included now...
-path.append("./eevee")
+sys.path.append("./eevee")
 environ['EEVEE_SRC_PATH'] = "./eevee"
 
 from lappdIfc import ADDR_PEDMEM_OFFSET
-import eevee
+import A2x_common
+import pedestal_qa
 
-# 1) Load the pedestal
-aPedestal = pickle.load(open(argv[1], "rb"))
-print("Pedestal file %s loaded." % argv[1])
+#
+# Pedestal memory: one 32 bit register per capacitor, holding the 12 bit pedestal
+#
+PEDESTAL_BITS = 0xFFF
+NUM_CHANNELS = 64
+CAP_LEN = 1024
+
+#
+# The last image uploaded to each board is kept as a flat array over pedestal memory
+# (-1 where unknown), in <cache>/<board MAC>.npy, so later uploads only write what changed.
+#
+DEFAULT_CACHE = os.path.expanduser('~/.packette/pedestals')
+
+# Where in the image a register is
+def imageIndex(addrs):
+    return (addrs - ADDR_PEDMEM_OFFSET) >> 2
+
+# The board a pedestal belongs to (older pedestals only have it in their file name)
+def pedestalBoard(aPedestal, fname):
+    board_id = getattr(aPedestal, 'board_id', None)
+    if board_id is not None:
+        return board_id.hex()
+
+    stem = os.path.basename(fname).split('.')[0]
+    try:
+        return bytes.fromhex(stem).hex() if len(stem) == 12 else None
+    except ValueError:
+        return None
+
+def loadImage(cache, board):
+    try:
+        image = np.load(os.path.join(cache, board + '.npy'))
+        if image.shape == (NUM_CHANNELS*CAP_LEN,):
+            return image
+    except (OSError, ValueError):
+        pass
+    return None
+
+def saveImage(cache, board, image):
+    os.makedirs(cache, exist_ok=True)
+    fname = os.path.join(cache, board + '.npy')
+
+    # Never leave half an image behind
+    with open(fname + '.tmp', 'wb') as f:
+        np.save(f, image)
+    os.replace(fname + '.tmp', fname)
+
+def forgetImage(cache, board):
+    try:
+        os.remove(os.path.join(cache, board + '.npy'))
+    except FileNotFoundError:
+        pass
+
+# Read all of pedestal memory back
+def readImage(pipeline):
+    addrs = ADDR_PEDMEM_OFFSET + 4*np.arange(NUM_CHANNELS*CAP_LEN)
+    return A2x_common.scatterread(pipeline, addrs) & PEDESTAL_BITS
+
+# How many of a random sample of the image's known registers the board doesn't hold
+# (pedestal memory can be lost behind our back: power cycles, firmware reloads, -I)
+def differs(pipeline, image, sample):
+    known = np.flatnonzero(image >= 0)
+    if len(known) > sample:
+        known = np.sort(np.random.choice(known, sample, replace=False))
+
+    readback = A2x_common.scatterread(pipeline, ADDR_PEDMEM_OFFSET + 4*known) & PEDESTAL_BITS
+    return np.count_nonzero(readback != image[known]), len(known)
 
-# 1.5) Connect to the board
-board = eevee.board(argv[2])
-print("Connection to EEVEE @ %s established." % argv[2])
+#
+# The MAC of the board at address, as the board itself gave it to the kernel
+# (from the ARP table, so only once we've talked to it, and not through a router)
+#
+def boardMAC(address, arp='/proc/net/arp'):
+    try:
+        address = socket.gethostbyname(address)
+        with open(arp) as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) >= 4 and fields[0] == address and not fields[3] == '00:00:00:00:00:00':
+                    return fields[3].replace(':', '').lower()
+    except OSError:
+        pass
+    return None
 
-# 2) Iterate through
 #
-# Since packets are limited to the maximum ethernet payload 1516 bytes (ish)
-# We have 1024 pedestals per channel
-# Each register set is a 32bit address and 32bit word
-# 
-maxSetsPerPacket = 32
-
-count = 0
-tmp = {}
-for chan in aPedestal.mean:
-    # Write backwards to work around bug in FW108
-    derp = enumerate(aPedestal.mean[chan])
-    for i, ped in derp:
-
-        # Truncate it
-        try:
-            ped = (int(ped) & 0xFFFF) >> 4
-        except ValueError:
-            print("WARNING bad pedestal, channel %d capacitor %d" % (chan, i))
-            continue
-        
+# Registers and values for a pedestal, as parallel arrays
+#
+def pedestalRegisters(aPedestal):
+
+    addrs = []
+    values = []
+
+    for chan in aPedestal.mean:
+        means = np.asarray(aPedestal.mean[chan], dtype=np.float64)
+
+        # Skip anything that didn't come out as a number (pedestal_qa reports them)
+        caps = np.flatnonzero(np.isfinite(means))
+
         # Multiplication by 4 because 32bits per address
-        addr = ADDR_PEDMEM_OFFSET + (chan << 12) + i*4
-                
-        # This method guarantees that only one 'register write'
-        # operation is required to set all these registers
-        tmp[addr] = ped if ped >= 0 else ped + 0xFFF + 1
-        count += 1 
-
-        if count == maxSetsPerPacket:
-            # Execute the transaction (now clears transactions)
-            board.poke(tmp, silent=True)
-            board.transact()
-            
-            # Clear it
-            tmp = {}
-        
-            # Reset count
-            count = 0
-
-# Dirty HAX for broken firmware pedestal 0 in FW < 109
-
-# for chan in aPedestal.mean:
-#     for i, ped in enumerate(aPedestal.mean[chan]):
-#         # Truncate it
-#         try:
-#             ped = (int(ped) & 0xFFFF) >> 4
-#         except ValueError:
-#             print("WARNING bad pedestal, channel %d capacitor %d" % (chan, i))
-#             continue
-        
-#         # Multiplication by 4 because 32bits per address
-#         addr = ADDR_PEDMEM_OFFSET + (chan << 12) + i*4
-                
-#         # This method guarantees that only one 'register write'
-#         # operation is required to set all these registers
-#         tmp[addr] = ped if ped >= 0 else ped + 0xFFF + 1
-#         count += 1 
-
-#         if count == maxSetsPerPacket:
-#             # Execute the transaction (now clears transactions)
-#             board.poke(tmp, silent=True)
-#             board.transact()
-            
-#             # Clear it
-#             tmp = {}
-        
-#             # Reset count
-#             count = 0
-
-#         break;
-    
-# Was there any leftover?
-if count > 0 and count < maxSetsPerPacket:
-    # Execute the transaction
-    board.poke(tmp, silent=True)
-    board.transact()
-    print("Sent residual chunt", chan, i, ped)
-
-# Done
-print("Pedestal written.")
+        addrs.append(ADDR_PEDMEM_OFFSET + (chan << 12) + caps*4)
+
+        # Truncate it (the means are in 16 bit sample units, with 4 flag bits at the bottom)
+        values.append((means[caps].astype(np.int64) & 0xFFFF) >> 4)
+
+    return np.concatenate(addrs), np.concatenate(values)
+
+#
+# Read back registers and return the indices of the ones that don't match
+#
+def verify(pipeline, addrs, values, sample=None):
+
+    which = np.arange(len(addrs))
+    if sample is not None and sample < len(addrs):
+        which = np.sort(np.random.choice(len(addrs), sample, replace=False))
+
+    readback = A2x_common.scatterread(pipeline, addrs[which])
+    return which[(readback & PEDESTAL_BITS) != values[which]]
+
+#
+# Upload the pedestal in fname to the board at address
+#
+def upload(fname, address, args):
+
+    # Tell them apart when there are several going at once
+    # (whole lines, so they don't get mixed up)
+    def say(message):
+        print("%s\n" % (message if args.single else "%s: %s" % (address, message)), end='')
+
+    # 1) Load the pedestal
+    aPedestal = pickle.load(open(fname, "rb"))
+    say("Pedestal file %s loaded." % fname)
+
+    # 1.25) Check it over
+    # (capacitors that aren't numbers are never written, anything else is, unless --strict)
+    out = io.StringIO()
+    flags = pedestal_qa.inspect(aPedestal)
+    pedestal_qa.report(flags, fname, out)
+    for line in out.getvalue().splitlines():
+        say(line)
+
+    if args.strict and flags.any():
+        say("ERROR pedestal has bad capacitors, not uploading it (see pedestal_qa.py)")
+        return False
+
+    # 1.5) Connect to the board
+    pipeline = A2x_common.connections(address, args.depth)
+    say("Connection to EEVEE @ %s established (%d transactions in flight)." % (address, args.depth))
+
+    # 2) Work out every register at once
+    #
+    # Since packets are limited to the maximum ethernet payload 1516 bytes (ish)
+    # We have 1024 pedestals per channel
+    # Each register set is a 32bit address and 32bit word, so 32 go in a packet
+    #
+    addrs, values = pedestalRegisters(aPedestal)
+
+    # 2.25) Which board is it really?
+    # (talk to it first, so the kernel has its MAC)
+    A2x_common.scatterread(pipeline, [ADDR_PEDMEM_OFFSET])
+    reported = boardMAC(address)
+
+    full = args.full
+    resync = args.resync
+    board = pedestalBoard(aPedestal, fname)
+    if reported is not None:
+        if board is not None and not board == reported:
+            say("ERROR pedestal is for board %s, but the board at %s is %s" % (board, address, reported))
+            return False
+        board = reported
+    elif board is None:
+        say("WARNING neither the pedestal nor the board say which board it is, writing all of it")
+        full = True
+
+    # 2.5) Only write what's changed since the last upload to this board
+    image = None
+    if not full and not resync:
+        image = loadImage(args.cache, board)
+        if image is None:
+            say("No previous upload to %s on record, writing all of it" % board)
+        else:
+            # Make sure the board still has it
+            wrong, checked = differs(pipeline, image, args.sample)
+            if wrong:
+                say("WARNING board doesn't hold its last upload (%d of %d sampled registers differ), reading it all back" % (wrong, checked))
+                forgetImage(args.cache, board)
+                image = None
+                resync = True
+
+    if resync:
+        start = time.time()
+        image = readImage(pipeline)
+        say("Read back all pedestal memory in %.2f s." % (time.time() - start))
+
+    if image is None:
+        image = np.full(NUM_CHANNELS*CAP_LEN, -1, dtype=np.int64)
+
+    total = len(addrs)
+    changed = np.flatnonzero(image[imageIndex(addrs)] != values)
+    image[imageIndex(addrs)] = values
+    addrs = addrs[changed]
+    values = values[changed]
+
+    # 3) Write them
+    # (Until they're verified, the cached image can't be trusted)
+    if board is not None:
+        forgetImage(args.cache, board)
+
+    start = time.time()
+    A2x_common.scatterwrite(pipeline, addrs, values)
+    say("Wrote %d of %d pedestal registers (the rest were already there) in %.2f s." % (len(addrs), total, time.time() - start))
+
+    # 4) Check them, and rewrite anything that didn't take
+    if not args.verify == 'none':
+        sample = args.sample if args.verify == 'sample' else None
+
+        bad = verify(pipeline, addrs, values, sample)
+
+        # If the sample found anything, check the rest too
+        if len(bad) and sample is not None:
+            say("WARNING sampled readback found %d bad pedestal registers, reading back all of them" % len(bad))
+            bad = verify(pipeline, addrs, values)
+            sample = None
+
+        if len(bad):
+            say("WARNING %d pedestal registers read back wrong, rewriting them" % len(bad))
+            A2x_common.scatterwrite(pipeline, addrs[bad], values[bad])
+
+            bad = bad[verify(pipeline, addrs[bad], values[bad])]
+            if len(bad):
+                say("ERROR %d pedestal registers could not be written (first at 0x%x)" % (len(bad), addrs[bad[0]]))
+                return False
+
+        say("Verified %s pedestal registers." % ("all" if sample is None else "%d sampled" % min(sample, len(addrs))))
+
+    # 5) Remember what the board has now
+    if board is not None:
+        saveImage(args.cache, board, image)
+
+    # Done
+    say("Pedestal written.")
+    return True
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Upload pedestals into board pedestal memory (several boards are uploaded to at once)')
+    parser.add_argument('uploads', metavar='PEDESTAL IP_ADDRESS', nargs='+', help='pedestal file (from pedestal_calibration.py) and the IP address of its board, repeated for more boards')
+    parser.add_argument('--depth', metavar='DEPTH', type=int, default=8, help='register transactions in flight, per board (default: 8)')
+    parser.add_argument('--verify', choices=['none', 'sample', 'full'], default='sample', help='read back a sample of the registers, or all of them (default: sample)')
+    parser.add_argument('--sample', metavar='REGISTERS', type=int, default=1024, help='registers read back by --verify sample, and to check the board still holds its last upload (default: 1024)')
+    parser.add_argument('--full', action='store_true', help='write every register, whatever the board was last sent')
+    parser.add_argument('--resync', action='store_true', help='read all of pedestal memory back first, and write only what differs from it')
+    parser.add_argument('--strict', action='store_true', help="don't upload pedestals that pedestal_qa.py finds bad capacitors in")
+    parser.add_argument('--cache', metavar='DIR', default=DEFAULT_CACHE, help='where the last image sent to each board is kept (default: %s)' % DEFAULT_CACHE)
+    args = parser.parse_args()
+
+    if len(args.uploads) % 2:
+        parser.error("pedestals and board addresses must come in pairs")
+
+    pedestals = dict(zip(args.uploads[1::2], args.uploads[0::2]))
+    if len(pedestals) < len(args.uploads)//2:
+        parser.error("each board can only be given one pedestal")
+    args.single = len(pedestals) == 1
+
+    results, errors = A2x_common.everyboard(list(pedestals.keys()),
+                                            lambda address: upload(pedestals[address], address, args),
+                                            'uploaded')
+    if errors or not all(results.values()):
+        sys.exit(1)